@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 比较页面中大量调用 can_access 时，逐个正则匹配和 AccessEngine 的网页生成耗时
+# Usage:
+# python3 benchmark/bench_access.py [--routes=300] [--links=500]
+
+import os
+import re
+import sys
+import timeit
+import random
+from tornado import template
+from tornado.options import define, options
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from controller.com.access import AccessEngine, url_placeholder  # noqa: E402
+
+define('routes', default=300, help='routes of each role', type=int)
+define('links', default=500, help='can_access calls in a page', type=int)
+
+page = template.Template('''<ul>
+{% for url in links %}{% if can_access(url) %}<li><a href="{{ url }}">{{ url }}</a></li>{% end %}
+{% end %}</ul>''')
+
+
+def make_routes(count):
+    routes = {}
+    for role in ['访客', '普通用户', '数据管理员']:
+        routes[role] = {}
+        for i in range(count):
+            routes[role]['/%s/module%d/@num' % (role, i)] = ['GET']
+            routes[role]['/%s/module%d/list' % (role, i)] = ['GET', 'POST']
+    return routes
+
+
+class RegexAccess(object):
+    """ 未编译前缀树时的做法：每次调用按角色逐个匹配路由的(预编译)正则 """
+
+    def __init__(self, routes):
+        self.patterns = {}
+        for role, urls in routes.items():
+            for url, methods in urls.items():
+                for k, v in url_placeholder.items():
+                    url = url.replace('@' + k, '(%s)' % v)
+                self.patterns.setdefault(role, []).append((re.compile(url + '$'), methods))
+
+    def can_access(self, roles, method, path):
+        return any(method in methods and regex.match(path)
+                   for role in roles.split(',') for regex, methods in self.patterns.get(role, []))
+
+
+def main():
+    options.parse_command_line()
+    routes = make_routes(options.routes)
+    urls = [u.replace('@num', str(random.randint(1, 999))) for r in routes.values() for u in r]
+    links = [random.choice(urls) for _ in range(options.links)]
+    roles = '普通用户,访客'
+
+    def render(engine):
+        return page.generate(links=links, can_access=lambda url, method='GET': engine.can_access(roles, method, url))
+
+    engines = [('regex', RegexAccess(routes)), ('trie', AccessEngine(routes, cache_size=0)),
+               ('trie+cache', AccessEngine(routes))]
+    assert len(set(render(engine) for name, engine in engines)) == 1
+    print('%d routes, %d can_access calls in a page' % (3 * 2 * options.routes, options.links))
+    base = None
+    for name, engine in engines:
+        ms = min(timeit.repeat(lambda: render(engine), number=10, repeat=3)) / 10 * 1000
+        base = base or ms
+        print('%-10s %8.2fms %6.1fx' % (name, ms, base / ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 比较 API 响应序列化的耗时
+# Usage:
+# python3 benchmark/bench_json.py [--docs=1000] [--rounds=20]
+
+import os
+import sys
+import json
+import timeit
+import random
+from datetime import datetime, timedelta
+from bson import json_util
+from bson.objectid import ObjectId
+from bson.decimal128 import Decimal128
+from tornado.options import define, options
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils import serializer  # noqa: E402
+
+define('docs', default=1000, help='documents in a response', type=int)
+define('rounds', default=20, help='rounds for each encoder', type=int)
+
+
+def make_docs(count):
+    """ 生成与列表接口返回数据相近的文档 """
+    now = datetime.now()
+    return [dict(
+        _id=ObjectId(), name='用户%d' % i, email='user%d@my-site.net' % i, phone='138%08d' % i,
+        roles='普通用户,数据管理员', status=random.choice(['active', 'disabled']),
+        create_time=now - timedelta(minutes=i), updated_time=now,
+        score=Decimal128('%d.%02d' % (i, i % 100)), avatar=os.urandom(32),
+        tags=['标签%d' % j for j in range(5)], stats=dict(count=i, ratio=i / 7.0, ok=True),
+        owner=dict(_id=ObjectId(), name='张三'),
+    ) for i in range(count)]
+
+
+def main():
+    options.parse_command_line()
+    response = dict(status='success', code=200, data=make_docs(options.docs))
+    encoders = [
+        ('json_util', json_util.dumps),
+        ('json', lambda obj: json.dumps(obj, default=serializer.default, ensure_ascii=False, separators=(',', ':'))),
+        ('fast', serializer.dumps_fast),
+    ]
+    print('%d docs x %d rounds, fast backend: %s' % (
+        options.docs, options.rounds, 'orjson' if serializer.orjson else 'json'))
+    base = None
+    for name, dumps in encoders:
+        seconds = min(timeit.repeat(lambda: dumps(response), number=options.rounds, repeat=3)) / options.rounds
+        base = base or seconds
+        print('%-10s %8.2fms  %5.1fx  %d bytes' % (name, seconds * 1000, base / seconds, len(dumps(response))))
+
+
+if __name__ == '__main__':
+    main()
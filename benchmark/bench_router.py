@@ -0,0 +1,67 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 比较Tornado正则路由和前缀树路由在不同路由数量下的查找耗时
+# Usage:
+# python3 benchmark/bench_router.py [--requests=2000]
+
+import os
+import sys
+import timeit
+import random
+from tornado import web
+from tornado.httputil import HTTPServerRequest
+from tornado.options import define, options
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from controller.app import Application  # noqa: E402
+from controller.router import RouteTrie  # noqa: E402
+from controller.com.access import url_placeholder  # noqa: E402
+
+define('requests', default=2000, help='requests to dispatch in a round', type=int)
+
+
+class Handler(web.RequestHandler):
+    pass
+
+
+def make_urls(count):
+    """ 生成与接口相近的路由，每个模块有列表、详情、修改三个接口 """
+    urls = []
+    for i in range(count // 3 + 1):
+        urls.extend(['/api/module%d/list' % i, '/api/module%d/@num' % i, '/api/module%d/@num/update' % i])
+    return urls[:count]
+
+
+def make_paths(urls, count):
+    return [random.choice(urls).replace('@num', str(random.randint(1, 99999))) for _ in range(count)]
+
+
+def main():
+    options.parse_command_line()
+    print('%5s %12s %12s %8s' % ('routes', 'regex(us)', 'trie(us)', 'speedup'))
+    for count in (10, 100, 1000):
+        urls = make_urls(count)
+        regex_app = web.Application([(Application.url_replace(url), Handler) for url in sorted(urls)])
+        trie = RouteTrie(url_placeholder)
+        for url in urls:
+            trie.add(url, Handler)
+        requests = [HTTPServerRequest(uri=p) for p in make_paths(urls, options.requests)]
+        assert all(regex_app.default_router.find_handler(r) for r in requests)
+        assert all(trie.match(r.path) for r in requests)
+
+        def dispatch_regex():
+            for r in requests:
+                regex_app.default_router.find_handler(r)
+
+        def dispatch_trie():  # 与正则路由一样创建请求处理的委托对象
+            for r in requests:
+                target, args = trie.match(r.path)
+                regex_app.get_handler_delegate(r, target, path_args=args)
+
+        t1 = min(timeit.repeat(dispatch_regex, number=1, repeat=5)) / len(requests) * 1e6
+        t2 = min(timeit.repeat(dispatch_trie, number=1, repeat=5)) / len(requests) * 1e6
+        print('%5d %12.2f %12.2f %7.1fx' % (count, t1, t2, t1 / t2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 比较上传大文件时同步读文件(原 body_producer)和异步逐块发送的吞吐量、IOLoop阻塞时间和内存占用
+# Usage:
+# python3 benchmark/bench_upload.py [--size_mb=1024] [--chunk_kb=64,256,1024]
+
+import os
+import sys
+import time
+import uuid
+import resource
+import tempfile
+import mimetypes
+from functools import partial
+from tornado import gen, web
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.httpclient import HTTPRequest
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from tornado.options import define, options
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils.http_helper import body_producer, multipart_length  # noqa: E402
+
+define('size_mb', default=1024, help='size of the uploaded file', type=int)
+define('chunk_kb', default='64,256,1024', help='chunk sizes of the async producer', type=str)
+define('port', default=8765, help='port of the receiving server', type=int)
+
+
+def legacy_producer(boundary, files, params, write):
+    """ 原 body_producer：在IOLoop中同步读文件，不等待写入完成 """
+    boundary_bytes = boundary.encode()
+    cr_lf = b'\r\n'
+    for arg_name in files:
+        filename = files[arg_name]
+        write(b'--%s%s' % (boundary_bytes, cr_lf))
+        write(b'Content-Disposition: form-data; name="%s"; filename="%s"%s' %
+              (arg_name.encode(), filename.encode(), cr_lf))
+        m_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        write(b'Content-Type: %s%s' % (m_type.encode(), cr_lf))
+        write(cr_lf)
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(16 * 1024)
+                if not chunk:
+                    break
+                write(chunk)
+        write(cr_lf)
+    write(b'--%s--%s' % (boundary_bytes, cr_lf))
+
+
+@web.stream_request_body
+class SinkHandler(web.RequestHandler):
+    def prepare(self):
+        self.request.connection.set_max_body_size(1 << 40)
+        self.received = 0
+
+    def data_received(self, chunk):
+        self.received += len(chunk)
+
+    def post(self):
+        self.write(dict(received=self.received))
+
+
+def make_file(size_mb):
+    f = tempfile.NamedTemporaryFile(suffix='.bin', delete=False)
+    block = os.urandom(1024 * 1024)
+    for i in range(size_mb):
+        f.write(block)
+    f.close()
+    return f.name
+
+
+async def upload(url, filename, producer, content_length=True):
+    boundary = uuid.uuid4().hex
+    files = dict(f=filename)
+    headers = {'Content-Type': 'multipart/form-data; boundary=%s' % boundary}
+    if content_length:
+        headers['Content-Length'] = str(multipart_length(boundary, files, {}))
+    request = HTTPRequest(url, method='POST', headers=headers, request_timeout=3600,
+                          body_producer=partial(producer, boundary, files, {}))
+
+    lag, last = [0.0], [time.time()]
+
+    def tick():  # 每10毫秒检查一次IOLoop被阻塞的时长
+        now = time.time()
+        lag[0] = max(lag[0], now - last[0] - 0.01)
+        last[0] = now
+
+    timer = PeriodicCallback(tick, 10)
+    timer.start()
+    start = time.time()
+    try:
+        await SimpleAsyncHTTPClient(force_instance=True).fetch(request)
+    finally:
+        timer.stop()
+    return time.time() - start, lag[0]
+
+
+async def run(filename):
+    web.Application([('/upload', SinkHandler)]).listen(options.port, max_body_size=1 << 40)
+    url = 'http://127.0.0.1:%d/upload' % options.port
+    cases = [('async %dKB' % kb, partial(body_producer, chunk_size=kb * 1024))
+             for kb in map(int, options.chunk_kb.split(','))]
+    cases.append(('legacy 16KB', legacy_producer))
+    for name, producer in cases:
+        await gen.sleep(0.1)
+        seconds, lag = await upload(url, filename, producer, content_length=producer is not legacy_producer)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        print('%-12s %7.2fs %8.1fMB/s  max loop block %7.1fms  peak rss %7.1fMB' % (
+            name, seconds, options.size_mb / seconds, lag * 1000, rss))
+
+
+def main():
+    options.parse_command_line()
+    filename = make_file(options.size_mb)
+    print('upload %dMB' % options.size_mb)
+    try:
+        IOLoop.current().run_sync(partial(run, filename))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 比较每次调用 validate 和重复使用预先编译的 Validator 校验表单数据的耗时
+# Usage:
+# python3 benchmark/bench_validate.py [--rounds=20000]
+
+import os
+import sys
+import timeit
+from tornado.options import define, options
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from controller import validate as v  # noqa: E402
+
+define('rounds', default=20000, help='validations for each case', type=int)
+
+# 注册表单的典型规则和数据
+rules = [
+    (v.not_empty, 'name', 'phone', 'password'),
+    (v.not_both_empty, 'phone', 'email'),
+    (v.is_name, 'name'),
+    (v.is_phone, 'phone'),
+    (v.is_email, 'email'),
+    (v.is_password, 'password'),
+    (v.not_equal, 'password', 'old_password'),
+    (v.between, 'age', 10, 100),
+    (v.in_list, 'gender', ['男', '女']),
+]
+valid = {'name': '张三', 'phone': '13800001234', 'email': 'zhang@my-site.net', 'password': 'abc123!',
+         'old_password': 'abc1234', 'age': 30, 'gender': '男'}
+invalid = {'name': 'a', 'phone': '1380000', 'email': 'zhang', 'password': '123456',
+           'old_password': '123456', 'age': 3, 'gender': '未知'}
+
+
+def main():
+    options.parse_command_line()
+    validator = v.Validator(rules)
+    print('%-8s %14s %14s %8s' % ('data', 'validate(us)', 'Validator(us)', 'speedup'))
+    for name, data in [('valid', valid), ('invalid', invalid)]:
+        assert v.validate(data, rules) == validator.validate(data)
+        t1 = min(timeit.repeat(lambda: v.validate(data, rules), number=options.rounds, repeat=3))
+        t2 = min(timeit.repeat(lambda: validator.validate(data), number=options.rounds, repeat=3))
+        print('%-8s %14.2f %14.2f %7.1fx' % (name, t1 / options.rounds * 1e6, t2 / options.rounds * 1e6, t1 / t2))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,7 @@ from controller import com
 views = com.views
 
 handlers = com.handlers
-handlers += [invalid.ApiTable]
+handlers += [invalid.ApiTable, invalid.ApiMetrics]
 
 modules = com.modules
 
@@ -6,13 +6,35 @@
 """
 
 import re
+import time
+import inspect
+import logging
 from os import path
+from functools import partial
 from operator import itemgetter
-from tornado import web
+from tornado import web, gen, httputil
+from tornado.web import RequestHandler
 from tornado.options import define, options
 from tornado.log import access_log
-from controller.com.access import url_placeholder
-from utils.helper import load_config, connect_db, BASE_DIR
+from tornado.ioloop import IOLoop
+from pymongo.errors import PyMongoError
+from controller.com.access import url_placeholder, AccessEngine
+from controller.router import RouteTrie
+from utils.helper import load_config, config_service, connect_db, connect_db_async, prop, BASE_DIR
+from utils.config import thaw
+from utils.http_helper import configure_client
+from utils.executor import configure_executors, shutdown_executors, executor_stats, thread_pool
+from utils.mongo_pool import PoolMonitor
+from utils.db_monitor import CommandMonitor
+from utils.indexes import registry as index_registry, log_report
+from utils.log_buffer import LogBuffer
+from utils.cache import SessionCache, ResponseCache
+from utils.serializer import get_encoder
+from utils.metrics import Metrics, split_stats
+from utils.admission import AdmissionControl
+from utils.async_db import AsyncDatabase
+from utils.supervisor import stop_server
+from utils.template_loader import TemplateLoader
 
 
 __version__ = '0.0.83.91223'
@@ -24,56 +46,207 @@ define('port', default=8001, help='run port', type=int)
 
 class Application(web.Application):
     def __init__(self, handlers, **settings):
-        self._db = self.db_uri = self.config = self.site = None
+        self._db = self._async_db = self.db_uri = self.config = self.site = None
+        self._active_requests = set()  # 正在处理的请求，用于停止服务前等待
+        self._shutdown_callbacks, self._stopped = [], False
         self._init_config(settings.get('db_name_ext'))
+        self.op_log = self._init_op_log()
+        if self.op_log:
+            self.add_shutdown_callback(self.op_log.flush)
+        self.session_cache = SessionCache(**(self.config.get('session_cache') or {}))
+        self.json_dumps = get_encoder(self.config.get('json_encoder') or 'fast')
+        self.metrics = self._init_metrics()
+        self.pool_monitor = PoolMonitor(self.metrics)
+        counts, gauges = split_stats(lambda: self.pool_monitor.stats, ('checked_out', 'idle'))
+        self.metrics.add_source('mongo_pool_total', counts)
+        self.metrics.add_source('mongo_pool_connections', gauges, 'gauge')
+        if not self.pool_monitor.supported:
+            logging.info('mongo pool metrics are unavailable, they need pymongo 3.9+')
+        self.db_monitor = self._init_db_monitor()
+        self.access = self._init_access()
+        self.response_cache = self._init_response_cache()
+        self.admission = self._init_admission()
+        configure_client(**(self.config.get('http_client') or {}))
+        self._init_executors()
 
         self.version = __version__ + '-master'
         self.BASE_DIR = BASE_DIR
         self.handlers = handlers
         handlers = []
 
-        for cls in self.handlers:
-            if isinstance(cls.URL, list):
-                handlers.extend((self.url_replace(url), cls) for url in cls.URL)
-            else:
-                handlers.append((self.url_replace(cls.URL), cls))
+        # router 为 trie 时，能放入前缀树的路由不再逐个正则匹配，其余仍由 Tornado 按正则匹配。
+        # 路由按正则排序后依次加入，多个路由都匹配时仍取排在前面的，与只用正则路由时一致
+        self.router = RouteTrie(url_placeholder) if self.config.get('router') == 'trie' else None
+        self._regex_routes = []  # 未加入前缀树的路由 [(序号, 正则)]
+        routes = sorted(((self.url_replace(url), url, cls) for cls in self.handlers
+                         for url in (cls.URL if isinstance(cls.URL, list) else [cls.URL])), key=itemgetter(0))
+        for order, (pattern, url, cls) in enumerate(routes):
+            if not (self.router and self.router.add(url, (order, cls))):
+                handlers.append((pattern, cls))
+                if self.router:
+                    self._regex_routes.append((order, re.compile(pattern if pattern.endswith('$') else pattern + '$')))
 
-        handlers = sorted(handlers, key=itemgetter(0))
+        template_path = path.join(BASE_DIR, 'views')
+        settings.update(self._init_templates(template_path))
         web.Application.__init__(
             self, handlers,
             debug=options.debug,
             login_url=self.config['sso'],
-            compiled_template_cache=False,
             static_path=path.join(BASE_DIR, 'static'),
-            template_path=path.join(BASE_DIR, 'views'),
+            template_path=template_path,
             cookie_secret=self.config['cookie_secret'],
             log_function=self.log_function,
             **settings
         )
 
+    @property
+    def active_requests(self):
+        return len(self._active_requests)
+
+    def find_handler(self, request, **kwargs):
+        self._active_requests.add(request)  # 在 log_request 或连接断开时移除
+        route = self.router and self.router.match(request.path)
+        if route and not self._earlier_regex_route(route[0][0], request.path):
+            delegate = self.get_handler_delegate(request, route[0][1], path_args=route[1])
+        else:
+            delegate = super(Application, self).find_handler(request, **kwargs)
+        return _ActiveRequestDelegate(self._active_requests, request, delegate)
+
+    def _earlier_regex_route(self, order, path):
+        """ 排在前缀树匹配的路由之前的正则路由是否也匹配，是则应按正则路由处理 """
+        for i, regex in self._regex_routes:
+            if i > order:
+                return False
+            if regex.match(path):
+                return True
+        return False
+
     @staticmethod
     def url_replace(url):
         for k, v in url_placeholder.items():
             url = url.replace('@' + k, '(%s)' % v)
         return url
 
+    def log_request(self, handler):
+        self._active_requests.discard(handler.request)
+        super(Application, self).log_request(handler)
+
     @staticmethod
     def log_function(handler):
         summary = handler._request_summary()
         s = handler.get_status()
-        if not (s in [304, 200] and re.search(r'GET /(static|api/(pull|message|discuss))', summary) or s == 404):
+        request_time = 1000.0 * handler.request.request_time()
+        handler.application.metrics.observe('http_request_duration_ms', request_time, code=s,
+                                            handler=handler.__class__.__name__, method=handler.request.method)
+        if not (s in [304, 200] and re.search(r'GET /(static|api/(pull|message|discuss|metrics))', summary)
+                or s == 404):
             nick = hasattr(handler, 'current_user') and handler.current_user
             nickname = nick and (hasattr(nick, 'name') and nick.name or nick.get('name')) or ''
-            request_time = 1000.0 * handler.request.request_time()
             log_method = access_log.info if s < 400 else access_log.warning if s < 500 else access_log.error
-            log_method("%d %s %.2fms%s", s, summary, request_time, nickname and ' [%s]' % nickname or '')
+            log_method("%d %s %.2fms%s%s", s, summary, request_time, nickname and ' [%s]' % nickname or '',
+                       Application._db_summary(handler))
+
+    @staticmethod
+    def _db_summary(handler):
+        """ 访问日志中本请求的文档库命令数、耗时和文档数，命令数超过 db_monitor.many_queries 时警告(可能是N+1查询) """
+        stats = getattr(handler, 'db_stats', None)
+        if not stats or not stats.count:
+            return ''
+        many = prop(handler.application.config, 'db_monitor.many_queries', 20)
+        if many and stats.count > many:
+            logging.warning('%d db commands in %s %s, maybe N+1 queries' % (
+                stats.count, handler.request.method, handler.request.path))
+        return ' db=%d/%.2fms/%ddocs' % (stats.count, stats.time_ms, stats.docs)
+
+    @property
+    def db_listeners(self):
+        return [m for m in (self.pool_monitor.supported and self.pool_monitor, self.db_monitor) if m]
 
     @property
     def db(self):
         if not self._db:
-            self._db, self.db_uri = connect_db(self.config['database'])
+            self._db, self.db_uri = connect_db(self.config['database'], self.db_listeners)
+            if self.db_monitor:
+                self.db_monitor.client = self._db.client
         return self._db
 
+    @property
+    def async_db(self):
+        """ 可 await 的文档库对象，由 database.async_driver 配置选用 motor 或线程池封装 """
+        if not self._async_db:
+            self._async_db = connect_db_async(self.config['database'], self.db, self.db_listeners)[0]
+        return self._async_db
+
+    async def prewarm_db(self):
+        """ 在工作进程中(fork之后)预先建立 database.options.minPoolSize 个连接，避免启动后的首批请求等待建立连接 """
+        size = prop(self.config, 'database.options.minPoolSize', 0)
+        if not size:
+            return
+        start = time.time()
+        try:
+            await gen.multi([thread_pool.run(self.db.command, 'ping') for _ in range(size)])
+            logging.info('%s db connections are ready in %.1fms' % (
+                self.pool_monitor.stats.get('idle', '?'), (time.time() - start) * 1000))
+        except PyMongoError as err:
+            logging.warning('fail to prewarm db connections: %s' % str(err))
+
+    async def ensure_indexes(self):
+        """ 在后台创建 utils.indexes 中登记而文档库中缺少的索引，报告未登记和未使用的索引。多进程时只在一个进程中调用 """
+        if not prop(self.config, 'indexes.ensure', True):
+            return
+        start = time.time()
+        try:
+            log_report(await thread_pool.run(index_registry.reconcile, self.db))
+            logging.info('indexes are reconciled in %.1fms' % ((time.time() - start) * 1000))
+        except PyMongoError as err:
+            logging.warning('fail to ensure indexes: %s' % str(err))
+
+    def check_indexes(self):
+        """ 检查登记的查询方式是否都有索引可用，返回没有索引可用的查询方式，文档库无法访问时只按登记的索引检查 """
+        try:
+            return index_registry.check(self.db)
+        except PyMongoError as err:
+            logging.warning('check indexes without the database: %s' % str(err))
+            return index_registry.check()
+
+    def watch_config(self):
+        """
+        在工作进程中每隔 config_reload.interval 秒检查配置文件，下列配置项修改后直接生效，其余的需重启工作进程。
+        其它模块可用 utils.helper.config_service.subscribe 订阅配置项的修改
+        """
+        reloaders = dict(
+            admission=lambda cfg: setattr(self, 'admission', self._init_admission()),
+            response_cache=lambda cfg: setattr(self, 'response_cache', self._init_response_cache()),
+            access=lambda cfg: setattr(self, 'access', self._init_access()),
+            session_cache=lambda cfg: self.session_cache.configure(**(cfg or {})),
+            op_log=self._reload_op_log,
+            db_monitor=self._reload_db_monitor,
+            json_encoder=lambda cfg: setattr(self, 'json_dumps', get_encoder(cfg or 'fast')),
+            upload=None,  # 处理请求时读取 self.config，不需另外处理
+        )
+        for key, apply in reloaders.items():
+            callback = partial(self._reload_config, key, apply)
+            config_service.subscribe(key, callback)
+            self.add_shutdown_callback(config_service.unsubscribe, key, callback)
+        config_service.start(prop(self.config, 'config_reload.interval', 5))
+        self.add_shutdown_callback(config_service.stop)
+
+    def _reload_config(self, key, apply, value, old):
+        self.config[key] = thaw(value)
+        if apply:
+            apply(self.config[key])
+
+    def _reload_op_log(self, cfg):
+        if self.op_log:
+            self.op_log.configure(**{k: v for k, v in (cfg or {}).items() if k != 'buffered'})
+
+    def _reload_db_monitor(self, cfg):
+        if self.db_monitor:
+            cfg = cfg or {}
+            self.db_monitor.slow_ms = cfg.get('slow_ms', 100)
+            self.db_monitor.explain_slow = cfg.get('explain_slow', False)
+            self.db_monitor.plans.ttl = cfg.get('explain_interval', 600)
+
     def _init_config(self, db_name_ext=None):
         self.config = load_config()
         self.site = self.config['site']
@@ -81,5 +254,159 @@ class Application(web.Application):
         if db_name_ext and not self.config['database']['name'].endswith('_test'):
             self.config['database']['name'] += db_name_ext
 
+    def _init_op_log(self):
+        cfg = dict(self.config.get('op_log') or {})
+        if cfg.pop('buffered', True):
+            return LogBuffer(lambda: self.db.log, **cfg)
+
+    def _init_metrics(self):
+        cfg = self.config.get('metrics') or {}
+        metrics = Metrics(cfg.get('path') and path.join(BASE_DIR, cfg['path']), cfg.get('interval', 5))
+        if self.op_log:
+            metrics.add_source('op_log_total', lambda: self.op_log.stats)
+            metrics.add_source('op_log_queue', lambda: dict(queued=len(self.op_log)), 'gauge')
+        metrics.add_source('session_cache_total', lambda: self.session_cache.stats)
+        self.add_shutdown_callback(metrics.stop)
+        return metrics
+
+    def _init_db_monitor(self):
+        """ 按请求统计文档库命令并写入访问日志，记录慢命令 """
+        cfg = self.config.get('db_monitor') or {}
+        if cfg.get('enabled', True):
+            monitor = CommandMonitor(cfg.get('slow_ms', 100), cfg.get('explain_slow', False),
+                                     cfg.get('explain_interval', 600), self.metrics)
+            self.metrics.add_source('db_monitor_total', lambda: monitor.stats)
+            self.add_shutdown_callback(monitor.close)
+            return monitor
+
+    def _init_access(self):
+        """ 启用访问控制时，在启动时编译各角色的可访问路由 """
+        cfg = self.config.get('access') or {}
+        if cfg.get('enabled'):
+            access = AccessEngine(cache_size=cfg.get('cache_size', 10000))
+            self.metrics.add_source('access_cache_total', lambda: access.cache.stats)
+            return access
+
+    def _init_response_cache(self):
+        """ 启用时缓存 cache_response 修饰的API响应，多进程时通过 path 目录下的文件同步失效 """
+        cfg = self.config.get('response_cache') or {}
+        if cfg.get('enabled', True):
+            cache = ResponseCache(cfg.get('max_size', 1000), cfg.get('ttl', 60),
+                                  cfg.get('path') and path.join(BASE_DIR, cfg['path']))
+            self.metrics.add_source('response_cache_total', lambda: cache.stats)
+            return cache
+
+    def _init_admission(self):
+        """ 过载保护，拒绝的请求数按原因计入 admission_total 指标 """
+        cfg = self.config.get('admission') or {}
+        self.metrics.add_source('admission_total', lambda: self.admission and self.admission.stats)
+        if cfg.get('enabled', False):
+            return AdmissionControl(**{k: v for k, v in cfg.items() if k != 'enabled'})
+
+    def _init_executors(self):
+        """ 配置 run_blocking、run_cpu 共用的线程池和进程池，池的大小按CPU数和工作进程数确定 """
+        cfg = self.config.get('executor') or {}
+        num_processes = 1 if options.debug else options.as_dict().get('num_processes') or 1
+        configure_executors(cfg.get('thread_workers', 0), cfg.get('process_workers', 0), num_processes, self.metrics)
+        gauge_keys = [pool + k for pool in ('thread_', 'process_') for k in ('in_flight', 'queued')]
+        counts, gauges = split_stats(executor_stats, gauge_keys)
+        self.metrics.add_source('executor_total', counts)
+        self.metrics.add_source('executor_tasks', gauges, 'gauge')
+        self.add_shutdown_callback(shutdown_executors)
+
+    def _init_templates(self, template_path):
+        """ 预编译全部模板并在本进程缓存，debug 模式下模板文件修改后自动重新加载 """
+        if not prop(self.config, 'template.precompile', True):
+            return dict(compiled_template_cache=False)
+        loader = TemplateLoader(template_path, reload=options.debug, metrics=self.metrics)
+        loader.precompile()
+        RequestHandler._template_loaders.pop(template_path, None)  # 不用先前的应用对象创建的模板加载器
+        return dict(template_loader=loader, compiled_template_cache=True)
+
+    def add_shutdown_callback(self, callback, *args, **kwargs):
+        """ 注册服务停止时执行的回调(可为协程)，如写入缓冲区、保存缓存。在请求处理完后、关闭文档库连接前按注册的逆序执行 """
+        self._shutdown_callbacks.append(partial(callback, *args, **kwargs))
+
+    async def shutdown(self, server=None, timeout=30):
+        """
+        分阶段停止服务，日志中记录各阶段的耗时：
+        1. 停止接受新连接，已有连接在当前请求结束后关闭；2. 等待正在处理的请求结束，最多 timeout 秒；
+        3. 执行 add_shutdown_callback 注册的回调；4. 关闭文档库连接
+        :param server: HTTPServer 对象，为空时只执行后两步
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        phases, start = [], time.time()
+        if server:
+            stop_server(server)
+            start = self._log_phase(phases, 'stop_accept', start)
+            left = await self._drain(server, timeout)
+            start = self._log_phase(phases, 'drain', start, left and '%d requests left' % left)
+        for callback in reversed(self._shutdown_callbacks):
+            try:
+                result = callback()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                logging.exception('fail to run the shutdown callback %s' % callback.func.__qualname__)
+        start = self._log_phase(phases, 'callbacks', start, '%d callbacks' % len(self._shutdown_callbacks))
+        self._close_db()
+        self._log_phase(phases, 'close_db', start)
+        logging.info('shutdown in %.1fms: %s' % (sum(t for _, t, _ in phases), ', '.join(
+            '%s %.1fms%s' % (name, t, note and ' (%s)' % note or '') for name, t, note in phases)))
+
+    @staticmethod
+    def _log_phase(phases, name, start, note=None):
+        now = time.time()
+        phases.append((name, (now - start) * 1000, note))
+        return now
+
+    async def _drain(self, server, timeout):
+        """ 等待正在处理的请求结束，返回超时后仍未结束的请求数 """
+        now = time.time()
+        deadline, grace = now + timeout, now + 1  # 刚接收的连接可能还没发来请求，最多等1秒
+        while (self.active_requests > 0 or server._connections and time.time() < grace) and time.time() < deadline:
+            await gen.sleep(0.05)
+        if self.active_requests > 0:
+            logging.warning('%d requests are still active after %ds' % (self.active_requests, timeout))
+        return self.active_requests
+
+    def _close_db(self):
+        if isinstance(self._async_db, AsyncDatabase):
+            self._async_db.close()
+        elif self._async_db is not None:  # motor
+            self._async_db.client.close()
+        if self._db is not None:
+            self._db.client.close()
+        self._db = self._async_db = None
+
     def stop(self):
-        pass
+        """ 在IOLoop未运行时(如测试结束)同步执行 shutdown 的后两步，IOLoop运行时应 await shutdown() """
+        loop = IOLoop(make_current=False)
+        try:
+            loop.run_sync(self.shutdown)
+        finally:
+            loop.close()
+
+
+class _ActiveRequestDelegate(httputil.HTTPMessageDelegate):
+    """ 请求体未收完连接就断开时，不创建处理类也不调用 log_request，在 on_connection_close 中移除请求 """
+
+    def __init__(self, active_requests, request, delegate):
+        self.active_requests = active_requests
+        self.request = request
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        return self.delegate.finish()
+
+    def on_connection_close(self):
+        self.active_requests.discard(self.request)
+        return self.delegate.on_connection_close()
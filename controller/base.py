@@ -6,26 +6,67 @@
 """
 
 import re
+import math
+import time
 import logging
+import functools
 import traceback
 from bson import json_util
 from bson.errors import BSONError
 from bson.objectid import ObjectId
 from datetime import datetime
 from pymongo.errors import PyMongoError
-from tornado.escape import to_basestring
+from itertools import islice
+from tornado.escape import to_basestring, utf8
 from tornado.options import options
-from tornado.web import RequestHandler, MissingArgumentError
+from tornado.web import RequestHandler, MissingArgumentError, Finish
 from tornado_cors import CorsMixin
 from controller import errors as e
-from controller.com.access import prepare_access, can_access
-from utils.helper import get_date_time
+from controller.com.access import prepare_access, can_access, get_roles
+from utils.helper import get_date_time, prop
 from utils.http_helper import call_api_async
+from utils.executor import thread_pool, process_pool
+from utils.pager import page_query, encode_token, decode_token
+from utils.indexes import add_index, add_query
+from utils.db_monitor import start_request
 
 MongoError = (PyMongoError, BSONError)
 DbError = MongoError
 
 
+# 操作日志(add_op_log)按时间、按用户和时间查询
+add_index('log', [('create_time', -1)])
+add_index('log', [('user_id', 1), ('create_time', -1)])
+add_query('log', 'user_id', sort=[('create_time', -1)])
+
+
+def cache_response(*collections, ttl=None):
+    """
+    缓存GET请求的响应，按路径、查询参数和用户角色区分，超时或依赖的集合被修改(见 BaseHandler.invalidate_cache)后失效。
+    响应带ETag，与请求的If-None-Match一致时返回304。app.yml 中 response_cache.enabled 为 false 时不缓存。
+    :param collections: 响应数据依赖的集合名
+    :param ttl: 缓存秒数，默认为 response_cache.ttl
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            cache = self.application.response_cache
+            if cache is not None:
+                key = self.request.path, self.request.query, get_roles(self)
+                entry = cache.get(key)
+                if entry:
+                    return self.send_cached_response(entry)
+                self._cache_key = cache, key, collections, ttl, time.time()
+            result = method(self, *args, **kwargs)
+            if result is not None:
+                await result
+
+        return wrapper
+
+    return decorator
+
+
 class BaseHandler(CorsMixin, RequestHandler):
     """ 后端API响应类的基类 """
     CORS_HEADERS = 'Content-Type,Host,X-Forwarded-For,X-Requested-With,User-Agent,Cache-Control,Cookies,Set-Cookie'
@@ -36,6 +77,24 @@ class BaseHandler(CorsMixin, RequestHandler):
         self.db = self.application.db
         self.config = self.application.config
         self.more = {}  # 给子类记录使用
+        self._cache_key = None  # 由 cache_response 设置，响应结束时缓存
+        self._admitted = None  # 计入了本请求的 AdmissionControl，重载配置后 application.admission 可能已替换
+        self.db_stats = None  # 本请求的文档库命令统计，见 utils.db_monitor
+
+    @property
+    def async_db(self):
+        """ 异步访问文档库，例如 await self.async_db.user.find_one(...) """
+        return self.application.async_db
+
+    @staticmethod
+    def run_blocking(fn, *args, **kwargs):
+        """ 在共用的线程池中执行阻塞调用(如pymongo查询、读写文件)，例如 docs = await self.run_blocking(list, cursor) """
+        return thread_pool.run(fn, *args, **kwargs)
+
+    @staticmethod
+    def run_cpu(fn, *args, **kwargs):
+        """ 在共用的进程池中执行耗CPU的计算(如生成报表)，fn 须为模块级的函数，参数和返回值须可pickle """
+        return process_pool.run(fn, *args, **kwargs)
 
     def set_default_headers(self):
         self.set_header('Access-Control-Allow-Origin', '*' if options.debug else self.application.site['domain'])
@@ -46,6 +105,9 @@ class BaseHandler(CorsMixin, RequestHandler):
 
     def prepare(self):
         """ 调用 get/post 前的准备 """
+        self.db_stats = self.application.db_monitor and start_request()
+        if not self.admit():
+            return
 
         try:
             uid = self.get_query_argument('sso_id')
@@ -61,16 +123,67 @@ class BaseHandler(CorsMixin, RequestHandler):
 
         return prepare_access(self, self.request.path, self.request.method)
 
+    def admit(self):
+        """ 过载保护，超过 app.yml 中 admission 的限制时直接返回429或503，不再处理 """
+        admission = self.application.admission
+        if not admission or admission.is_exempt(self.request.path):
+            return True
+        user = self.current_user
+        if self._finished:
+            return False
+        rejected = admission.admit(self.get_ip(), user and str(user.get('_id')))
+        if not rejected:
+            self._admitted = admission
+            return True
+
+        reason, wait = rejected
+        error = e.server_busy if reason == 'busy' else e.too_many_requests
+        self.set_status(error[0])
+        self.set_header('Retry-After', str(int(math.ceil(wait))))
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.finish(self.application.json_dumps(dict(status='failed', code=error[0], message=error[1], error=error)))
+
+    def on_finish(self):
+        self._end_request()
+
+    def on_connection_close(self):
+        # 流式接收请求体时客户端中途断开，Tornado 不再调用 finish 和 on_finish，在此结束计数
+        super(BaseHandler, self).on_connection_close()
+        self._end_request()
+
+    def _end_request(self):
+        """ 释放过载保护的计数并结束文档库命令统计，在 on_finish 或连接断开时调用，可重复调用 """
+        if self.db_stats:
+            self.db_stats.done = True  # 此后在本请求的上下文中执行的命令(如后台任务)不再计入
+        if self._admitted:
+            admission, self._admitted = self._admitted, None
+            admission.release()
+
     def get_current_user(self):
         if 'Access-Control-Allow-Origin' not in self._headers:
             self.write({'code': 403, 'error': 'Forbidden'})
             return self.finish()
 
-        user = self.get_secure_cookie('user')
-        try:
-            return user and json_util.loads(user) or None
-        except TypeError as err:
-            print(user, str(err))
+        # 已验证过签名的cookie直接取缓存中解码后的用户，避免每个请求都校验签名和解析
+        raw, cache = self.get_cookie('user'), self.application.session_cache
+        user = raw and cache.get(raw)
+        if not user:
+            user = self.get_secure_cookie('user')
+            try:
+                user = user and json_util.loads(user) or None
+            except TypeError as err:
+                print(user, str(err))
+                return None
+            if user:
+                cache.set(raw, user)
+        return user and dict(user)
+
+    def clear_current_user(self):
+        """ 注销登录，清除cookie及其缓存 """
+        user = self.current_user
+        self.clear_cookie('user')
+        if user:
+            self.application.session_cache.invalidate(user.get('_id'))
 
     def render(self, template_name, **kwargs):
         kwargs['currentRoles'] = self.current_user and self.current_user.get('roles') or ''
@@ -113,6 +226,38 @@ class BaseHandler(CorsMixin, RequestHandler):
             body = json_util.loads(to_basestring(self.get_body_argument('data')))
         return body or {}
 
+    def send_cached_response(self, entry):
+        """ 发送 cache_response 缓存的响应，If-None-Match与ETag一致时返回304 """
+        start, collections, etag, body, content_type = entry
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return self.finish()
+        if content_type:
+            self.set_header('Content-Type', content_type)
+        self.finish(body)
+
+    def invalidate_cache(self, *collections):
+        """ 修改数据后使依赖这些集合的缓存响应失效 """
+        if self.application.response_cache is not None:
+            self.application.response_cache.invalidate(*collections)
+
+    def finish(self, chunk=None):
+        # 缓存 cache_response 修饰的正常响应，已分批发送的响应不缓存
+        if self._cache_key and self._status_code == 200 and not self._finished and not self._headers_written:
+            if chunk is not None:
+                self.write(chunk)
+                chunk = None
+            cache, key, collections, ttl, start = self._cache_key
+            etag = self.compute_etag()
+            self.set_header('Etag', etag)
+            entry = start, collections, etag, b''.join(self._write_buffer), self._headers.get('Content-Type')
+            cache.set(key, entry, ttl)
+            if self.check_etag_header():  # 已设置Etag时 RequestHandler.finish 不再检查
+                self._write_buffer = []
+                self.set_status(304)
+        return super(BaseHandler, self).finish(chunk)
+
     def send_data_response(self, data=None, **kwargs):
         """
         发送正常响应内容，并结束处理
@@ -125,9 +270,118 @@ class BaseHandler(CorsMixin, RequestHandler):
 
         response = dict(status='success', data=data, code=200)
         response.update(kwargs)
-        self.write(json_util.dumps(response))
+        self.write(self.application.json_dumps(response))
         self.finish()
 
+    def _page_args(self, condition, sort_key, direction, token, projection):
+        last = None
+        if token:
+            try:
+                last = decode_token(self.application.settings['cookie_secret'], token, sort_key, direction)
+            except ValueError:
+                self.send_error_response(e.invalid_page_token)
+                raise Finish()
+        query, sort = page_query(condition, sort_key, direction, last)
+        hide_id = bool(projection) and not projection.get('_id', 1)
+        if projection:  # 须取出排序字段和_id，以便生成令牌，调用者排除了的_id在生成令牌后去掉
+            fields = {k: v for k, v in projection.items() if k != '_id'}
+            if any(fields.values()) or not fields and projection['_id']:  # 只取部分字段
+                projection = dict(projection, **{sort_key: 1, '_id': 1})
+            else:  # 排除部分字段
+                projection = {k: v for k, v in projection.items() if k not in (sort_key, '_id')} or None
+        return query, sort, projection, hide_id
+
+    def _page_result(self, docs, page_size, sort_key, direction, hide_id=False):
+        more = len(docs) > page_size
+        docs = docs[:page_size]
+        token = more and encode_token(self.application.settings['cookie_secret'], docs[-1], sort_key, direction)
+        if hide_id:
+            for doc in docs:
+                doc.pop('_id', None)
+        return dict(docs=docs, next=token or None)
+
+    def get_page(self, collection, condition=None, sort_key='_id', direction=-1, page_size=20, token=None,
+                 projection=None, with_total=False):
+        """
+        按键值范围分页查询，返回 dict(docs=本页记录, next=下一页的令牌或None)，with_total 时增加 total(集合的估计总数)。
+        集合应有 (sort_key, _id) 的复合索引，翻到第几页耗时都一样
+        :param collection: pymongo集合
+        :param sort_key: 排序字段，值相同时按_id排序
+        :param direction: 1 为升序，-1 为降序
+        :param token: 上一次返回的 next，为空表示第一页。令牌无效时返回 invalid_page_token 错误
+        """
+        query, sort, projection, hide_id = self._page_args(condition, sort_key, direction, token, projection)
+        docs = list(collection.find(query, projection).sort(sort).limit(page_size + 1))
+        result = self._page_result(docs, page_size, sort_key, direction, hide_id)
+        if with_total:
+            result['total'] = collection.estimated_document_count()
+        return result
+
+    async def get_page_async(self, collection, condition=None, sort_key='_id', direction=-1, page_size=20, token=None,
+                             projection=None, with_total=False):
+        """ get_page 的协程版本，collection 为 self.async_db 中的集合 """
+        query, sort, projection, hide_id = self._page_args(condition, sort_key, direction, token, projection)
+        docs = await collection.find(query, projection).sort(sort).limit(page_size + 1).to_list(page_size + 1)
+        result = self._page_result(docs, page_size, sort_key, direction, hide_id)
+        if with_total:
+            result['total'] = await collection.estimated_document_count()
+        return result
+
+    async def send_stream_response(self, cursor, batch_size=100, **kwargs):
+        """
+        逐批发送查询结果，响应格式与 send_data_response 一致，内存占用只与 batch_size 有关
+        :param cursor: pymongo游标，或可 async for 的异步游标(见 async_db)、异步迭代器
+        :param batch_size: 每批从游标取出并发送的文档数
+        :param kwargs: 更多上下文参数
+        :return: None
+        """
+        assert 'data' not in kwargs
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        response = dict(status='success', code=200)
+        response.update(kwargs)
+        dumps = self.application.json_dumps
+        self.write(utf8(dumps(response)).rstrip()[:-1] + b',"data":[')
+
+        count = 0
+        try:
+            async for docs in self._iter_batches(cursor, batch_size):
+                self.write((b',' if count else b'') + b','.join(utf8(dumps(d)) for d in docs))
+                count += len(docs)
+                await self.flush()
+        except Exception as err:
+            if not self._headers_written:  # 尚未发出响应头，可以正常返回错误
+                self.clear()
+                if isinstance(err, MongoError):
+                    return self.send_db_error(err)
+                raise
+            # 已发出部分数据，关闭连接让客户端得到不完整的响应，避免误以为数据已完整
+            logging.error('stream response broken after %d docs: %s' % (count, str(err)))
+            return self.request.connection.close()
+
+        self.write(b']}')
+        self.finish()
+
+    @staticmethod
+    async def _iter_batches(cursor, batch_size):
+        if hasattr(cursor, 'batch_size'):
+            cursor.batch_size(batch_size)
+        if hasattr(cursor, '__aiter__'):
+            docs = []
+            async for doc in cursor:
+                docs.append(doc)
+                if len(docs) >= batch_size:
+                    yield docs
+                    docs = []
+            if docs:
+                yield docs
+        else:  # pymongo游标在线程池中取数据，避免阻塞 IOLoop
+            cursor = iter(cursor)
+            while True:
+                docs = await thread_pool.run(lambda: list(islice(cursor, batch_size)))
+                if not docs:
+                    break
+                yield docs
+
     def send_error_response(self, error=None, **kwargs):
         """
         反馈错误消息，并结束处理
@@ -136,6 +390,7 @@ class BaseHandler(CorsMixin, RequestHandler):
         :return: None
         """
         code, message = list(error.values())[0] if isinstance(error, dict) else error
+        self._cache_key = None  # 错误响应不缓存
         # 如果kwargs中含有message，则覆盖error中对应的message
         message = kwargs['message'] if kwargs.get('message') else message
 
@@ -154,7 +409,7 @@ class BaseHandler(CorsMixin, RequestHandler):
         if not self._finished:
             response.pop('exc_info', None)
             self.set_header('Content-Type', 'application/json; charset=UTF-8')
-            self.write(json_util.dumps(response))
+            self.write(self.application.json_dumps(response))
             self.finish()
 
     def send_error(self, status_code=500, **kwargs):
@@ -209,22 +464,40 @@ class BaseHandler(CorsMixin, RequestHandler):
         ip = self.request.headers.get('x-forwarded-for') or self.request.remote_ip
         return ip and re.sub(r'^::\d$', '', ip[:15]) or '127.0.0.1'
 
-    def add_op_log(self, op_type, target_id=None, message=None, username=None):
+    def _op_log(self, op_type, target_id=None, message=None, username=None):
         username = username or self.current_user and self.current_user.get('name')
         user_id = self.current_user and self.current_user.get('_id')
         logging.info('%s,username=%s,target_id=%s,message=%s' % (op_type, username, target_id, message))
+        return dict(
+            op_type=op_type, username=username, user_id=user_id, target_id=target_id and str(target_id) or None,
+            message=message, ip=self.get_ip(), create_time=datetime.now(),
+        )
+
+    def add_op_log(self, op_type, target_id=None, message=None, username=None):
+        """ 记录操作日志，启用 op_log.buffered 时放入日志缓冲区批量写入 """
+        log = self._op_log(op_type, target_id, message, username)
+        if self.application.op_log:
+            return self.application.op_log.append(log)
+        try:
+            self.db.log.insert_one(log)
+        except MongoError:
+            pass
+
+    async def add_op_log_async(self, op_type, target_id=None, message=None, username=None):
+        log = self._op_log(op_type, target_id, message, username)
+        if self.application.op_log:
+            return self.application.op_log.append(log)
         try:
-            self.db.log.insert_one(dict(
-                op_type=op_type, username=username, user_id=user_id, target_id=target_id and str(target_id) or None,
-                message=message, ip=self.get_ip(), create_time=datetime.now(),
-            ))
+            await self.async_db.log.insert_one(log)
         except MongoError:
             pass
 
     def call_back_api(self, url, handle_response, handle_error=None, **kwargs):
         self._auto_finish = False
-        if not re.match(r'http(s)?://', url):
+        # http_client.loopback 为 true 时，站内API直接在本进程处理，否则经 localhost 调用
+        app = self.application if prop(self.application.config, 'http_client.loopback') else None
+        if not re.match(r'http(s)?://', url) and not (app and 'files' not in kwargs):
             url = '%s://localhost:%d%s' % (self.request.protocol, options['port'], url)
         call_api_async(url, self.request.headers, handle_response,
                        lambda s: handle_error(s) if handle_error else self.render('_error.html', code=500, message=s),
-                       **kwargs)
+                       app=app, **kwargs)
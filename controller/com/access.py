@@ -1,17 +1,78 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import re
+from controller import errors as e
+from controller.router import RouteTrie
+from utils.cache import LRUCache
 
 # url占位符
 url_placeholder = {
     'num': '[0-9]+',
 }
 
+# 各角色可访问的路由：{角色: {url: 请求方法列表}}，url可含url_placeholder中的占位符，如 /api/page/@num
+# 在 app.yml 中设置 access.enabled 为 true 后生效
+role_routes = {
+    '访客': {
+        '/': ['GET'],
+        '/home': ['GET'],
+        '/api': ['GET'],
+        '/api/metrics': ['GET'],
+        '/api/user/login': ['GET'],
+    },
+    '普通用户': {
+    },
+}
+
+
+class AccessEngine(object):
+    """ 启动时将各角色的可访问路由编译为前缀树，并缓存 (角色, 方法, 路径) 的判断结果 """
+
+    def __init__(self, routes=None, placeholders=None, cache_size=10000):
+        placeholders = placeholders or url_placeholder
+        self.tries = {}
+        self.patterns = {}  # 不能放入前缀树的url，按正则匹配
+        for role, urls in (role_routes if routes is None else routes).items():
+            trie = self.tries[role] = RouteTrie(placeholders)
+            for url, methods in urls.items():
+                methods = frozenset(m.upper() for m in methods)
+                if not trie.add(url, methods):
+                    for k, v in placeholders.items():
+                        url = url.replace('@' + k, '(%s)' % v)
+                    self.patterns.setdefault(role, []).append((re.compile(url + '$'), methods))
+        self.cache = LRUCache(cache_size)
+
+    def _role_can_access(self, role, method, path):
+        trie = self.tries.get(role)
+        # 多个路由都匹配时(如 /api/page/@num 和 /api/page/1)，任一路由允许该方法即可访问
+        if trie and any(method in methods for order, methods, args in trie.match_all(path)):
+            return True
+        return any(method in methods and regex.match(path) for regex, methods in self.patterns.get(role, []))
+
+    def can_access(self, roles, method, path):
+        """
+        :param roles: 逗号分隔的角色
+        :param method: 请求方法，如 GET
+        :param path: 请求路径，不含查询参数
+        """
+        key = roles, method, path
+        ok = self.cache.get(key)
+        if ok is None:
+            ok = any(self._role_can_access(role.strip(), method, path) for role in roles.split(','))
+            self.cache.set(key, ok)
+        return ok
+
+
+def get_roles(handler):
+    return '访客' if not handler.current_user else (handler.current_user.get('roles') or '普通用户') + ',访客'
+
 
 def prepare_access(handler, req_path, method):
-    pass
+    if not can_access(handler, req_path, method):
+        return handler.send_error_response(e.unauthorized if handler.current_user else e.need_login)
 
 
 def can_access(handler, req_path, method):
-    role = '访客' if not handler.current_user else (handler.current_user.get('roles') or '普通用户') + ',访客'
-    return True
+    engine = handler.application.access
+    return not engine or engine.can_access(get_roles(handler), method.upper(), req_path.partition('?')[0])
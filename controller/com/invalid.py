@@ -60,3 +60,12 @@ class ApiTable(BaseHandler):
                 add_handler(url_, i + 1)
         else:
             add_handler(cls.URL)
+
+
+class ApiMetrics(BaseHandler):
+    URL = '/api/metrics'
+
+    def get(self):
+        """ 显示各接口的响应时间分布等运行指标 """
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=UTF-8')
+        self.finish(self.application.metrics.render())
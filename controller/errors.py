@@ -6,6 +6,8 @@
 """
 
 need_login = 403, '尚未登录'
+too_many_requests = 429, '请求过于频繁，请稍后再试'
+server_busy = 503, '服务繁忙，请稍后再试'
 db_error = 10000, '服务访问出错'
 mongo_error = 20000, '文档库访问出错'
 
@@ -31,3 +33,7 @@ no_object = 2000, '对象不存在'
 no_user = 2001, '用户不存在'
 unauthorized = 2002, '没有权限'
 url_not_config = 2003, '路径没有配置'
+upload_too_large = 2004, '上传内容不能超过%s'
+invalid_upload = 2005, '上传内容格式有误'
+upload_failed = 2006, '上传文件保存失败'
+invalid_page_token = 2007, '分页参数有误，请从第一页重新查询'
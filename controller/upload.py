@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 流式接收上传文件的API基类，边接收边解析multipart请求体，文件内容逐块写入磁盘或GridFS，内存占用与文件大小无关
+@time: 2026/10/18
+"""
+
+import os
+import uuid
+import logging
+import gridfs
+import hashlib
+from os import path
+from tornado.escape import utf8, to_unicode
+from tornado.httputil import HTTPHeaders, _parse_header
+from tornado.ioloop import IOLoop
+from tornado.web import stream_request_body
+from controller import errors as e
+from controller.base import BaseHandler, DbError
+from utils.helper import BASE_DIR
+from utils.executor import thread_pool
+
+
+class MultipartParser(object):
+    """
+    增量解析multipart请求体，feed 返回本次解析出的事件列表：
+    ('begin', 该部分的头部)、('data', 内容片段)、('end', None)。缓存的未解析数据不超过分隔符或头部的长度。
+    """
+    MAX_HEADER_SIZE = 16 * 1024
+
+    def __init__(self, boundary):
+        self.delimiter = b'\r\n--' + boundary
+        self.buffer = b'\r\n'  # 首个分隔符前没有换行，补上后各分隔符统一按 \r\n--boundary 查找
+        self.state = 'preamble'
+        self.finished = False
+
+    def feed(self, data):
+        buffer, events, more = self.buffer + data, [], True
+        while more and not self.finished:
+            if self.state in ('preamble', 'body'):
+                buffer, more = self._read_body(buffer, events)
+            elif self.state == 'delimiter':
+                buffer, more = self._read_delimiter(buffer)
+            else:
+                buffer, more = self._read_headers(buffer, events)
+        self.buffer = buffer
+        return events
+
+    def _read_body(self, buffer, events):
+        i = buffer.find(self.delimiter)
+        if i < 0:  # 末尾可能是不完整的分隔符，留到下次
+            keep = len(self.delimiter) - 1
+            if self.state == 'body' and len(buffer) > keep:
+                events.append(('data', buffer[:-keep]))
+            return buffer[-keep:], False
+        if self.state == 'body':
+            if i:
+                events.append(('data', buffer[:i]))
+            events.append(('end', None))
+        self.state = 'delimiter'
+        return buffer[i + len(self.delimiter):], True
+
+    def _read_delimiter(self, buffer):
+        if len(buffer) < 2:
+            return buffer, False
+        if buffer[:2] == b'--':
+            self.finished = True
+            return b'', False
+        if buffer[:2] != b'\r\n':
+            raise ValueError('invalid multipart delimiter')
+        self.state = 'headers'
+        return buffer, True
+
+    def _read_headers(self, buffer, events):
+        i = buffer.find(b'\r\n\r\n')  # buffer 以分隔符行末的 \r\n 开头
+        if i < 0:
+            if len(buffer) > self.MAX_HEADER_SIZE:
+                raise ValueError('multipart headers too large')
+            return buffer, False
+        events.append(('begin', HTTPHeaders.parse(to_unicode(buffer[2:i]))))
+        self.state = 'body'
+        return buffer[i + 4:], True
+
+
+class DiskWriter(object):
+    """ 将上传文件写入 directory 目录下的新文件 """
+
+    def __init__(self, directory, filename, content_type):
+        os.makedirs(directory, exist_ok=True)
+        ext = path.splitext(filename)[1]
+        self.path = path.join(directory, uuid.uuid4().hex + ext)
+        self.file = open(self.path, 'wb')
+
+    @property
+    def info(self):
+        return dict(path=self.path)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self, sha256):
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        self.remove()
+
+    def remove(self):
+        if path.exists(self.path):
+            os.remove(self.path)
+
+
+class GridFSWriter(object):
+    """ 将上传文件写入GridFS，sha256 记录在文件信息中 """
+
+    def __init__(self, fs, filename, content_type):
+        self.fs = fs
+        self.file = fs.new_file(filename=filename, content_type=content_type)
+
+    @property
+    def info(self):
+        return dict(file_id=self.file._id)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self, sha256):
+        self.file.sha256 = sha256
+        self.file.close()
+
+    def abort(self):
+        self.file.abort()
+
+    def remove(self):
+        self.fs.delete(self.file._id)
+
+
+@stream_request_body
+class StreamingUploadHandler(BaseHandler):
+    """
+    流式上传的基类，子类实现 on_uploaded(files) 处理已保存的文件，可为协程。
+    files 为各文件的信息字典：name(字段名)、filename、content_type、size、sha256，
+    以及 path(保存到磁盘时的文件路径) 或 file_id(保存到GridFS时的文件ID)。
+    普通字段可用 get_body_argument、get_request_data 获取。上传出错、客户端断开或 on_uploaded 出错时删除已保存的文件。
+    """
+    MAX_SIZE = None  # 请求体的最大字节数，默认为 app.yml 中的 upload.max_size
+    MAX_FIELD_SIZE = 64 * 1024  # 普通字段的最大字节数
+    STORAGE = None  # disk 或 gridfs，默认为 app.yml 中的 upload.storage
+
+    def prepare(self):
+        self.files, self.received, self._writers = [], 0, []
+        self._parser = self._part = None
+        self._busy = self._aborted = self._done = False
+        super(StreamingUploadHandler, self).prepare()
+        if self._finished:
+            return
+
+        cfg = self.config.get('upload') or {}
+        self.max_size = self.MAX_SIZE or cfg.get('max_size', 1 << 30)
+        self.storage = self.STORAGE or cfg.get('storage', 'disk')
+        content_type, params = _parse_header(self.request.headers.get('Content-Type', ''))
+        if content_type != 'multipart/form-data' or not params.get('boundary'):
+            return self.send_error_response(e.invalid_upload)
+        # 按Content-Length提前拒绝超限的上传，未指定Content-Length时在接收中检查
+        if int(self.request.headers.get('Content-Length') or 0) > self.max_size:
+            return self.send_error_response(self._too_large())
+        self.request.connection.set_max_body_size(self.max_size)
+        self._parser = MultipartParser(utf8(params['boundary']))
+
+    def _too_large(self):
+        return e.upload_too_large[0], e.upload_too_large[1] % ('%.1fMB' % (self.max_size / 1048576.0))
+
+    @staticmethod
+    def _run(func, *args):
+        return thread_pool.run(func, *args)
+
+    def _create_writer(self, filename, content_type):
+        if self.storage == 'gridfs':
+            collection = (self.config.get('upload') or {}).get('gridfs_collection', 'fs')
+            return GridFSWriter(gridfs.GridFS(self.db, collection), filename, content_type)
+        directory = (self.config.get('upload') or {}).get('path', 'upload')
+        return DiskWriter(path.join(BASE_DIR, directory), filename, content_type)
+
+    async def data_received(self, chunk):
+        if self._finished or self._aborted or not self._parser:
+            return
+        self.received += len(chunk)
+        if self.received > self.max_size:
+            return await self._abort(self._too_large())
+
+        self._busy = True
+        try:
+            for event, value in self._parser.feed(chunk):
+                if event == 'begin':
+                    await self._begin_part(value)
+                elif event == 'data':
+                    await self._write_part(value)
+                else:
+                    await self._end_part()
+                if self._aborted:  # 客户端已断开
+                    return await self._discard()
+        except ValueError:
+            await self._abort(e.invalid_upload)
+        except (OSError, DbError) as err:
+            await self._abort(e.upload_failed, message='%s: %s' % (e.upload_failed[1], str(err)))
+        finally:
+            self._busy = False
+
+    async def _begin_part(self, headers):
+        params = _parse_header(headers.get('Content-Disposition', ''))[1]
+        self._part = part = dict(name=params.get('name'), size=0)
+        if 'filename' not in params:  # 普通字段
+            part['value'] = b''
+            return
+        part.update(filename=params['filename'], hash=hashlib.sha256(),
+                    content_type=headers.get('Content-Type', 'application/octet-stream'))
+        part['writer'] = await self._run(self._create_writer, part['filename'], part['content_type'])
+
+    async def _write_part(self, data):
+        part = self._part
+        part['size'] += len(data)
+        if 'writer' in part:
+            part['hash'].update(data)
+            await self._run(part['writer'].write, data)
+        elif part['size'] > self.MAX_FIELD_SIZE:
+            raise ValueError('field %s too large' % part['name'])
+        else:
+            part['value'] += data
+
+    async def _end_part(self):
+        part, self._part = self._part, None
+        if 'writer' not in part:
+            self.request.body_arguments.setdefault(part['name'], []).append(part['value'])
+            self.request.arguments.setdefault(part['name'], []).append(part['value'])
+            return
+        sha256 = part['hash'].hexdigest()
+        await self._run(part['writer'].close, sha256)
+        info = dict(name=part['name'], filename=part['filename'], content_type=part['content_type'],
+                    size=part['size'], sha256=sha256)
+        info.update(part['writer'].info)
+        self.files.append(info)
+        self._writers.append(part['writer'])
+
+    def _discard_sync(self):
+        """ 删除正在写入和已保存的文件 """
+        part, self._part = self._part, None
+        if part and 'writer' in part:
+            part['writer'].abort()
+        for writer in self._writers:
+            writer.remove()
+        self._writers = []
+
+    async def _discard(self):
+        try:
+            await self._run(self._discard_sync)
+        except (OSError, DbError) as err:
+            logging.error('fail to remove uploaded files: %s' % str(err))
+
+    async def _abort(self, error, **kwargs):
+        self._aborted = True
+        await self._discard()
+        self.send_error_response(error, **kwargs)
+
+    def on_connection_close(self):
+        super(StreamingUploadHandler, self).on_connection_close()
+        self._aborted = True
+        if not self._busy:  # 正在写入时由 data_received 在写入完成后删除
+            IOLoop.current().spawn_callback(self._discard)
+
+    def on_finish(self):
+        super(StreamingUploadHandler, self).on_finish()
+        if self._parser and not self._done and not self._aborted:
+            IOLoop.current().spawn_callback(self._discard)
+
+    async def post(self):
+        if self._finished:
+            return
+        if not self._parser.finished:
+            return await self._abort(e.invalid_upload)
+        self.request.body = b''
+        self._done = True
+        try:
+            result = self.on_uploaded(self.files)
+            if result is not None:
+                await result
+        except Exception:
+            self._done = False
+            raise
+
+    def on_uploaded(self, files):
+        raise NotImplementedError()
@@ -6,41 +6,126 @@
 """
 
 import re
+import inspect
+from collections import namedtuple
+from tornado import gen
 from bson.objectid import ObjectId
 from tornado.web import Finish
 import controller.errors as e
+from utils.executor import thread_pool
+from utils.async_db import AsyncCollection
+
+try:
+    from motor.motor_tornado import MotorCollection
+    ASYNC_COLLECTIONS = (AsyncCollection, MotorCollection)
+except ImportError:
+    ASYNC_COLLECTIONS = (AsyncCollection,)
+
+NAME_RE = re.compile(r'^[\u4E00-\u9FA5]{2,5}$|^[A-Za-z][A-Za-z -]{2,19}$')
+PHONE_RE = re.compile(r'^1[34578]\d{9}$')
+EMAIL_RE = re.compile(r'^[a-z0-9][a-z0-9_.-]+@[a-z0-9_-]+(\.[a-z]+){1,2}$')
+PASSWORD_RE = re.compile(r'^(?![0-9]+$)(?![a-zA-Z]+$)[A-Za-z0-9,.;:!@#$%^&*-_]{6,18}$')
+DIGIT_RE = re.compile(r'^\d+$')
+
+
+class Validator(object):
+    """
+    预先编译的校验规则，在模块中创建一次后可重复使用，例如：
+    user_rules = Validator([(not_empty, 'name'), (is_phone, 'phone')])
+    user_rules.validate(data, handler)
+    """
+
+    def __init__(self, rules):
+        """
+        :param rules: 校验规则列表，格式见 validate 函数
+        """
+        self.rules = rules
+        self.checks = []  # 每个rule预先拆分为 (序号, func, 非字符串参数, data的属性名)
+        self.db_checks = []  # 文档库校验规则，校验时合并为每个集合一次查询
+        for i, rule in enumerate(rules):
+            args, keys = [], []
+            for para in rule[1:]:
+                (keys if isinstance(para, str) else args).append(para)
+            if rule[0] in DB_RULES:
+                self.db_checks.append((i, DB_RULES[rule[0]], args, keys))
+            else:
+                self.checks.append((i, rule[0], args, keys))
+
+    def _collect_db_checks(self, get):
+        db_checks = []
+        for i, func, args, keys in self.db_checks:
+            collection, checks = func(*args, **{k: get(k) for k in keys})
+            db_checks.append((collection, [c._replace(rule=i) for c in checks]))
+        return db_checks
+
+    def validate(self, data, handler=None):
+        results = {}  # 规则序号: 该规则的校验错误
+        get = data.get
+        for i, func, args, keys in self.checks:
+            ret = func(*args, **{k: get(k) for k in keys})
+            if ret:
+                results[i] = ret
+        if self.db_checks:
+            for c in _db_failures(self._collect_db_checks(get)):
+                results.setdefault(c.rule, {})[c.key] = c.error
+        return self._done(results, handler)
+
+    async def validate_async(self, data, handler=None):
+        results = {}
+        get = data.get
+        for i, func, args, keys in self.checks:
+            ret = func(*args, **{k: get(k) for k in keys})
+            if inspect.isawaitable(ret):
+                ret = await ret
+            if ret:
+                results[i] = ret
+        if self.db_checks:
+            for c in await _db_failures_async(self._collect_db_checks(get)):
+                results.setdefault(c.rule, {})[c.key] = c.error
+        return self._done(results, handler)
+
+    @staticmethod
+    def _done(results, handler):
+        # 按规则的顺序合并，与逐条校验时错误的顺序及同一属性的取值一致
+        errs = {}
+        for i in sorted(results):
+            errs.update(results[i])
+        if errs and handler:
+            handler.send_error_response(errs)
+            raise Finish()
+        return errs or None
 
 
 def validate(data, rules, handler=None):
     """
     数据校验主控函数
     :param data:  待校验的数据，一般是指从页面POST的dict类型的数据
-    :param rules: 校验规则列表，每个rule是一个(func, para1, para2, ...)元组，其中，func是校验工具函数。关于para1、para2等参数：
+    :param rules: 校验规则列表或 Validator 对象，每个rule是一个(func, para1, para2, ...)元组，其中，func是校验工具函数。
+                  关于para1、para2等参数：
                   1. 如果是字符串格式，则表示data的属性，将data[para1]数据作为参数传递给func函数
                   2. 如果不是字符串格式，则直接作为参数传递给func函数
     :param handler: Web请求响应对象，指定则发送错误消息并抛出异常结束
     :return: 如果校验有误，则返回校验错误，格式为{key: (error_code, message)}，其中，key为data的属性。无误，则无返回值。
     """
-    errs = {}
-    for rule in rules:
-        func = rule[0]
-        kw = {para: data.get(para) for para in rule[1:] if isinstance(para, str)}
-        args = [para for para in rule[1:] if not isinstance(para, str)]
-        ret = func(*args, **kw)
-        if ret:
-            errs.update(ret)
-    if errs and handler:
-        handler.send_error_response(errs)
-        raise Finish()
-    return errs or None
+    return (rules if isinstance(rules, Validator) else Validator(rules)).validate(data, handler)
+
+
+async def validate_async(data, rules, handler=None):
+    """
+    数据校验主控函数的协程版本，参数同 validate。not_existed 等文档库校验按集合合并查询，
+    collection 参数可为 handler.async_db 中的集合，或在线程池中查询的pymongo集合，不阻塞 IOLoop
+    """
+    return await (rules if isinstance(rules, Validator) else Validator(rules)).validate_async(data, handler)
+
+
+I18N = {
+    'title': '名称',
+    'name': '姓名',
+}
 
 
 def i18n_trans(key):
-    maps = {
-        'title': '名称',
-        'name': '姓名',
-    }
-    return maps[key] if key in maps else key
+    return I18N.get(key, key)
 
 
 def not_empty(**kw):
@@ -55,9 +140,9 @@ def not_both_empty(**kw):
     assert len(kw) == 2
     k1, k2 = kw.keys()
     v1, v2 = kw.values()
-    code, message = e.not_allowed_both_empty
-    err = code, message % (i18n_trans(k1), i18n_trans(k2))
     if not v1 and not v2:
+        code, message = e.not_allowed_both_empty
+        err = code, message % (i18n_trans(k1), i18n_trans(k2))
         return {k1: err, k2: err}
 
 
@@ -65,9 +150,9 @@ def not_equal(**kw):
     assert len(kw) == 2
     k1, k2 = kw.keys()
     v1, v2 = kw.values()
-    code, message = e.both_times_equal
-    err = code, message % (i18n_trans(k1), i18n_trans(k2))
     if v1 == v2:
+        code, message = e.both_times_equal
+        err = code, message % (i18n_trans(k1), i18n_trans(k2))
         return {k1: err, k2: err}
 
 
@@ -75,97 +160,89 @@ def equal(**kw):
     assert len(kw) == 2
     k1, k2 = kw.keys()
     v1, v2 = kw.values()
-    code, message = e.not_equal
-    err = code, message % (i18n_trans(k1), i18n_trans(k2))
     if v1 != v2:
+        code, message = e.not_equal
+        err = code, message % (i18n_trans(k1), i18n_trans(k2))
         return {k1: err, k2: err}
 
 
 def is_name(**kw):
     """ 检查是否为姓名。"""
     assert len(kw) == 1
-    k, v = list(kw.items())[0]
-    regex = r'^[\u4E00-\u9FA5]{2,5}$|^[A-Za-z][A-Za-z -]{2,19}$'
+    k, v = next(iter(kw.items()))
     # 值为空或空串时跳过而不检查
-    if v and not re.match(regex, v):
+    if v and not NAME_RE.match(v):
         return {k: e.invalid_name}
 
 
 def is_phone(**kw):
     """ 检查是否为手机。"""
     assert len(kw) == 1
-    k, v = list(kw.items())[0]
-    regex = r'^1[34578]\d{9}$'
+    k, v = next(iter(kw.items()))
     # 值为空或空串时跳过而不检查
-    if v and not re.match(regex, str(v)):
+    if v and not PHONE_RE.match(str(v)):
         return {k: e.invalid_phone}
 
 
 def is_email(**kw):
     """ 检查是否为邮箱。"""
     assert len(kw) == 1
-    k, v = list(kw.items())[0]
-    regex = r'^[a-z0-9][a-z0-9_.-]+@[a-z0-9_-]+(\.[a-z]+){1,2}$'
+    k, v = next(iter(kw.items()))
     # 值为空或空串时跳过而不检查
-    if v and not re.match(regex, v):
+    if v and not EMAIL_RE.match(v):
         return {k: e.invalid_email}
 
 
 def is_phone_or_email(**kw):
     """ 检查是否为手机或邮箱。"""
     assert len(kw) == 1
-    k, v = list(kw.items())[0]
-    email_regex = r'^[a-z0-9][a-z0-9_.-]+@[a-z0-9_-]+(\.[a-z]+){1,2}$'
-    phone_regex = r'^1[34578]\d{9}$'
+    k, v = next(iter(kw.items()))
     # 值为空或空串时跳过而不检查
-    if v and not re.match(email_regex, v) and not re.match(phone_regex, v):
+    if v and not EMAIL_RE.match(v) and not PHONE_RE.match(v):
         return {k: e.invalid_phone_or_email}
 
 
 def is_password(**kw):
     """ 检查是否为密码。"""
     assert len(kw) == 1
-    k, v = list(kw.items())[0]
-    regex = r'^(?![0-9]+$)(?![a-zA-Z]+$)[A-Za-z0-9,.;:!@#$%^&*-_]{6,18}$'
+    k, v = next(iter(kw.items()))
     # 值为空或空串时跳过而不检查
-    if v and not re.match(regex, str(v)):
+    if v and not PASSWORD_RE.match(str(v)):
         return {k: e.invalid_password}
 
 
 def is_digit(**kw):
     """ 检查是否为数字。"""
     code, message = e.invalid_digit
-    errs = {k: (code, '%s:%s' % (k, message)) for k, v in kw.items() if v and not re.match(r'^\d+$', str(v))}
+    errs = {k: (code, '%s:%s' % (k, message)) for k, v in kw.items() if v and not DIGIT_RE.match(str(v))}
     return errs or None
 
 
 def between(min_v, max_v, **kw):
     assert len(kw) == 1
-    k, v = list(kw.items())[0]
-    if isinstance(v, str) and re.match(r'^\d+$', v):
+    k, v = next(iter(kw.items()))
+    if isinstance(v, str) and DIGIT_RE.match(v):
         v = int(v)
-    code, message = e.invalid_range
-    err = code, message % (i18n_trans(k), min_v, max_v)
     if isinstance(v, int) and (v < min_v or v > max_v):
-        return {k: err}
+        code, message = e.invalid_range
+        return {k: (code, message % (i18n_trans(k), min_v, max_v))}
 
 
 def in_list(lst, **kw):
     """检查是否在lst列表中"""
-    k, v = list(kw.items())[0]
+    k, v = next(iter(kw.items()))
     if v:
-        code, message = e.should_in_list
-        err = code, message % (i18n_trans(k), lst)
         assert type(v) in [str, list]
         v = [v] if isinstance(v, str) else v
         not_in = [i for i in v if i not in lst]
         if not_in:
-            return {k: err}
+            code, message = e.should_in_list
+            return {k: (code, message % (i18n_trans(k), lst))}
 
 
 def has_fields(fields, **kw):
     """检查是否有fields中的字段"""
-    k, v = list(kw.items())[0]
+    k, v = next(iter(kw.items()))
     if v:
         need_fields = [r for r in fields if r not in v.keys()]
         if need_fields:
@@ -173,22 +250,113 @@ def has_fields(fields, **kw):
             return {k: err}
 
 
+# 文档库校验项：key为data的属性，condition为查询条件，fail(count)根据匹配的记录数(最多数到2)判断是否有误，
+# rule为该校验项在 Validator 规则列表中的序号
+DbCheck = namedtuple('DbCheck', 'key condition fail error rule')
+DbCheck.__new__.__defaults__ = (0,)
+
+
+def _not_existed(collection=None, exclude_id=None, **kw):
+    code, message = e.record_existed
+    checks = []
+    for k, v in kw.items():
+        if v:
+            condition = {k: v}
+            if exclude_id:
+                condition['_id'] = {'$ne': exclude_id}
+            checks.append(DbCheck(k, condition, lambda n: n > 0, (code, message % i18n_trans(k))))
+    return collection, checks
+
+
+def _exist(collection=None, **kw):
+    code, message = e.record_existed
+    checks = [DbCheck(k, {k: ObjectId(v) if k == '_id' else v}, lambda n: n == 0, (code, message % i18n_trans(k)))
+              for k, v in kw.items() if v]
+    return collection, checks
+
+
+def _is_unique(collection=None, **kw):
+    code, message = e.record_existed
+    checks = [DbCheck(k, {k: v}, lambda n: n > 1, (code, message % i18n_trans(k)))
+              for k, v in kw.items() if v is not None]
+    return collection, checks
+
+
+def _group_checks(db_checks):
+    """ 将 [(collection, checks)] 按集合合并，同一集合的校验项用一次聚合查询 """
+    groups = {}
+    for collection, checks in db_checks:
+        if collection and checks:
+            key = getattr(collection, 'full_name', None) or id(collection)
+            groups.setdefault(key, (collection, []))[1].extend(checks)
+    return list(groups.values())
+
+
+def _pipeline(checks):
+    """ 先用 $or 取出可能匹配的记录，再在 $facet 中分别统计每个校验项匹配的记录数 """
+    return [
+        {'$match': {'$or': [c.condition for c in checks]} if len(checks) > 1 else checks[0].condition},
+        {'$facet': {'c%d' % i: [{'$match': c.condition}, {'$limit': 2}, {'$count': 'n'}]
+                    for i, c in enumerate(checks)}},
+    ]
+
+
+def _failed_checks(checks, result):
+    failed = []
+    for i, c in enumerate(checks):
+        counts = result.get('c%d' % i)
+        if c.fail(counts[0]['n'] if counts else 0):
+            failed.append(c)
+    return failed
+
+
+def _db_errors(failed):
+    """ 按校验项的规则序号合并为校验错误，同一规则内保持校验项的顺序 """
+    return {c.key: c.error for c in sorted(failed, key=lambda c: c.rule)} or None
+
+
+def _db_failures(db_checks):
+    failed = []
+    for collection, checks in _group_checks(db_checks):
+        if isinstance(collection, ASYNC_COLLECTIONS):  # 异步集合取其pymongo集合
+            collection = collection.delegate
+        result = next(collection.aggregate(_pipeline(checks)), {})
+        failed.extend(_failed_checks(checks, result))
+    return failed
+
+
+def check_db(db_checks):
+    """ 执行文档库校验，每个集合只查询一次，返回校验错误 """
+    return _db_errors(_db_failures(db_checks))
+
+
+async def _db_failures_async(db_checks):
+    async def check(collection, checks):
+        pipeline = _pipeline(checks)
+        if isinstance(collection, ASYNC_COLLECTIONS):  # pymongo集合的任意属性都是子集合，不能用 hasattr 判断
+            result = await collection.aggregate(pipeline).to_list(1)
+        else:
+            result = await thread_pool.run(lambda: list(collection.aggregate(pipeline)))
+        return _failed_checks(checks, result and result[0] or {})
+
+    failed = []
+    for ret in await gen.multi([check(c, checks) for c, checks in _group_checks(db_checks)]):
+        failed.extend(ret)
+    return failed
+
+
+async def check_db_async(db_checks):
+    """ check_db 的协程版本，各集合的查询并发执行，pymongo集合在线程池中查询 """
+    return _db_errors(await _db_failures_async(db_checks))
+
+
 def not_existed(collection=None, exclude_id=None, **kw):
     """
     校验数据库中是否不存在kw中对应的记录，存在则报错
     :param collection: mongdb的collection
     :param exclude_id: 校验时，排除某个id对应的记录
     """
-    errs = {}
-    code, message = e.record_existed
-    if collection:
-        for k, v in kw.items():
-            condition = {k: v}
-            if exclude_id:
-                condition['_id'] = {'$ne': exclude_id}
-            if v and collection.find_one(condition):
-                errs[k] = code, message % i18n_trans(k)
-    return errs or None
+    return check_db([_not_existed(collection, exclude_id, **kw)])
 
 
 def exist(collection=None, **kw):
@@ -196,22 +364,31 @@ def exist(collection=None, **kw):
     校验数据库中是否存在kw中对应的记录，不存在则报错
     :param collection: mongdb的collection
     """
-    errs = {}
-    code, message = e.record_existed
-    if collection:
-        for k, v in kw.items():
-            condition = {k: ObjectId(v) if k == '_id' else v}
-            if v and not collection.find_one(condition):
-                errs[k] = code, message % i18n_trans(k)
-    return errs or None
+    return check_db([_exist(collection, **kw)])
 
 
 def is_unique(collection=None, **kw):
     """校验数据库中是否唯一"""
-    errs = {}
-    code, message = e.record_existed
-    if collection:
-        for k, v in kw.items():
-            if v is not None and collection.count_documents({k: v}) > 1:
-                errs[k] = code, message % i18n_trans(k)
-    return errs or None
+    return check_db([_is_unique(collection, **kw)])
+
+
+async def not_existed_async(collection=None, exclude_id=None, **kw):
+    """ not_existed 的协程版本，collection 为异步集合 """
+    return await check_db_async([_not_existed(collection, exclude_id, **kw)])
+
+
+async def exist_async(collection=None, **kw):
+    """ exist 的协程版本，collection 为异步集合 """
+    return await check_db_async([_exist(collection, **kw)])
+
+
+async def is_unique_async(collection=None, **kw):
+    """ is_unique 的协程版本，collection 为异步集合 """
+    return await check_db_async([_is_unique(collection, **kw)])
+
+
+# 文档库校验函数及其校验项的生成函数，validate 时合并为每个集合一次查询
+DB_RULES = {
+    not_existed: _not_existed, exist: _exist, is_unique: _is_unique,
+    not_existed_async: _not_existed, exist_async: _exist, is_unique_async: _is_unique,
+}
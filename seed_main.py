@@ -6,35 +6,81 @@
 """
 
 import os
+import sys
 import socket
+import signal
 import logging
+from functools import partial
+from tornado import gen
 from tornado.httpserver import HTTPServer
 from tornado import ioloop, netutil, process
 from tornado.options import define, options as opt
 
 import controller as c
 from controller.app import Application
+from utils.supervisor import Supervisor, notify_ready, set_cpu_affinity, worker_args
 
 define('num_processes', default=4, help='sub-processes count', type=int)
+define('supervisor', default=False, help='run workers with SO_REUSEPORT, reload them on SIGHUP', type=bool)
+define('cpu_affinity', default=False, help='pin each worker to a CPU in the supervisor mode', type=bool)
+define('stop_timeout', default=30, help='seconds to wait for active requests when a worker stops', type=int)
+define('check_indexes', default=False, help='exit with 1 if any registered query pattern has no index', type=bool)
+define('worker_id', default=-1, help='worker index, set by the supervisor', type=int)
+define('ready_fd', default=-1, help='pipe to notify the supervisor, set by the supervisor', type=int)
+
+
+@gen.coroutine
+def stop_worker(server, app):
+    """ 停止接受新连接，等正在处理的请求结束(最多 stop_timeout 秒)、执行关闭回调后退出 """
+    yield app.shutdown(server, opt.stop_timeout)
+    ioloop.IOLoop.current().stop()
+
 
 if __name__ == '__main__':
     os.chdir(os.path.dirname(os.path.realpath(__file__)))
     opt.parse_command_line()
+    if opt.supervisor and not opt.debug and os.name != 'nt':
+        os.makedirs('log', exist_ok=True)
+        with open('log/seed_main.pid', 'w') as f:
+            f.write(str(os.getpid()))
+        logging.info('Start the supervisor with %d workers on port %d' % (opt.num_processes, opt.port))
+        sys.exit(Supervisor(worker_args(os.path.realpath(__file__)), opt.num_processes,
+                            stop_timeout=opt.stop_timeout + 5).run())
+
     routes = c.handlers + c.views
     app = Application(routes, default_handler_class=c.InvalidPageHandler, ui_modules=c.modules, xsrf_cookies=True)
+    if opt.check_indexes:
+        missing = app.check_indexes()
+        for collection, query in missing:
+            logging.error('no index for %s: %s sort by %s' % (collection, sorted(query.fields), query.sort))
+        sys.exit(1 if missing else 0)
+    server = None
     try:
         ssl_options = not opt.debug and app.site.get('https') or None
         server = HTTPServer(app, xheaders=True, ssl_options=ssl_options)
-        sockets = netutil.bind_sockets(opt.port, family=socket.AF_INET)
-        fork_id = 0 if opt.debug or os.name == 'nt' else process.fork_processes(opt.num_processes)
+        if opt.worker_id >= 0:  # 由 supervisor 启动的工作进程，各自用 SO_REUSEPORT 绑定端口
+            fork_id = opt.worker_id
+            if opt.cpu_affinity:
+                set_cpu_affinity(fork_id)
+            sockets = netutil.bind_sockets(opt.port, family=socket.AF_INET, reuse_port=True)
+        else:
+            sockets = netutil.bind_sockets(opt.port, family=socket.AF_INET)
+            fork_id = 0 if opt.debug or os.name == 'nt' else process.fork_processes(opt.num_processes)
         server.add_sockets(sockets)
+        app.metrics.start()
+        app.watch_config()
+        ioloop.IOLoop.current().spawn_callback(app.prewarm_db)
         protocol = 'https' if ssl_options else 'http'
         logging.info('Start the service #%d v%s on %s://localhost:%d' % (fork_id, app.version, protocol, opt.port))
         if fork_id == 0:
             script = app.db and 'sh start_worker.sh {0} {1}'.format(app.db_uri, app.config['database']['name'])
             # os.system(script)
+            ioloop.IOLoop.current().spawn_callback(app.ensure_indexes)
+        signal.signal(signal.SIGTERM, lambda *args: ioloop.IOLoop.current().add_callback_from_signal(
+            stop_worker, server, app))
+        notify_ready(opt.ready_fd)
         ioloop.IOLoop.current().start()
 
     except KeyboardInterrupt:
-        app.stop()
+        ioloop.IOLoop.current().run_sync(partial(app.shutdown, server, opt.stop_timeout))
         logging.info('Stop the service')
@@ -1,5 +1,21 @@
 #!/bin/sh
-kill -9 `ps -ef | grep 8001 | grep seed_main.py | awk -F" " {'print $2'}` 2>/dev/null
 cd `dirname $0`
 test -d log || mkdir log
-nohup python3 seed_main.py --port=8001 --debug=false >> log/app.log 2>&1 &
+if test -f log/seed_main.pid && kill -0 `cat log/seed_main.pid` 2>/dev/null; then
+  # 服务已在运行：滚动重启工作进程，新进程就绪后旧进程处理完已有请求再退出
+  kill -HUP `cat log/seed_main.pid`
+else
+  pids=`ps -ef | grep 8001 | grep seed_main.py | grep -v grep | awk -F" " {'print $2'}`
+  if test -n "$pids"; then
+    # 旧进程处理完已有请求再退出，最多等 stop_timeout(与 seed_main.py 的 --stop_timeout 一致)加5秒，超时则强制结束
+    kill $pids 2>/dev/null
+    waited=0
+    while test -n "$pids" && test $waited -lt ${STOP_TIMEOUT:-35}; do
+      sleep 1
+      waited=`expr $waited + 1`
+      pids=`for pid in $pids; do kill -0 $pid 2>/dev/null && echo $pid; done`
+    done
+    test -n "$pids" && kill -9 $pids 2>/dev/null
+  fi
+  nohup python3 seed_main.py --port=8001 --debug=false --supervisor=true >> log/app.log 2>&1 &
+fi
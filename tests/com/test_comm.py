@@ -1,10 +1,25 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from tests.testcase import APITestCase
+from tests.testcase import APITestCase, FakeCollection
 from controller import validate as v
+from controller.router import RouteTrie
+from controller.com.access import AccessEngine
+from controller.upload import MultipartParser
+from utils.admission import AdmissionControl
 import controller.errors as e
+import socket
 import logging
+from unittest import mock
+from tornado import gen
+from tornado.iostream import IOStream
+from tornado.testing import gen_test
+from tornado.web import RequestHandler
+from tornado.httputil import HTTPServerRequest
+from controller.app import Application
+from utils.helper import load_config
+from pymongo import MongoClient
+from utils.async_db import AsyncCollection
 
 
 class TestCommon(APITestCase):
@@ -27,11 +42,126 @@ class TestCommon(APITestCase):
 
         errs = v.validate(data, rules)
         self.assertEqual(set(errs.keys()), {'age', 'email', 'name', 'password', 'phone', 'old_password'})
+        self.assertEqual(v.Validator(rules).validate(data), errs)
         for k, t in errs.items():
             self.assertIs(t.__class__, tuple)
             self.assertIs(t[0].__class__, int)
             self.assertIs(t[1].__class__, str)
 
+    def test_validate_async(self):
+        data = {'name': '1234567890', 'phone': '1', 'age': 8}
+        rules = [(v.is_name, 'name'), (v.is_phone, 'phone'), (v.between, 'age', 10, 100)]
+        errs = self.io_loop.run_sync(lambda: v.validate_async(data, rules))
+        self.assertEqual(errs, v.validate(data, rules))
+
+    def test_validate_db(self):
+        collection = FakeCollection(aggregate_result=[dict(c0=[dict(n=1)], c1=[], c2=[dict(n=2)])])
+        data = {'name': 'a', 'phone': '13800001234', 'email': 'a@b.com'}
+        rules = [(v.not_existed, collection, 'name', 'phone'), (v.is_unique, collection, 'email')]
+        errs = v.validate(data, rules)
+        self.assertEqual(set(errs.keys()), {'name', 'email'})
+        self.assertEqual(len(collection.pipelines), 1)
+        self.assertEqual(errs, self.io_loop.run_sync(lambda: v.validate_async(data, rules)))
+
+        # 文档库规则与其他规则的错误按规则的顺序合并，同一属性取后面规则的错误
+        data['phone'] = '1'
+        rules = [(v.not_existed, collection, 'name'), (v.is_phone, 'phone'), (v.is_name, 'name')]
+        errs = v.validate(data, rules)
+        self.assertEqual(list(errs.items()), [('name', e.invalid_name), ('phone', e.invalid_phone)])
+        self.assertEqual(list(errs.items()), list(self.io_loop.run_sync(lambda: v.validate_async(data, rules)).items()))
+        rules = [(v.not_existed, collection, 'name'), (v.is_phone, 'phone')]
+        self.assertEqual(list(v.validate(data, rules)), ['name', 'phone'])
+
+    def test_validate_db_pymongo(self):
+        """ pymongo集合的任意属性都是子集合，校验应在集合本身上查询 """
+        collection = MongoClient(connect=False)['test']['user']
+        result = [dict(c0=[dict(n=1)], c1=[dict(n=1)])]
+        data = {'name': 'a', 'email': 'a@b.com'}
+        rules = [(v.not_existed, collection, 'name'), (v.exist, collection, 'email')]
+        with mock.patch.object(collection, 'aggregate', side_effect=lambda p: iter(result)) as aggregate:
+            errs = v.validate(data, rules)
+            self.assertEqual(set(errs.keys()), {'name'})
+            self.assertEqual(errs, self.io_loop.run_sync(lambda: v.validate_async(data, rules)))
+            self.assertEqual(aggregate.call_count, 2)
+
+        async_collection = AsyncCollection(collection, None)
+        rules = [(v.not_existed, async_collection, 'name'), (v.exist, async_collection, 'email')]
+        with mock.patch.object(collection, 'aggregate', side_effect=lambda p: iter(result)) as aggregate:
+            self.assertEqual(v.validate(data, rules), errs)
+            self.assertEqual(aggregate.call_count, 1)
+
+    def test_route_trie(self):
+        trie = RouteTrie({'num': '[0-9]+'})
+        self.assertTrue(trie.add('/api/page/@num', 'page'))
+        self.assertTrue(trie.add('/api/page/new', 'new'))
+        self.assertFalse(trie.add('/api/file/(.+)', 'file'))
+        self.assertEqual(trie.match('/api/page/12'), ('page', [b'12']))
+        self.assertEqual(trie.match('/api/page/new'), ('new', []))
+        self.assertIsNone(trie.match('/api/page/a1'))
+        self.assertIsNone(trie.match('/api/page'))
+        self.assertTrue(trie.add('/api/page/1', 'one'))
+        self.assertEqual(trie.match('/api/page/1'), ('page', [b'1']))  # 多个路由都匹配时取先添加的
+
+    def test_trie_router_order(self):
+        """ 前缀树路由与正则路由重叠时，与只用正则路由时一样取排在前面的 """
+        class ItemHandler(RequestHandler):
+            URL = '/api/item/@num'
+
+        class AnyItemHandler(RequestHandler):
+            URL = '/api/item/(.+)'
+
+        class PageHandler(RequestHandler):
+            URL = '/api/list/@num'
+
+        class FirstPageHandler(RequestHandler):
+            URL = '/api/list/1'
+
+        routes = {'/api/item/12': AnyItemHandler, '/api/list/1': PageHandler, '/api/list/2': PageHandler}
+        for router in ['regex', 'trie']:
+            config = load_config()
+            config['router'] = router
+            with mock.patch('controller.app.load_config', return_value=config):
+                app = Application([ItemHandler, AnyItemHandler, FirstPageHandler, PageHandler])
+            for url, cls in routes.items():
+                delegate = app.find_handler(HTTPServerRequest('GET', url, connection=mock.Mock()))
+                self.assertIs(delegate.delegate.handler_class, cls, (router, url))
+
+    def test_access_engine(self):
+        engine = AccessEngine({
+            '访客': {'/api': ['GET']},
+            '普通用户': {'/api/page/@num': ['GET', 'POST'], '/api/file/.+': ['GET']},
+        })
+        self.assertTrue(engine.can_access('访客', 'GET', '/api'))
+        self.assertFalse(engine.can_access('访客', 'GET', '/api/page/1'))
+        self.assertTrue(engine.can_access('普通用户,访客', 'POST', '/api/page/1'))
+        self.assertFalse(engine.can_access('普通用户,访客', 'DELETE', '/api/page/1'))
+        self.assertTrue(engine.can_access('普通用户,访客', 'GET', '/api/file/a.txt'))
+        self.assertTrue(engine.can_access('访客', 'GET', '/api'))
+        self.assertEqual(engine.cache.stats['hits'], 1)
+
+        # 重叠的路由允许的方法不同
+        engine = AccessEngine({'普通用户': {'/api/page/@num': ['GET'], '/api/page/1': ['POST']}})
+        self.assertTrue(engine.can_access('普通用户', 'GET', '/api/page/1'))
+        self.assertTrue(engine.can_access('普通用户', 'POST', '/api/page/1'))
+        self.assertFalse(engine.can_access('普通用户', 'POST', '/api/page/2'))
+
+    def test_multipart_parser(self):
+        body = (b'--xyz\r\nContent-Disposition: form-data; name="a"\r\n\r\n1\r\n'
+                b'--xyz\r\nContent-Disposition: form-data; name="f"; filename="f.txt"\r\n\r\n'
+                b'line\r\n--xy\r\n\r\n--xyz--\r\n')
+        for size in [1, 3, 7, len(body)]:
+            parser, parts = MultipartParser(b'xyz'), []
+            for i in range(0, len(body), size):
+                for event, value in parser.feed(body[i:i + size]):
+                    if event == 'begin':
+                        parts.append([value.get('Content-Disposition'), b''])
+                    elif event == 'data':
+                        parts[-1][1] += value
+            self.assertTrue(parser.finished)
+            self.assertEqual([p[1] for p in parts], [b'1', b'line\r\n--xy\r\n'])
+            self.assertIn('filename="f.txt"', parts[1][0])
+        self.assertRaises(ValueError, MultipartParser(b'xyz').feed, b'--xyzab')
+
     def test_db(self):
         self._app.db.tmp.drop()
         logging.error('test')
@@ -40,6 +170,43 @@ class TestCommon(APITestCase):
         self.assert_code(200, self.fetch('/'))
         self.assert_code(200, self.fetch('/api?_raw=1'))
 
+    def test_metrics(self):
+        self.assert_code(200, self.fetch('/api?_raw=1'))
+        self.assert_code(200, self.fetch('/api'))
+        r = self.fetch('/api/metrics').body.decode()
+        self.assertIn('http_request_duration_ms_count{code="200",handler="ApiTable",method="GET"} 2', r)
+        self.assertIn('template_render_ms_count{template="_api.html"} 1', r)
+        self.assertIn('# TYPE executor_total counter', r)
+        self.assertIn('# TYPE executor_tasks gauge\nexecutor_tasks{type="process_in_flight"} 0', r)
+        self.assertNotIn('executor_total{type="thread_in_flight"}', r)
+
+    def test_admission(self):
+        self._app.admission = AdmissionControl(ip_rate=1, ip_burst=2, exempt=['/api/metrics'])
+        self.assert_code(200, self.fetch('/api?_raw=1'))
+        self.assert_code(200, self.fetch('/api?_raw=1'))
+        r = self.fetch('/api?_raw=1')
+        self.assertEqual(r.code, 429)
+        self.assertEqual(r.headers['Retry-After'], '1')
+        self.assertEqual(self._app.admission.in_flight, 0)
+
+        self._app.admission = AdmissionControl(max_in_flight=1, exempt=['/api/metrics'])
+        self._app.admission.in_flight = 1
+        r = self.fetch('/api?_raw=1')
+        self.assertEqual(r.code, 503)
+        self.assertIn('admission_total{type="rejected_busy"} 1', self.fetch('/api/metrics').body.decode())
+
+    @gen_test
+    async def test_aborted_body(self):
+        """ 请求体未收完连接就断开时，不应再计入正在处理的请求数 """
+        stream = IOStream(socket.socket())
+        await stream.connect(('127.0.0.1', self.get_http_port()))
+        await stream.write(b'POST /api HTTP/1.1\r\nHost: localhost\r\nContent-Length: 100\r\n\r\nabc')
+        await gen.sleep(0.05)
+        self.assertEqual(self._app.active_requests, 1)
+        stream.close()
+        await gen.sleep(0.05)
+        self.assertEqual(self._app.active_requests, 0)
+
     def test_404(self):
         self.assert_code(404, self.fetch('/api_err'))
         self.assert_code(404, self.fetch('/api/err'))
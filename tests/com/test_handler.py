@@ -1,10 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import socket
+import hashlib
+import tempfile
+from os import path
+from tornado import gen
+from tornado.iostream import IOStream
+from tornado.testing import gen_test
 from tests.testcase import APITestCase
-from controller.base import BaseHandler, DbError
+from controller.base import BaseHandler, DbError, cache_response
+from controller.upload import StreamingUploadHandler
 from controller import validate as v
 import controller.errors as e
+from utils.admission import AdmissionControl
 
 
 class DummyHandler(BaseHandler):
@@ -27,9 +37,81 @@ class DummyHandler(BaseHandler):
             self.send_db_error(err)
 
 
+class StreamHandler(BaseHandler):
+    URL = '/api/test/stream'
+
+    async def get(self):
+        """测试流式返回"""
+        size = int(self.get_query_argument('size'))
+        await self.send_stream_response(iter([dict(i=i) for i in range(size)]), batch_size=100, size=size)
+
+
+class SlowHandler(BaseHandler):
+    URL = '/api/test/slow'
+
+    async def get(self):
+        """测试停止服务时等待正在处理的请求"""
+        await gen.sleep(0.2)
+        self.send_data_response(dict(done=True))
+
+
+class LoopbackHandler(BaseHandler):
+    URL = '/api/test/loopback'
+
+    def get(self):
+        """测试站内调用API"""
+        self.call_back_api('/api/test/stream?size=3', lambda r: self.send_data_response(dict(size=r['size'])),
+                           lambda err: self.send_error_response(e.not_allowed_empty, message=str(err)))
+
+
+class UploadHandler(BaseHandler):
+    URL = '/api/test/upload'
+
+    def post(self):
+        """测试上传文件"""
+        files = {k: [len(f['body']) for f in v] for k, v in self.request.files.items()}
+        self.send_data_response(dict(files=files, a=self.get_body_argument('a'),
+                                     length=int(self.request.headers['Content-Length'])))
+
+
+class StreamingUploadTestHandler(StreamingUploadHandler):
+    URL = '/api/test/upload/stream'
+    MAX_SIZE = 1024 * 1024
+
+    def on_uploaded(self, files):
+        """测试流式上传"""
+        for f in files:
+            assert path.exists(f['path'])
+            os.remove(f['path'])
+        self.send_data_response(dict(files=files, a=self.get_body_argument('a')))
+
+
+class CachedHandler(BaseHandler):
+    URL = '/api/test/cached'
+    count = 0
+
+    @cache_response('dummy')
+    def get(self):
+        """测试缓存响应"""
+        CachedHandler.count += 1
+        self.send_data_response(dict(count=CachedHandler.count))
+
+
+class SlowCachedHandler(BaseHandler):
+    URL = '/api/test/slow/cached'
+
+    @cache_response('dummy')
+    async def get(self):
+        """测试处理请求时重载配置"""
+        await gen.sleep(0.2)
+        self.send_data_response(dict(done=True))
+
+
 class TestHandler(APITestCase):
     def get_app(self):
-        return APITestCase.get_app(self, extra_handlers=[DummyHandler])
+        return APITestCase.get_app(self, extra_handlers=[
+            DummyHandler, StreamHandler, SlowHandler, LoopbackHandler, UploadHandler, StreamingUploadTestHandler,
+            CachedHandler, SlowCachedHandler])
 
     def tearDown(self):
         self._app.db.dummy.delete_one(dict(name='a'))
@@ -43,3 +125,96 @@ class TestHandler(APITestCase):
         r = self.fetch('/api/test/dummy', body={'data': {'name': 'a', 'res': 10}})
         self.assert_code(200, r)
         self.assertEqual(self.parse_response(r)['res'], 10)
+
+    def test_stream_api(self):
+        for size in [0, 100, 250]:
+            r = self.parse_response(self.fetch('/api/test/stream?size=%d' % size))
+            self.assertEqual(r['size'], size)
+            self.assertEqual([d['i'] for d in r['data']], list(range(size)))
+
+    def test_upload_api(self):
+        r = self.parse_response(self.fetch('/api/test/upload', files={'f': __file__}, body={'a': 1}))
+        self.assertEqual(r.get('files'), {'f': [path.getsize(__file__)]})
+        self.assertEqual(r.get('a'), '1')
+        self.assertGreater(r.get('length'), path.getsize(__file__))
+
+    def test_streaming_upload_api(self):
+        with open(__file__, 'rb') as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        r = self.parse_response(self.fetch('/api/test/upload/stream', files={'f': __file__}, body={'a': 1}))
+        self.assertEqual(r.get('a'), '1')
+        self.assertEqual([(f['name'], f['size'], f['sha256']) for f in r['files']],
+                         [('f', path.getsize(__file__), sha256)])
+
+        with tempfile.NamedTemporaryFile(suffix='.bin') as f:
+            f.write(os.urandom(2 * 1024 * 1024))
+            f.flush()
+            r = self.fetch('/api/test/upload/stream', files={'f': f.name}, body={'a': 1}, expect_100_continue=True)
+            self.assert_code(e.upload_too_large, r)
+
+    @gen_test
+    async def test_aborted_upload(self):
+        """ 流式上传中途断开时应释放过载保护的计数 """
+        admission = self._app.admission = AdmissionControl(max_in_flight=5)
+        for i in range(3):
+            stream = IOStream(socket.socket())
+            await stream.connect(('127.0.0.1', self.get_http_port()))
+            await stream.write(b'POST /api/test/upload/stream HTTP/1.1\r\nHost: localhost\r\n'
+                               b'Content-Type: multipart/form-data; boundary=b\r\nContent-Length: 1000\r\n\r\n'
+                               b'--b\r\nContent-Disposition: form-data; name="f"; filename="a.txt"\r\n\r\nabc')
+            await gen.sleep(0.05)
+            self.assertEqual(admission.in_flight, 1)
+            stream.close()
+            await gen.sleep(0.05)
+            self.assertEqual(admission.in_flight, 0)
+        self.assertEqual(self._app.active_requests, 0)
+
+    def test_cached_api(self):
+        self._app.response_cache.path = None  # 只测试本进程的缓存，不写失效标记文件
+        r1, r2 = self.fetch('/api/test/cached?q=1'), self.fetch('/api/test/cached?q=1')
+        self.assertEqual(r1.body, r2.body)
+        self.assertEqual(r1.headers['Etag'], r2.headers['Etag'])
+        self.assert_code(304, self.fetch('/api/test/cached?q=1', headers={'If-None-Match': r1.headers['Etag']}))
+
+        count = self.parse_response(r1)['count']
+        self.assertEqual(self.parse_response(self.fetch('/api/test/cached?q=2'))['count'], count + 1)
+        self._app.response_cache.invalidate('dummy')
+        self.assertEqual(self.parse_response(self.fetch('/api/test/cached?q=1'))['count'], count + 2)
+
+    def test_loopback_api(self):
+        for loopback in [True, False]:
+            self._app.config['http_client'] = dict(loopback=loopback)
+            r = self.parse_response(self.fetch('/api/test/loopback'))
+            self.assertEqual(r.get('size'), 3, r)
+
+    @gen_test
+    async def test_reload_in_request(self):
+        """ 处理请求时替换或关闭过载保护和响应缓存，请求结束时应在原来的对象上释放和缓存 """
+        for i, new_admission in enumerate([AdmissionControl(max_in_flight=2), None]):
+            admission = self._app.admission = AdmissionControl(max_in_flight=2)
+            cache, cache.path = self._app.response_cache, None
+            future = self.http_client.fetch(self.get_url('/api/test/slow/cached?q=%d' % i))
+            await gen.sleep(0.05)
+            self.assertEqual(admission.in_flight, 1)
+            self._app.admission = new_admission
+            self._app.response_cache = None
+            self.assertEqual(self.parse_response(await future).get('done'), True)
+            self.assertEqual(admission.in_flight, 0)
+            self.assertEqual(new_admission and new_admission.in_flight, new_admission and 0)
+            self.assertEqual(len(cache), 1)
+            cache.clear()
+            self._app.response_cache = cache
+
+    @gen_test
+    async def test_shutdown(self):
+        calls = []
+        self._app.add_shutdown_callback(calls.append, 'first')
+        self._app.add_shutdown_callback(gen.sleep, 0.01)
+        self._app.add_shutdown_callback(calls.append, 'last')
+        future = self.http_client.fetch(self.get_url('/api/test/slow'))
+        await gen.sleep(0.05)
+        self.assertEqual(self._app.active_requests, 1)
+        await self._app.shutdown(self.http_server, timeout=5)
+        self.assertEqual(self._app.active_requests, 0)
+        self.assertEqual(calls, ['last', 'first'])
+        self.assertEqual(self.parse_response(await future).get('done'), True)
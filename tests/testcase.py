@@ -12,9 +12,9 @@ from tornado.util import PY3
 from bson import json_util
 import uuid
 import re
-import mimetypes
 import controller as c
 from controller.app import Application
+from utils.http_helper import body_producer, multipart_length
 
 if PY3:
     import http.cookies as Cookie
@@ -24,39 +24,61 @@ else:
 cookie = Cookie.SimpleCookie()
 
 
-# https://github.com/ooclab/ga.service/blob/master/src/codebase/utils/fetch_with_form.py
-def body_producer(boundary, files, params, write):
-    boundary_bytes = boundary.encode()
-    crlf = b'\r\n'
+class FakeCursor(object):
+    """ 测试用的pymongo游标，只实现 sort、limit 和迭代 """
 
-    for arg_name in files:
-        filename = files[arg_name]
-        filename_bytes = filename.encode()
-        write(b'--%s%s' % (boundary_bytes, crlf))
-        write(b'Content-Disposition: form-data; name="%s"; filename="%s"%s' %
-              (arg_name.encode(), filename_bytes, crlf))
+    def __init__(self, docs):
+        self.docs = list(docs)
 
-        m_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-        write(b'Content-Type: %s%s' % (m_type.encode(), crlf))
-        write(crlf)
-        with open(filename, 'rb') as f:
-            while True:
-                # 16k at a time.
-                chunk = f.read(16 * 1024)
-                if not chunk:
-                    break
-                write(chunk)
+    def sort(self, key, direction=1):
+        self.docs = sorted(self.docs, key=lambda d: d[key], reverse=direction < 0)
+        return self
 
-        write(crlf)
+    def limit(self, n):
+        self.docs = self.docs[:n]
+        return self
 
-    assert isinstance(params, dict)
-    for arg_name in params:
-        value = str(params[arg_name])
-        write(b'--%s%s' % (boundary_bytes, crlf))
-        write(b'Content-Disposition: form-data; name="%s"{}{}%s{}'.replace(b'{}', crlf) %
-              (arg_name.encode(), value.encode()))
+    def __iter__(self):
+        self.docs = iter(self.docs)
+        return self
 
-    write(b'--%s--%s' % (boundary_bytes, crlf))
+    def __next__(self):
+        return next(self.docs)
+
+
+class FakeCollection(object):
+    """
+    测试用的内存集合，不需要文档库，只实现各测试用到的pymongo集合方法。
+    aggregate 记录收到的管道，$indexStats 按 indexes 返回，其他管道返回 aggregate_result
+    """
+
+    def __init__(self, docs=None, indexes=None, aggregate_result=None, full_name='test.fake'):
+        self.docs = list(docs or [])
+        self.indexes = indexes or {}  # 索引名: 索引字段
+        self.aggregate_result = aggregate_result or []
+        self.full_name = full_name
+        self.pipelines = []
+
+    def find(self, *args, **kwargs):
+        return FakeCursor(self.docs)
+
+    def find_one(self, condition):
+        return next((d for d in self.docs if all(d.get(k) == v for k, v in condition.items())), None)
+
+    def insert_many(self, docs, ordered=True):
+        self.docs.extend(docs)
+
+    def index_information(self):
+        return {name: dict(key=keys) for name, keys in self.indexes.items()}
+
+    def create_index(self, keys, name, **kwargs):
+        self.indexes[name] = keys
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        if '$indexStats' in pipeline[0]:
+            return iter([dict(name=name, accesses=dict(ops=0)) for name in self.indexes])
+        return iter(self.aggregate_result)
 
 
 class APITestCase(AsyncHTTPTestCase):
@@ -112,15 +134,17 @@ class APITestCase(AsyncHTTPTestCase):
         if 'body' in kwargs or files:
             kwargs['method'] = kwargs.get('method', 'POST')
 
-        headers = kwargs.get('headers', {})
+        headers = kwargs.pop('headers', {})
         headers['Cookie'] = ''.join(['%s=%s;' % (x, morsel.value) for (x, morsel) in cookie.items()])
 
         host = kwargs.pop('host', None)
         url = url if re.match('^http', url) else (host + url if host else self.get_url(url))
         if files:
             boundary = uuid.uuid4().hex
-            headers.update({'Content-Type': 'multipart/form-data; boundary=%s' % boundary})
-            producer = partial(body_producer, boundary, files, kwargs.pop('body', {}))
+            params = kwargs.pop('body', {})
+            headers.update({'Content-Type': 'multipart/form-data; boundary=%s' % boundary,
+                            'Content-Length': str(multipart_length(boundary, files, params))})
+            producer = partial(body_producer, boundary, files, params)
             request = HTTPRequest(url, headers=headers, body_producer=producer, **kwargs)
         else:
             request = HTTPRequest(url, headers=headers, **kwargs)
@@ -3,10 +3,37 @@
 """
 @time: 2019/05/07
 """
-from tests.testcase import APITestCase
+from tests.testcase import APITestCase, FakeCollection
+import os
+import time
+import tempfile
 from datetime import datetime
 from utils import helper as h
-from utils.http_helper import call_api_async, call_api_sync
+from utils.http_helper import call_api_async, call_api_sync, call_api_many, call_api_many_async, _create_request
+from utils.log_buffer import LogBuffer
+from utils.cache import LRUCache, SessionCache, ResponseCache
+from utils import serializer
+from utils.serializer import dumps_fast
+from utils.admission import RateLimiter, AdmissionControl
+from utils.mongo_pool import PoolMonitor
+from utils.pager import page_query, encode_token, decode_token
+from utils.indexes import IndexRegistry
+from utils.config import ConfigService
+from utils.db_monitor import CommandMonitor, start_request, filter_shape, plan_summary
+from types import SimpleNamespace
+from unittest import mock
+from tornado.httputil import HTTPServerRequest
+from controller.base import BaseHandler
+from utils.executor import thread_pool, process_pool, blocking, cpu_bound, configure_executors
+from utils.async_db import AsyncDatabase
+from tornado import gen
+from tornado.testing import gen_test
+from bson import json_util, ObjectId, Decimal128
+
+
+@cpu_bound
+def gen_ids(values):
+    return [h.gen_id(v) for v in values]
 
 
 class TestHelper(APITestCase):
@@ -33,3 +60,285 @@ class TestHelper(APITestCase):
             self.assertEqual(r.get('code'), 1001)
 
             call_api_sync('http://localhost:8000/api/user/login', body={'a': 1}, files={'f': __file__})
+
+    def test_expect_100_continue(self):
+        for url, expect in [('http://localhost:8000/api/upload', True), ('http://127.0.0.1/api', True),
+                            ('https://example.com/upload', False)]:
+            request = _create_request(url, {}, files={'f': __file__})[0]
+            self.assertEqual(request.expect_100_continue, expect, url)
+        request = _create_request('https://example.com/upload', {}, files={'f': __file__}, expect_100_continue=True)[0]
+        self.assertTrue(request.expect_100_continue)
+
+    def test_upload_missing_file(self):
+        missing = os.path.join(tempfile.gettempdir(), 'not-existed.bin')
+        self.assertIsInstance(call_api_sync('http://localhost:123', files={'f': missing}), FileNotFoundError)
+        errors = []
+        self.io_loop.run_sync(lambda: call_api_async(self.get_url('/api'), {}, errors.append, errors.append,
+                                                     files={'f': missing}))
+        self.assertEqual(len(errors), 1)
+        self.assertIn('not-existed.bin', errors[0])
+
+    def test_call_api_many(self):
+        r = call_api_many(['http://localhost:123', dict(url='http://localhost:124', method='POST', body={})])
+        self.assertEqual([type(x) for x in r], [ConnectionRefusedError] * 2)
+
+        done = []
+        requests = [dict(url=self.get_url('/api/user/login'), body={})] * 5 + [self.get_url('/api/not-existed')]
+        r = self.io_loop.run_sync(lambda: call_api_many_async(
+            requests, concurrency=2, progress=lambda n, total, i, ret: done.append((n, total))))
+        self.assertEqual([x.get('code') for x in r[:5]], [405] * 5)
+        self.assertEqual(r[5].code, 404)
+        self.assertEqual(done[-1], (6, 6))
+
+    def test_log_buffer(self):
+        collection = FakeCollection()
+        buf = LogBuffer(lambda: collection, batch_size=2, max_size=3)
+        self.assertTrue(buf.append(dict(a=1)))
+        buf.append(dict(a=2))
+        buf.append(dict(a=3))
+        self.assertFalse(buf.append(dict(a=4)))
+        buf.flush()
+        self.assertEqual([d['a'] for d in collection.docs], [1, 2, 3])
+        self.assertEqual(buf.stats, dict(buffered=3, flushed=3, dropped=1, failed=0))
+
+        buf.configure(batch_size=5, flush_interval=2, max_size=3, overflow='drop_old')
+        self.assertEqual((buf.batch_size, buf.flush_interval, buf.overflow), (5, 2, 'drop_old'))
+        self.assertRaises(ValueError, buf.configure, overflow='block')
+        self.assertRaises(ValueError, buf.configure, batch_size=0)
+        self.assertRaises(TypeError, buf.configure, buffered=True)
+
+    def test_cache(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats, dict(hits=1, misses=1, evictions=1))
+
+        sessions = SessionCache()
+        sessions.set('cookie1', dict(_id=1, name='a'))
+        sessions.set('cookie2', dict(_id=1, name='a'))
+        sessions.set('cookie3', dict(_id=2, name='b'))
+        sessions.invalidate(1)
+        self.assertEqual(len(sessions), 1)
+        self.assertEqual(sessions.get('cookie3')['name'], 'b')
+        sessions.set('cookie4', dict(_id=3, name='c'))
+        sessions.configure(max_size=1, ttl=60)
+        self.assertEqual((len(sessions), sessions.ttl), (1, 60))
+        self.assertIsNone(sessions.get('cookie3'))
+        self.assertNotIn(2, sessions.user_keys)
+        self.assertRaises(ValueError, sessions.configure, max_size=0)
+
+        with tempfile.TemporaryDirectory() as path:
+            worker1, worker2 = ResponseCache(path=path), ResponseCache(path=path)
+            worker1.set('a', (time.time(), ('user',), 'etag', b'{}', None))
+            worker1.set('b', (time.time(), ('log',), 'etag', b'{}', None))
+            worker2.invalidate('user')  # 其他进程修改了数据
+            self.assertIsNone(worker1.get('a'))
+            self.assertEqual(worker1.get('b')[2], 'etag')
+
+    def test_rate_limit(self):
+        limiter = RateLimiter(rate=10, burst=2)
+        self.assertEqual([limiter.acquire('a') for i in range(3)][:2], [0, 0])
+        self.assertGreater(limiter.acquire('a'), 0)
+        self.assertEqual(limiter.acquire('b'), 0)
+        time.sleep(0.11)
+        self.assertEqual(limiter.acquire('a'), 0)
+
+        admission = AdmissionControl(max_in_flight=2, user_rate=1)
+        self.assertIsNone(admission.admit('ip1', 'u1'))
+        self.assertEqual(admission.admit('ip1', 'u1')[0], 'user')
+        self.assertIsNone(admission.admit('ip1'))
+        self.assertEqual(admission.admit('ip2')[0], 'busy')
+        admission.release()
+        self.assertIsNone(admission.admit('ip2'))
+        self.assertEqual(admission.stats, dict(accepted=3, rejected_busy=1, rejected_ip=0, rejected_user=1))
+
+        admission = AdmissionControl(ip_rate=1, ip_burst=2, user_rate=1)
+        self.assertIsNone(admission.admit('ip1', 'u1'))
+        self.assertEqual(admission.admit('ip1', 'u1')[0], 'user')  # 被用户限流拒绝的请求不消耗IP的令牌
+        self.assertIsNone(admission.admit('ip1', 'u2'))
+
+    def test_db_options(self):
+        self.assertEqual(h.get_db_uri(dict(host='db', port=27018)), 'mongodb://db:27018/')
+        self.assertEqual(h.get_db_uri(dict(hosts=['db1', 'db2:27018'], user='u', password='p')),
+                         'mongodb://u:p@db1,db2:27018/admin')
+        options = h.db_options(dict(options=dict(maxPoolSize=50, compressors='zlib')))
+        self.assertEqual([options[k] for k in ['maxPoolSize', 'compressors', 'waitQueueTimeoutMS']], [50, 'zlib', 5000])
+
+        monitor = PoolMonitor()
+        if monitor.supported:
+            for event in ['connection_created', 'connection_check_out_started', 'connection_checked_out']:
+                getattr(monitor, event)(None)
+            self.assertEqual((monitor.stats['checked_out'], monitor.stats['idle']), (1, 0))
+        else:  # pymongo 3.9 以下没有连接池事件
+            self.assertEqual(monitor.stats, {})
+
+    def test_pager(self):
+        self.assertEqual(page_query({'a': 1}), ({'a': 1}, [('_id', -1)]))
+        doc = dict(_id=ObjectId(), time=datetime(2020, 1, 8, 12, 0, 0, 123000))
+        token = encode_token('secret', doc, 'time', 1)
+        last = decode_token('secret', token, 'time', 1)
+        self.assertEqual(last, (doc['time'], doc['_id']))
+        after = {'$or': [{'time': {'$gt': doc['time']}}, {'time': doc['time'], '_id': {'$gt': doc['_id']}}]}
+        sort = [('time', 1), ('_id', 1)]
+        self.assertEqual(page_query({'a': 1}, 'time', 1, last), ({'$and': [{'a': 1}, after]}, sort))
+        self.assertEqual(page_query(None, last=(None, doc['_id']))[0], {'_id': {'$lt': doc['_id']}})
+        for args in [('secret', token[:-2] + 'AA', 'time', 1), ('other', token, 'time', 1),
+                     ('secret', token, 'time', -1)]:
+            self.assertRaises(ValueError, decode_token, *args)
+
+    def test_pager_null(self):
+        """ 排序值为null或缺少排序字段的记录不会被跳过 """
+        def match(doc, query):  # 按文档库的规则匹配用到的查询运算符，$gt、$lt 不匹配null
+            for k, v in query.items():
+                if k in ('$and', '$or'):
+                    ok = (all if k == '$and' else any)(match(doc, q) for q in v)
+                elif isinstance(v, dict):
+                    x = doc.get(k)
+                    ok = all(x != y if op == '$ne' else x is not None and (x > y if op == '$gt' else x < y)
+                             for op, y in v.items())
+                else:
+                    ok = doc.get(k) == v
+                if not ok:
+                    return False
+            return True
+
+        docs = [dict(_id=0, n=2), dict(_id=1), dict(_id=2, n=1), dict(_id=3, n=None), dict(_id=4, n=2)]
+        for direction in (1, -1):
+            expected = sorted(docs, key=lambda d: (d.get('n') is not None, d.get('n') or 0, d['_id']),
+                              reverse=direction < 0)
+            ids, last = [], None
+            while True:
+                query, sort = page_query({}, 'n', direction, last)
+                page = [d for d in expected if match(d, query)][:2]
+                if not page:
+                    break
+                ids += [d['_id'] for d in page]
+                last = decode_token('secret', encode_token('secret', page[-1], 'n', direction), 'n', direction)
+            self.assertEqual(ids, [d['_id'] for d in expected], direction)
+
+    def test_get_page(self):
+        handler = BaseHandler(self._app, HTTPServerRequest('GET', '/', connection=mock.Mock()))
+        collection = mock.Mock()
+        cursor = collection.find.return_value.sort.return_value.limit
+        for projection, expected in [
+            ({'_id': 0, 'name': 1}, {'_id': 1, 'name': 1, 'time': 1}),
+            ({'_id': 0, 'time': 0}, None),
+            ({'_id': 0}, None),
+            ({'_id': 1}, {'_id': 1, 'time': 1}),
+            ({'a': 0}, {'a': 0}),
+        ]:
+            cursor.return_value = [dict(_id=i, name='n', time=i) for i in range(3)]
+            page = handler.get_page(collection, sort_key='time', page_size=2, projection=projection)
+            self.assertEqual(collection.find.call_args[0][1], expected, projection)
+            self.assertEqual(len(page['docs']), 2)
+            self.assertEqual('_id' in page['docs'][0], projection.get('_id', 1) == 1, projection)
+            self.assertEqual(decode_token(self._app.settings['cookie_secret'], page['next'], 'time'), (1, 1))
+
+    def test_indexes(self):
+        registry = IndexRegistry()
+        registry.add_index('log', [('create_time', -1)])
+        registry.add_index('log', [('user_id', 1), ('op_type', 1), ('create_time', -1)])
+        registry.add_query('log', 'op_type', 'user_id', sort=[('create_time', 1)])
+        registry.add_query('log', 'username')
+        self.assertEqual([q.fields for c, q in registry.check()], [{'username'}])
+
+        db = dict(log=FakeCollection(indexes={'_id_': [('_id', 1)], 'ct': [('create_time', -1)], 'ip_1': [('ip', 1)]}))
+        report = registry.reconcile(db)['log']
+        self.assertEqual(report['created'], ['user_id_1_op_type_1_create_time_-1'])
+        self.assertEqual((report['conflict'], report['unregistered']), ([], ['ip_1']))
+        self.assertEqual(registry.reconcile(db)['log']['created'], [])
+
+    @gen_test
+    async def test_db_monitor(self):
+        self.assertEqual(filter_shape({'a': 1, 'b': {'$in': [1, 2]}, '$or': [{'c': 'x'}]}),
+                         {'a': '?', 'b': {'$in': '?'}, '$or': [{'c': '?'}]})
+        plan = dict(stage='FETCH', inputStage=dict(stage='IXSCAN', keyPattern={'user_id': 1}))
+        self.assertEqual(plan_summary(plan), 'FETCH > IXSCAN {"user_id": 1}')
+
+        monitor = CommandMonitor(slow_ms=50)
+
+        def run_command(request_id, duration_ms):
+            command = dict(find='log', filter={'user_id': request_id})
+            monitor.started(SimpleNamespace(command_name='find', command=command, database_name='test',
+                                            request_id=request_id, connection_id=1))
+            monitor.succeeded(SimpleNamespace(command_name='find', request_id=request_id, connection_id=1,
+                                              duration_micros=duration_ms * 1000,
+                                              reply=dict(cursor=dict(firstBatch=[{}, {}]))))
+
+        stats = start_request()
+        if stats is None:  # Python 3.6 没有 contextvars
+            return
+        run_command(1, 10)
+        await thread_pool.run(run_command, 2, 60)  # 线程池中执行的命令也计入当前请求
+        self.assertEqual((stats.count, stats.time_ms, stats.docs), (2, 70, 4))
+        self.assertEqual((monitor.stats['commands'], monitor.stats['slow']), (2, 1))
+
+    def test_config_service(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            base, custom = os.path.join(tmp, 'base.yml'), os.path.join(tmp, 'custom.yml')
+            with open(base, 'w') as f:
+                f.write('site: {name: a}\nadmission: {ip_rate: 50}\ndatabase: {host: localhost}\n')
+            service = ConfigService(base, custom)
+            self.assertIs(service.get(), service.get())  # 只解析一次
+            self.assertFalse(os.path.exists(custom))
+            with self.assertRaises(TypeError):
+                service.get()['admission']['ip_rate'] = 1
+            config = service.load()
+            config['admission']['ip_rate'] = 1
+            self.assertEqual(service.get()['admission']['ip_rate'], 50)
+
+            changes = []
+            service.subscribe('admission', lambda value, old: changes.append((value['ip_rate'], old['ip_rate'])))
+            self.assertEqual(service.check(), [])
+            with open(custom, 'w') as f:
+                f.write('admission: {ip_rate: 10}\ndatabase: {host: db}\n')
+            self.assertEqual(service.check(), ['admission', 'database'])
+            self.assertEqual(changes, [(10, 50)])
+            self.assertEqual(service.get()['database']['host'], 'db')
+
+    @gen_test
+    async def test_executor(self):
+        sleep = blocking(time.sleep)
+        start = time.time()
+        await gen.multi([sleep(0.2) for i in range(3)])  # 并发执行，不阻塞 IOLoop
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual(await gen_ids(['a', 'b']), [h.gen_id('a'), h.gen_id('b')])
+        self.assertEqual(self._app.metrics.snapshot()['counters']['executor_total']['type="process_completed"'], 1)
+        self.assertEqual(thread_pool.stats['in_flight'], 0)
+        self.assertEqual(self._app.metrics.snapshot()['gauges']['executor_tasks']['type="thread_in_flight"'], 0)
+        self.assertIn('pool="process"', self._app.metrics.histograms['executor_wait_ms'])
+        with self.assertRaises(ZeroDivisionError):
+            await process_pool.run(divmod, 1, 0)
+
+        executor = thread_pool.executor
+        configure_executors(thread_pool.max_workers, process_pool.max_workers, metrics=self._app.metrics)
+        self.assertIs(thread_pool.executor, executor)  # 大小不变时继续使用已创建的池
+        configure_executors(thread_pool.max_workers + 1, process_pool.max_workers, metrics=self._app.metrics)
+        self.assertIsNot(thread_pool.executor, executor)
+        self.assertEqual(thread_pool.executor._max_workers, thread_pool.max_workers)
+
+    @gen_test
+    async def test_async_db(self):
+        docs = [dict(_id=i, n=i % 3) for i in range(5)]
+        collection = FakeCollection(docs)
+        db = AsyncDatabase(mock.Mock(**{'__getitem__': lambda self, name: collection}))
+        completed = thread_pool.stats['completed']
+        self.assertEqual(await db.user.find().sort('_id', -1).limit(2).to_list(10), [docs[4], docs[3]])
+        self.assertEqual(await db['user'].find_one({'_id': 1}), docs[1])
+        cursor = db.user.find({}).sort('n', 1).batch_size(2)
+        self.assertEqual([d['n'] async for d in cursor], [0, 0, 1, 1, 2])
+        self.assertEqual(thread_pool.stats['completed'] - completed, 6)  # 经共用的线程池执行，async for 每次取2条直到取空
+
+    def test_dumps_fast(self):
+        doc = dict(_id=ObjectId(), name='张三', create_time=datetime(2020, 1, 8, 12, 0, 0, 123000),
+                   data=b'ab', price=Decimal128('1.5'), tags=['a', 1, None], big=2 ** 70)
+        self.assertEqual(json_util.loads(dumps_fast(doc)), json_util.loads(json_util.dumps(doc)))
+
+        with mock.patch.object(serializer, 'orjson', None), mock.patch.object(serializer, '_warned', []):
+            with self.assertLogs(level='WARNING') as logs:
+                self.assertIs(serializer.get_encoder('fast'), dumps_fast)
+                serializer.get_encoder('fast')
+            self.assertEqual(len(logs.output), 1)  # 未安装orjson时只警告一次
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 过载保护：限制每个进程同时处理的请求数，按IP和用户的令牌桶限流，超限的请求直接拒绝，不再排队
+@time: 2026/10/18
+"""
+
+import time
+from utils.cache import LRUCache
+
+
+class RateLimiter(object):
+    """ 按键(IP或用户)的令牌桶，桶保存在LRU缓存中，长时间不活动的键被淘汰 """
+
+    def __init__(self, rate, burst=None, max_keys=100000):
+        """
+        :param rate: 每秒补充的令牌数，即持续的每秒请求数
+        :param burst: 桶的容量，即可突发的请求数，默认与 rate 相同
+        :param max_keys: 最多记录的键数
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.buckets = LRUCache(max_keys)  # 键: [令牌数, 上次补充的时刻]
+
+    def _bucket(self, key):
+        now = time.time()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = [self.burst, now]
+            self.buckets.set(key, bucket)
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def check(self, key):
+        """ 不取令牌，返回 0 表示有令牌可取，否则返回需等待的秒数 """
+        bucket = self._bucket(key)
+        return 0 if bucket[0] >= 1 else (1 - bucket[0]) / self.rate
+
+    def acquire(self, key):
+        """ 取一个令牌，返回 0 表示允许，否则返回需等待的秒数 """
+        wait = self.check(key)
+        if not wait:
+            self.buckets.get(key)[0] -= 1
+        return wait
+
+
+class AdmissionControl(object):
+    """ 在 BaseHandler.prepare 中调用 admit，允许的请求结束时调用 release。各项为0表示不限制 """
+
+    def __init__(self, max_in_flight=0, ip_rate=0, ip_burst=None, user_rate=0, user_burst=None, max_keys=100000,
+                 retry_after=1, exempt=()):
+        """
+        :param max_in_flight: 本进程同时处理的请求数上限，超过时返回503
+        :param ip_rate: 每个IP每秒的请求数，ip_burst 为可突发的请求数，超过时返回429
+        :param user_rate: 每个登录用户每秒的请求数，user_burst 为可突发的请求数，超过时返回429
+        :param retry_after: 返回503时建议客户端等待的秒数
+        :param exempt: 不限制的路径前缀，如 /api/metrics
+        """
+        self.max_in_flight = max_in_flight
+        self.ip_limiter = ip_rate and RateLimiter(ip_rate, ip_burst, max_keys)
+        self.user_limiter = user_rate and RateLimiter(user_rate, user_burst, max_keys)
+        self.retry_after = retry_after
+        self.exempt = tuple(exempt)
+        self.in_flight = 0
+        self.stats = dict(accepted=0, rejected_busy=0, rejected_ip=0, rejected_user=0)
+
+    def is_exempt(self, path):
+        return path.startswith(self.exempt) if self.exempt else False
+
+    def admit(self, ip, user_id=None):
+        """
+        检查能否处理请求，允许时计入正在处理的请求数
+        :return: None 表示允许，否则为 (拒绝原因, 建议等待的秒数)，拒绝原因为 busy、ip 或 user
+        """
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return self._reject('busy', self.retry_after)
+        # 两个限流都允许时才取令牌，被一个拒绝的请求不消耗另一个的令牌
+        wait = self.ip_limiter and self.ip_limiter.check(ip)
+        if wait:
+            return self._reject('ip', wait)
+        wait = user_id and self.user_limiter and self.user_limiter.check(user_id)
+        if wait:
+            return self._reject('user', wait)
+        if self.ip_limiter:
+            self.ip_limiter.acquire(ip)
+        if user_id and self.user_limiter:
+            self.user_limiter.acquire(user_id)
+        self.in_flight += 1
+        self.stats['accepted'] += 1
+
+    def _reject(self, reason, wait):
+        self.stats['rejected_' + reason] += 1
+        return reason, wait
+
+    def release(self):
+        self.in_flight = max(0, self.in_flight - 1)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 未安装motor时使用的异步文档库访问封装，在共用的线程池(utils.executor.thread_pool)中执行pymongo调用，接口与motor一致
+@time: 2026/10/18
+"""
+
+from functools import partial
+from collections import deque
+from itertools import islice
+from tornado.gen import convert_yielded
+from utils.executor import thread_pool
+
+# 需要在线程池中执行的集合方法，其余属性(name、full_name等)直接取自pymongo集合
+ASYNC_METHODS = {
+    'find_one', 'insert_one', 'insert_many', 'update_one', 'update_many', 'replace_one',
+    'delete_one', 'delete_many', 'count_documents', 'estimated_document_count', 'distinct',
+    'find_one_and_update', 'find_one_and_replace', 'find_one_and_delete', 'bulk_write',
+    'create_index', 'create_indexes', 'drop_index', 'index_information', 'drop',
+}
+
+
+def _submit(executor, func, *args, **kwargs):
+    """ 立即提交到线程池，返回 Future，与motor一样不 await 时也会执行 """
+    return convert_yielded(executor.run(func, *args, **kwargs))
+
+
+class AsyncDatabase(object):
+    """ pymongo数据库的异步封装，db.coll 或 db['coll'] 得到 AsyncCollection 对象 """
+
+    def __init__(self, db, executor=None):
+        """
+        :param executor: utils.executor.Executor 线程池，默认为共用的 thread_pool，其排队数和耗时计入 executor 指标
+        """
+        self.delegate = db
+        self.executor = executor or thread_pool
+
+    @property
+    def client(self):
+        return self.delegate.client
+
+    def close(self):
+        """ 关闭连接池，在服务停止时调用。共用的线程池由 utils.executor.shutdown_executors 停止 """
+        self.delegate.client.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        return AsyncCollection(self.delegate[name], self.executor)
+
+    def run(self, func, *args, **kwargs):
+        """ 在线程池中执行 func，返回可 await 的 Future """
+        return _submit(self.executor, func, *args, **kwargs)
+
+    def command(self, *args, **kwargs):
+        return self.run(self.delegate.command, *args, **kwargs)
+
+    def list_collection_names(self, **kwargs):
+        return self.run(self.delegate.list_collection_names, **kwargs)
+
+
+class AsyncCollection(object):
+    def __init__(self, collection, executor):
+        self.delegate = collection
+        self.executor = executor
+
+    def __getattr__(self, name):
+        attr = getattr(self.delegate, name)
+        if name in ASYNC_METHODS:
+            return partial(self._run, attr)
+        return attr
+
+    def _run(self, func, *args, **kwargs):
+        return _submit(self.executor, func, *args, **kwargs)
+
+    def find(self, *args, **kwargs):
+        """ 与motor一致，find不访问文档库，在 to_list 或 async for 时才取数据 """
+        return AsyncCursor(self.delegate.find(*args, **kwargs), self.executor)
+
+    def aggregate(self, pipeline, **kwargs):
+        return AsyncCursor(partial(self.delegate.aggregate, pipeline, **kwargs), self.executor)
+
+
+class AsyncCursor(object):
+    def __init__(self, cursor, executor):
+        self._cursor = cursor  # pymongo游标，或延迟执行的aggregate函数
+        self._executor = executor
+        self._buffer = deque()
+        self._batch_size = 100
+
+    def __getattr__(self, name):
+        """ sort、limit、skip等链式调用只修改查询参数，不访问文档库 """
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def chain(*args, **kwargs):
+            attr(*args, **kwargs)
+            return self
+
+        return chain
+
+    def batch_size(self, size):
+        self._batch_size = size
+        if hasattr(self._cursor, 'batch_size'):
+            self._cursor.batch_size(size)
+        return self
+
+    def _fetch(self, length):
+        if callable(self._cursor):
+            self._cursor = self._cursor()
+        return list(islice(self._cursor, length))
+
+    def _run(self, length):
+        return _submit(self._executor, self._fetch, length)
+
+    async def to_list(self, length=None):
+        return await self._run(length)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._buffer:
+            self._buffer = deque(await self._run(self._batch_size))
+            if not self._buffer:
+                raise StopAsyncIteration
+        return self._buffer.popleft()
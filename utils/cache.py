@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 进程内的LRU缓存，及基于它的登录用户缓存和API响应缓存
+@time: 2026/10/18
+"""
+
+import os
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ 限定条数、可设过期秒数的LRU缓存，stats 记录命中(hits)、未命中(misses)、淘汰(evictions)次数 """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()  # key: (过期时刻, value)
+        self.stats = dict(hits=0, misses=0, evictions=0)
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is not None and item[0] and item[0] < time.time():
+            self.pop(key)
+            item = None
+        if item is None:
+            self.stats['misses'] += 1
+            return default
+        self.data.move_to_end(key)
+        self.stats['hits'] += 1
+        return item[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        if key in self.data:
+            self.pop(key)
+        self.data[key] = (ttl and time.time() + ttl, value)
+        while len(self.data) > self.max_size:
+            old_key, (_, old_value) = self.data.popitem(last=False)
+            self.on_remove(old_key, old_value)
+            self.stats['evictions'] += 1
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        if item is None:
+            return default
+        self.on_remove(key, item[1])
+        return item[1]
+
+    def clear(self):
+        self.data.clear()
+
+    def on_remove(self, key, value):
+        """ 缓存项被移除或淘汰时调用，供子类维护索引 """
+        pass
+
+
+class SessionCache(LRUCache):
+    """ 已验证的登录用户缓存，键为原始的 user cookie，值为解码后的用户字典 """
+
+    def __init__(self, max_size=10000, ttl=300):
+        super(SessionCache, self).__init__(max_size, ttl)
+        self.user_keys = {}  # 用户id: 该用户的cookie集合
+
+    def configure(self, max_size=10000, ttl=300):
+        """ 重载配置时调用，缩小 max_size 时立即淘汰多出的缓存项，已缓存项的过期时刻不变 """
+        if not (max_size > 0 and ttl and ttl > 0):
+            raise ValueError('max_size and ttl should be positive')
+        self.max_size, self.ttl = max_size, ttl
+        while len(self.data) > self.max_size:
+            key, (_, user) = self.data.popitem(last=False)
+            self.on_remove(key, user)
+            self.stats['evictions'] += 1
+
+    def set(self, key, user, ttl=None):
+        super(SessionCache, self).set(key, user, ttl)
+        self.user_keys.setdefault(str(user.get('_id')), set()).add(key)
+
+    def on_remove(self, key, user):
+        keys = self.user_keys.get(str(user.get('_id')))
+        if keys:
+            keys.discard(key)
+            if not keys:
+                self.user_keys.pop(str(user.get('_id')))
+
+    def invalidate(self, user_id=None):
+        """ 注销或角色变更时清除该用户的缓存，不指定用户则清除全部 """
+        if user_id is None:
+            self.clear()
+            self.user_keys.clear()
+        else:
+            for key in list(self.user_keys.get(str(user_id), [])):
+                self.pop(key)
+
+
+class ResponseCache(LRUCache):
+    """
+    API响应缓存，值为 (开始生成的时刻, 依赖的集合名, ETag, 响应内容, Content-Type)。
+    数据修改后调用 invalidate 使依赖这些集合的响应失效。多进程时在 path 目录下以集合名命名的文件记录失效时刻，
+    各进程取缓存时比较文件的修改时间。
+    """
+
+    def __init__(self, max_size=1000, ttl=60, path=None):
+        super(ResponseCache, self).__init__(max_size, ttl)
+        self.path = path
+        self.invalidated = {}  # 集合名: 本进程最近一次失效的时刻
+
+    def _invalidated_at(self, collection):
+        t = self.invalidated.get(collection, 0)
+        if self.path:
+            try:
+                t = max(t, os.stat(os.path.join(self.path, collection)).st_mtime)
+            except OSError:
+                pass
+        return t
+
+    def get(self, key, default=None):
+        value = super(ResponseCache, self).get(key)
+        if value is not None and any(self._invalidated_at(c) >= value[0] for c in value[1]):
+            self.pop(key)
+            self.stats['hits'] -= 1
+            self.stats['misses'] += 1
+            value = None
+        return default if value is None else value
+
+    def invalidate(self, *collections):
+        now = time.time()
+        for collection in collections:
+            self.invalidated[collection] = now
+            if self.path:
+                os.makedirs(self.path, exist_ok=True)
+                filename = os.path.join(self.path, collection)
+                with open(filename, 'a'):
+                    pass
+                os.utime(filename, (now, now))
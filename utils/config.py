@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 配置服务：每个进程只解析一次配置文件，保存只读快照；定时检查文件的修改时间，修改后通知订阅了相应配置项的模块
+@time: 2026/10/18
+"""
+
+import logging
+from os import path
+from types import MappingProxyType
+from yaml import load as load_yml, SafeLoader, YAMLError
+from tornado.ioloop import PeriodicCallback
+
+
+def freeze(value):
+    """ 只读的副本：字典为 MappingProxyType，列表为元组 """
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """ 可修改的副本 """
+    if isinstance(value, (dict, MappingProxyType)):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+class ConfigService(object):
+    """
+    base_file 为默认配置，custom_file 为本机的配置(可不存在)，custom_file 中没有的顶层配置项和 ALWAYS_BASE 中的项取自 base_file。
+    subscribe 订阅的配置项修改后调用回调函数，未订阅的配置项修改后需重启工作进程(如 start.sh 滚动重启)才能生效。
+    """
+    ALWAYS_BASE = ('site',)
+
+    def __init__(self, base_file, custom_file):
+        self.files = (base_file, custom_file)
+        self.snapshot = None  # 只读的配置
+        self.subscribers = {}  # 顶层配置项名: [callback]
+        self._mtimes = None
+        self._timer = None
+
+    def _read_mtimes(self):
+        return tuple(path.getmtime(f) if path.exists(f) else None for f in self.files)
+
+    def _parse(self):
+        base, custom = [self._read(f) for f in self.files]
+        for k, v in base.items():
+            if k not in custom or k in self.ALWAYS_BASE:
+                custom[k] = v
+        return freeze(custom)
+
+    @staticmethod
+    def _read(filename):
+        if not path.exists(filename):
+            return {}
+        with open(filename, encoding='utf-8') as f:
+            return load_yml(f, Loader=SafeLoader) or {}
+
+    def get(self):
+        """ 返回只读的配置快照，首次调用时解析配置文件 """
+        if self.snapshot is None:
+            self._mtimes = self._read_mtimes()
+            self.snapshot = self._parse()
+        return self.snapshot
+
+    def load(self):
+        """ 返回可修改的配置副本，如每个 Application 对象各有一份 """
+        return thaw(self.get())
+
+    def subscribe(self, key, callback):
+        """ 顶层配置项 key 修改后调用 callback(新值, 旧值)，值为只读快照 """
+        self.subscribers.setdefault(key, []).append(callback)
+
+    def unsubscribe(self, key, callback):
+        callbacks = self.subscribers.get(key) or []
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    def check(self):
+        """ 配置文件修改后重新解析并通知订阅者，返回修改了的顶层配置项名 """
+        mtimes = self._read_mtimes()
+        if self.snapshot is None or mtimes == self._mtimes:
+            return []
+        self._mtimes = mtimes
+        try:
+            new = self._parse()
+        except (OSError, YAMLError) as err:
+            logging.error('fail to reload the config, keep the old one: %s' % str(err))
+            return []
+
+        old, self.snapshot = self.snapshot, new
+        changed = sorted(k for k in set(old) | set(new) if old.get(k) != new.get(k))
+        for key in changed:
+            callbacks = self.subscribers.get(key)
+            if not callbacks:
+                logging.warning('config %s is changed, restart the workers to apply it' % key)
+            for callback in list(callbacks or []):
+                try:
+                    callback(new.get(key), old.get(key))
+                except Exception:
+                    logging.exception('fail to apply the config %s' % key)
+            if callbacks:
+                logging.info('config %s is reloaded' % key)
+        return changed
+
+    def start(self, interval=5):
+        """ 在各工作进程中每隔 interval 秒检查配置文件的修改时间 """
+        if interval and not self._timer:
+            self.get()
+            self._timer = PeriodicCallback(self.check, interval * 1000)
+            self._timer.start()
+
+    def stop(self):
+        if self._timer:
+            self._timer.stop()
+            self._timer = None
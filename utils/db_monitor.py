@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 监控文档库命令：按请求统计命令数、耗时和文档数，记录慢命令的查询结构，按需记录慢查询的执行计划
+@time: 2026/10/18
+"""
+
+import json
+import logging
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+from bson.son import SON
+from utils.cache import LRUCache
+
+try:
+    import contextvars
+except ImportError:  # Python 3.6 没有 contextvars，不按请求统计
+    contextvars = None
+
+_current = contextvars and contextvars.ContextVar('db_stats', default=None)
+
+# 可 explain 的命令及其查询条件所在的字段
+FILTER_FIELDS = dict(find='filter', count='query', distinct='query', findAndModify='query', aggregate='pipeline')
+WRITE_COMMANDS = ('update', 'delete')  # 慢命令也记录查询结构，但不 explain
+
+
+class RequestStats(object):
+    """ 一个请求的文档库命令数(count)、耗时(time_ms)和返回或修改的文档数(docs) """
+    __slots__ = ('count', 'time_ms', 'docs', 'done')
+
+    def __init__(self):
+        self.count, self.time_ms, self.docs, self.done = 0, 0.0, 0, False
+
+    def add(self, duration_ms, docs):
+        self.count += 1
+        self.time_ms += duration_ms
+        self.docs += docs
+
+
+def start_request():
+    """ 在请求开始时调用，此后在本请求中(包括经 bind 提交到线程池的调用)执行的命令计入返回的统计对象 """
+    if _current is not None:
+        stats = RequestStats()
+        _current.set(stats)
+        return stats
+
+
+def bind(fn):
+    """ 返回在调用者的上下文中执行 fn 的函数，提交到线程池时使用，以便线程中执行的命令计入当前请求 """
+    return partial(contextvars.copy_context().run, fn) if contextvars else fn
+
+
+def filter_shape(value):
+    """ 查询条件的结构，各值替换为 ?，如 {"user_id": "?", "time": {"$gt": "?"}} """
+    if isinstance(value, dict):
+        return {k: filter_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)) and any(isinstance(v, dict) for v in value):
+        return [filter_shape(v) for v in value]
+    return '?'
+
+
+def command_filter(name, command):
+    if name in ('update', 'delete'):
+        ops = command.get(name + 's') or [{}]
+        return ops[0].get('q')
+    value = command.get(FILTER_FIELDS.get(name, ''))
+    if name == 'aggregate':  # 只取第一个 $match
+        value = next((s['$match'] for s in value or [] if isinstance(s, dict) and '$match' in s), None)
+    return value
+
+
+def count_docs(name, reply):
+    cursor = reply.get('cursor')
+    if cursor:
+        return len(cursor.get('firstBatch') or cursor.get('nextBatch') or [])
+    if name == 'distinct':
+        return len(reply.get('values') or [])
+    if name == 'findAndModify':
+        return 1 if reply.get('value') else 0
+    return reply.get('n') or 0
+
+
+def plan_summary(plan):
+    """ 执行计划的各阶段，如 FETCH > IXSCAN {"user_id": 1}，COLLSCAN 表示全表扫描 """
+    stages = []
+    while plan:
+        stage = plan.get('stage', '?')
+        if plan.get('keyPattern'):
+            stage += ' ' + json.dumps(plan['keyPattern'])
+        stages.append(stage)
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+    return ' > '.join(stages)
+
+
+class CommandMonitor(monitoring.CommandListener):
+    """
+    命令监听器，在执行命令的线程中被调用。各命令计入当前请求的 RequestStats，
+    耗时超过 slow_ms 的命令记录查询结构；explain_slow 为 True 时在后台对慢查询执行 explain，
+    同一查询结构每 explain_interval 秒最多一次，选中的执行计划记录在日志和 plans 中。
+    设置了 metrics 时按命令名记录耗时 mongo_command_ms。
+    """
+
+    def __init__(self, slow_ms=100, explain_slow=False, explain_interval=600, metrics=None):
+        self.slow_ms = slow_ms
+        self.explain_slow = explain_slow
+        self.metrics = metrics
+        self.client = None  # 执行 explain 的 MongoClient，由调用者设置
+        self.plans = LRUCache(1000, explain_interval)  # (库名, 集合名, 命令名, 查询结构): 执行计划摘要
+        self.stats = dict(commands=0, slow=0, failed=0, explained=0)
+        self._pending = {}  # (request_id, connection_id): (开始时的请求统计, 库名, 命令)
+        self._lock = threading.Lock()
+        self._explainer = None
+
+    def started(self, event):
+        stats = _current.get() if _current is not None else None
+        command = event.command if event.command_name in FILTER_FIELDS or event.command_name in WRITE_COMMANDS else None
+        self._pending[(event.request_id, event.connection_id)] = (
+            stats if stats and not stats.done else None, event.database_name, command)
+
+    def succeeded(self, event):
+        self._finish(event, count_docs(event.command_name, event.reply))
+
+    def failed(self, event):
+        with self._lock:
+            self.stats['failed'] += 1
+        self._finish(event, 0)
+
+    def _finish(self, event, docs):
+        stats, db_name, command = self._pending.pop((event.request_id, event.connection_id), (None, None, None))
+        duration = event.duration_micros / 1000.0
+        if stats:
+            stats.add(duration, docs)
+        if self.metrics:
+            self.metrics.observe('mongo_command_ms', duration, command=event.command_name)
+        with self._lock:
+            self.stats['commands'] += 1
+            if duration < self.slow_ms or command is None:
+                return
+            self.stats['slow'] += 1
+        collection = command.get(event.command_name)
+        shape = json.dumps(filter_shape(command_filter(event.command_name, command)), sort_keys=True)
+        logging.warning('slow db command %s %s.%s %.1fms docs=%d filter=%s' % (
+            event.command_name, db_name, collection, duration, docs, shape))
+        if self.explain_slow and self.client and event.command_name in FILTER_FIELDS:
+            self._explain_later((db_name, collection, event.command_name, shape), command)
+
+    def _explain_later(self, key, command):
+        with self._lock:
+            if self.plans.get(key) is not None:
+                return
+            self.plans.set(key, '')  # 执行中，避免重复 explain
+            if not self._explainer:
+                self._explainer = ThreadPoolExecutor(1, thread_name_prefix='explain')
+        command = SON((k, v) for k, v in command.items() if not k.startswith('$') and k not in ('lsid', 'txnNumber'))
+        self._explainer.submit(self._explain, key, command)
+
+    def _explain(self, key, command):
+        try:
+            result = self.client[key[0]].command('explain', command, verbosity='queryPlanner')
+            plan = plan_summary(result.get('queryPlanner', {}).get('winningPlan'))
+        except PyMongoError as err:
+            plan = 'explain failed: %s' % str(err)
+        with self._lock:
+            self.plans.set(key, plan)
+            self.stats['explained'] += 1
+        logging.warning('plan of %s %s.%s filter=%s: %s' % (key[2], key[0], key[1], key[3], plan))
+
+    def close(self):
+        if self._explainer:
+            self._explainer.shutdown(wait=False)
+            self._explainer = None
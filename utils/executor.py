@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 共用的线程池和进程池，将阻塞调用(如pymongo查询)和耗CPU的计算移出IOLoop，并统计排队数和排队、执行耗时
+@time: 2026/10/18
+"""
+
+import os
+import time
+import functools
+import importlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from tornado.ioloop import IOLoop
+from utils.db_monitor import bind
+
+
+def cpu_count():
+    """ 本进程可用的CPU数 """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _timed_call(fn, args, kwargs):
+    """ 在线程或子进程中执行，返回开始时刻，以便计算排队耗时 """
+    return time.time(), fn(*args, **kwargs)
+
+
+def _call_wrapped(module, qualname, args, kwargs):
+    """ cpu_bound 修饰的函数在子进程中按模块和名称找到原函数执行 """
+    obj = importlib.import_module(module)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+    return obj.__wrapped__(*args, **kwargs)
+
+
+class Executor(object):
+    """
+    线程池或进程池的封装，首次使用时才创建(进程池须在fork工作进程之后创建)。
+    stats 记录正在执行和排队的任务数(in_flight、queued)、累计完成(completed)和出错(failed)的任务数，
+    设置了 metrics 时按 pool 标签记录排队耗时 executor_wait_ms 和执行耗时 executor_run_ms。
+    """
+    KINDS = ('thread', 'process')
+
+    def __init__(self, kind, max_workers=1, metrics=None):
+        assert kind in self.KINDS, 'kind should be in %s' % str(self.KINDS)
+        self.kind = kind
+        self.max_workers = max_workers
+        self.metrics = metrics
+        self._executor = None
+        self.in_flight = 0
+        self._counts = dict(completed=0, failed=0)
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.kind == 'thread':
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='blocking')
+            else:
+                self._executor = ProcessPoolExecutor(self.max_workers)
+        return self._executor
+
+    @property
+    def stats(self):
+        return dict(self._counts, in_flight=self.in_flight, queued=max(0, self.in_flight - self.max_workers))
+
+    async def run(self, fn, *args, **kwargs):
+        """ 在池中执行 fn(*args, **kwargs) 并返回结果。进程池中执行时 fn 和参数须可pickle，如模块级的函数 """
+        submitted = time.time()
+        self.in_flight += 1
+        try:
+            call = bind(_timed_call) if self.kind == 'thread' else _timed_call  # 线程中的文档库命令计入当前请求
+            started, result = await IOLoop.current().run_in_executor(self.executor, call, fn, args, kwargs)
+        except Exception:
+            self._counts['failed'] += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        self._counts['completed'] += 1
+        if self.metrics:
+            now = time.time()
+            self.metrics.observe('executor_wait_ms', max(0.0, started - submitted) * 1000, pool=self.kind)
+            self.metrics.observe('executor_run_ms', (now - started) * 1000, pool=self.kind)
+        return result
+
+    def resize(self, max_workers):
+        """ 修改池的大小，大小改变时才停止原有的池，下次使用时按新的大小创建 """
+        if max_workers != self.max_workers:
+            self.shutdown()
+            self.max_workers = max_workers
+
+    def shutdown(self):
+        """ 停止池，不等待已提交的任务(任务仍会执行完)，以免阻塞 IOLoop """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+thread_pool = Executor('thread')
+process_pool = Executor('process')
+
+
+def configure_executors(thread_workers=0, process_workers=0, num_processes=1, metrics=None):
+    """
+    设置线程池和进程池的大小，为0时按CPU数自动确定：
+    线程池用于阻塞的IO，默认为 min(32, CPU数 + 4)；进程池用于计算，默认为 CPU数 / 工作进程数，使各工作进程的进程池合计不超过CPU数
+    每次创建 Application 都会调用，池的大小不变时继续使用已创建的池
+    :param num_processes: 本机的工作进程数
+    """
+    cores = cpu_count()
+    thread_pool.resize(thread_workers or min(32, cores + 4))
+    process_pool.resize(process_workers or max(1, cores // max(1, num_processes)))
+    thread_pool.metrics = process_pool.metrics = metrics
+
+
+def shutdown_executors():
+    thread_pool.shutdown()
+    process_pool.shutdown()
+
+
+def executor_stats():
+    stats = {'thread_' + k: v for k, v in thread_pool.stats.items()}
+    stats.update({'process_' + k: v for k, v in process_pool.stats.items()})
+    return stats
+
+
+def blocking(fn):
+    """ 修饰阻塞的函数或方法，调用时在线程池中执行，返回可 await 的结果 """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return thread_pool.run(fn, *args, **kwargs)
+
+    return wrapper
+
+
+def cpu_bound(fn):
+    """ 修饰模块级的计算函数，调用时在进程池中执行，返回可 await 的结果。参数和返回值须可pickle """
+    if '<locals>' in fn.__qualname__:
+        raise ValueError('cpu_bound should decorate a module-level function: %s' % fn.__qualname__)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return process_pool.run(_call_wrapped, fn.__module__, fn.__qualname__, args, kwargs)
+
+    return wrapper
@@ -4,9 +4,7 @@
 @desc: 加载app.yml、连接数据库、常用实用函数
 @time: 2019/11/6
 """
-from tornado.util import PY3
 from os import path
-from yaml import load as load_yml, SafeLoader
 import pymongo
 
 from hashids import Hashids
@@ -14,45 +12,58 @@ from datetime import datetime, timedelta
 import inspect
 import logging
 import re
+from utils.config import ConfigService
 
 BASE_DIR = path.dirname(path.dirname(__file__))
+config_service = ConfigService(path.join(BASE_DIR, '_app.yml'), path.join(BASE_DIR, 'app.yml'))
 
 
 def load_config():
-    param = dict(encoding='utf-8') if PY3 else {}
-    cfg_base = path.join(BASE_DIR, '_app.yml')
-    cfg_file = path.join(BASE_DIR, 'app.yml')
-    config = {}
-
-    with open(cfg_base, **param) as f:
-        config_base = load_yml(f, Loader=SafeLoader)
-    if path.exists(cfg_file):
-        with open(cfg_file, **param) as f:
-            config = load_yml(f, Loader=SafeLoader)
-    else:
-        with open(cfg_file, 'w') as f:
-            f.write('todo:')
-    for k, v in config_base.items():
-        if k not in config or k in ['site']:
-            config[k] = v
-
-    return config
-
-
-def connect_db(cfg):
+    """ 返回可修改的配置副本，配置文件每个进程只解析一次，见 utils.config """
+    return config_service.load()
+
+
+def get_db_uri(cfg):
+    """ hosts 为多个主机(如副本集的各成员)的列表，每项为 主机 或 主机:端口，不指定时用 host 和 port """
+    hosts = ','.join(cfg.get('hosts') or []) or '{0}:{1}'.format(cfg.get('host'), cfg.get('port', 27017))
     if cfg.get('user'):
-        uri = 'mongodb://{0}:{1}@{2}:{3}/admin'.format(
-            cfg.get('user'), cfg.get('password'), cfg.get('host'), cfg.get('port', 27017)
-        )
-    else:
-        uri = 'mongodb://{0}:{1}/'.format(cfg.get('host'), cfg.get('port', 27017))
-    conn = pymongo.MongoClient(
-        uri, connectTimeoutMS=2000, serverSelectionTimeoutMS=2000,
-        maxPoolSize=10, waitQueueTimeoutMS=5000
-    )
+        return 'mongodb://{0}:{1}@{2}/admin'.format(cfg.get('user'), cfg.get('password'), hosts)
+    return 'mongodb://{0}/'.format(hosts)
+
+
+DB_OPTIONS = dict(connectTimeoutMS=2000, serverSelectionTimeoutMS=2000, maxPoolSize=10, waitQueueTimeoutMS=5000)
+
+
+def db_options(cfg):
+    """ MongoClient 的参数：DB_OPTIONS 加上 database.options 中的设置(连接池大小、等待队列、压缩、读偏好等) """
+    return dict(DB_OPTIONS, **(cfg.get('options') or {}))
+
+
+def connect_db(cfg, event_listeners=None):
+    uri = get_db_uri(cfg)
+    conn = pymongo.MongoClient(uri, event_listeners=event_listeners or [], **db_options(cfg))
     return conn[cfg['name']], uri
 
 
+def connect_db_async(cfg, db=None, event_listeners=None):
+    """
+    连接文档库，返回可 await 访问的数据库对象
+    :param cfg: app.yml 中的 database 配置，async_driver 为 motor 或 thread
+    :param db: 已连接的pymongo数据库，thread 方式时在线程池中调用它，以共用连接池
+    """
+    uri, options = get_db_uri(cfg), db_options(cfg)
+    if cfg.get('async_driver', 'motor') == 'motor':
+        try:
+            from motor.motor_tornado import MotorClient
+            return MotorClient(uri, event_listeners=event_listeners or [], **options)[cfg['name']], uri
+        except ImportError:
+            logging.warning('motor is not installed, use thread driver instead')
+
+    from utils.async_db import AsyncDatabase
+    db = db or connect_db(cfg, event_listeners)[0]
+    return AsyncDatabase(db), uri
+
+
 def prop(obj, key, default=None):
     for s in key.split('.'):
         obj = obj.get(s) if isinstance(obj, dict) else None
@@ -2,28 +2,143 @@
 # -*- coding: utf-8 -*-
 
 import re
+import os
 import uuid
+import logging
 import traceback
 import mimetypes
-from tornado import gen
+from io import BytesIO
+from datetime import timedelta
+from tornado import gen, locks
 from bson import json_util
 import http.cookies as Cookie
 from functools import partial
+from urllib.parse import urlsplit
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
 from tornado.escape import to_basestring, native_str
-from tornado.httpclient import HTTPError, HTTPRequest
+from tornado.httputil import HTTPHeaders, HTTPServerRequest, RequestStartLine
+from tornado.httpclient import HTTPError, HTTPRequest, HTTPResponse
 from tornado.httpclient import AsyncHTTPClient, HTTPClient
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from utils.executor import thread_pool
 
 global_cookie = Cookie.SimpleCookie()
 
+# 调用API的默认设置，由 configure_client 按 app.yml 的 http_client 修改
+client_options = dict(connect_timeout=5, request_timeout=10, max_per_host=0, chunk_size=256 * 1024)
+_host_semaphores = {}
+LOOPBACK_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+
+def configure_client(backend='simple', max_clients=10, max_per_host=0, connect_timeout=5, request_timeout=10,
+                     chunk_size=256 * 1024, **kwargs):
+    """
+    设置本进程调用API的 AsyncHTTPClient，需在首次调用API前执行
+    :param backend: simple 为Tornado自带的客户端，curl 为基于pycurl的客户端(复用长连接)，未安装pycurl时用 simple
+    :param max_clients: 同时进行的请求数，超过的请求排队等待
+    :param max_per_host: 对同一主机同时进行的请求数，0表示不限制
+    :param chunk_size: 上传文件时每次读取和发送的字节数
+    :param kwargs: 其他配置项(如 loopback)，由调用方使用
+    """
+    impl = None
+    if backend == 'curl':
+        try:
+            import pycurl  # noqa: F401
+            impl = 'tornado.curl_httpclient.CurlAsyncHTTPClient'
+        except ImportError:
+            logging.warning('pycurl is not installed, use the simple http client')
+    client_options.update(connect_timeout=connect_timeout, request_timeout=request_timeout,
+                          max_per_host=max_per_host, chunk_size=chunk_size)
+    _host_semaphores.clear()
+    AsyncHTTPClient.configure(impl, max_clients=max_clients,
+                              defaults=dict(connect_timeout=connect_timeout, request_timeout=request_timeout))
+
+
+def _client_for(request, client=None):
+    """ curl客户端不支持 body_producer，上传文件时改用 simple 客户端 """
+    client = client or AsyncHTTPClient()
+    if request.body_producer and not isinstance(client, SimpleAsyncHTTPClient):
+        return SimpleAsyncHTTPClient()
+    return client
+
+
+def _host_semaphore(url):
+    if client_options['max_per_host']:
+        host = urlsplit(url).netloc
+        if host not in _host_semaphores:
+            _host_semaphores[host] = locks.Semaphore(client_options['max_per_host'])
+        return _host_semaphores[host]
+
+
+class _LoopbackConnection(object):
+    """ 站内直接调用API时代替网络连接，收集响应内容 """
+
+    class context(object):
+        remote_ip = '127.0.0.1'
+        protocol = 'http'
+
+    def __init__(self):
+        self.code, self.reason, self.headers = 500, None, HTTPHeaders()
+        self.chunks = []
+        self.finished = Future()
+
+    def set_close_callback(self, callback):
+        pass
+
+    def set_max_body_size(self, max_body_size):
+        pass
+
+    def _done(self, callback=None):
+        if callback:
+            callback()
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def write_headers(self, start_line, headers, chunk=None, callback=None):
+        self.code, self.reason, self.headers = start_line.code, start_line.reason, headers
+        return self.write(chunk, callback)
+
+    def write(self, chunk, callback=None):
+        if chunk:
+            self.chunks.append(chunk)
+        return self._done(callback)
+
+    def finish(self):
+        if not self.finished.done():
+            self.finished.set_result(None)
+
+
+@gen.coroutine
+def _fetch_local(app, request):
+    """ 不经过网络，直接由本进程的 Application 处理请求 """
+    conn = _LoopbackConnection()
+    headers = HTTPHeaders(request.headers)
+    headers.pop('Content-Length', None)
+    parts = urlsplit(request.url)
+    uri = parts.path + ('?' + parts.query if parts.query else '')
+    server_request = HTTPServerRequest(request.method, uri, headers=headers, connection=conn)
+    delegate = app.find_handler(server_request)
+    start_line = RequestStartLine(server_request.method, uri, 'HTTP/1.1')
+    yield delegate.headers_received(start_line, headers)  # 流式接收请求体的API在此执行 prepare
+    if request.body:
+        yield delegate.data_received(request.body)
+    delegate.finish()
+    yield gen.with_timeout(timedelta(seconds=request.request_timeout), conn.finished)
+    return HTTPResponse(request, conn.code, headers=conn.headers, buffer=BytesIO(b''.join(conn.chunks)),
+                        reason=conn.reason, request_time=server_request.request_time())
+
 
 @gen.coroutine
-def call_api_async(url, headers, handle_response, handle_error=None, **kwargs):
+def call_api_async(url, headers, handle_response, handle_error=None, app=None, **kwargs):
     """
     异步调用本站或外部的API，可传文件和字典数据
     :param url: API地址，绝对地址或站内相对地址
     :param headers: self.request.headers
     :param handle_response: 调用成功后的结果回调函数，必须指定，函数的字典参数里有data或error成员
     :param handle_error: 调用失败的回调函数，函数参数为错误描述文本，不指定则抛出ValueError异常
+    :param app: 指定本站的 Application 时，站内相对地址(且不传文件)的API直接在本进程处理，不经过网络
     :param kwargs: 更多参数，可指定files、body、binary_response、params、error_code、connect_timeout、request_timeout 等参数
     :return: None
     """
@@ -37,11 +152,24 @@ def call_api_async(url, headers, handle_response, handle_error=None, **kwargs):
     if handle_error is None:
         handle_error = _error
     error_code = kwargs.pop('error_code', 500)
-    request, binary_res, params_for_handler = _create_request(url, headers, **kwargs)
-    client = AsyncHTTPClient()
+    local = app and not re.match(r'http(s)?://', url) and 'files' not in kwargs
+    if local:
+        url = 'http://%s%s' % (headers.get('Host') or '127.0.0.1', url)
     try:
-        yield client.fetch(request, callback=callback)
-    except (OSError, HTTPError) as err_con:
+        request, binary_res, params_for_handler = _create_request(url, headers, **kwargs)
+    except OSError as err:  # 上传的文件不存在或不可读
+        return handle_error('无法读取上传的文件: ' + str(err))
+    try:
+        if local:
+            callback((yield _fetch_local(app, request)))
+            return
+        semaphore = _host_semaphore(url)
+        if semaphore:
+            with (yield semaphore.acquire()):
+                yield _client_for(request).fetch(request, callback=callback)
+        else:
+            yield _client_for(request).fetch(request, callback=callback)
+    except (OSError, HTTPError, gen.TimeoutError) as err_con:
         handle_error('服务无响应: ' + str(err_con))
 
 
@@ -58,8 +186,11 @@ def call_api_sync(url, handle_response=None, handle_error=None, **kwargs):
     headers = kwargs.get('headers', {})
     cookie = kwargs.pop('cookie', global_cookie)
     headers['Cookie'] = ''.join(['%s=%s;' % (x, morsel.value) for (x, morsel) in cookie.items()])
-    request, binary_res, params_for_handler = _create_request(url, headers, **kwargs)
-    client = HTTPClient()
+    try:
+        request, binary_res, params_for_handler = _create_request(url, headers, **kwargs)
+    except OSError as err:  # 上传的文件不存在或不可读
+        return handle_error(err) if handle_error else err
+    client = HTTPClient(SimpleAsyncHTTPClient if request.body_producer else None)
     try:
         response = client.fetch(request)
         ret = _handle_response(response, handle_response or (lambda r: r), handle_error or (lambda r: r),
@@ -71,9 +202,74 @@ def call_api_sync(url, handle_response=None, handle_error=None, **kwargs):
     return ret
 
 
+def call_api_many(requests, concurrency=10, progress=None, **kwargs):
+    """
+    同步并发调用多个外部API，在批量同步数据等外部脚本中使用，参数和返回值见 call_api_many_async
+    """
+    io_loop = IOLoop()
+    try:
+        return io_loop.run_sync(partial(call_api_many_async, requests, concurrency, progress, **kwargs))
+    finally:
+        io_loop.close()
+
+
+@gen.coroutine
+def call_api_many_async(requests, concurrency=10, progress=None, handle_response=None, handle_error=None,
+                        cookie=None):
+    """
+    并发调用多个外部API，各请求共用一个HTTP客户端，同时进行的请求不超过 concurrency 个
+    :param requests: API请求列表，每项为API地址，或含url成员的字典(其余成员同 call_api_sync 的参数)
+    :param concurrency: 同时进行的请求数
+    :param progress: 每完成一个请求后的回调函数，参数为 (已完成数, 总数, 请求序号, 结果)
+    :param handle_response: 调用成功后对结果的转换函数，不指定则直接返回结果
+    :param handle_error: 调用失败后对错误的转换函数，不指定则直接返回错误描述文本或异常对象
+    :param cookie: 各请求使用的cookie，默认为 call_api_sync 共用的cookie
+    :return: 与 requests 顺序一致的结果列表，单个请求失败不影响其他请求
+    """
+    items = [dict(url=r) if isinstance(r, str) else dict(r) for r in requests]
+    results = [None] * len(items)
+    cookie = ''.join(['%s=%s;' % (x, morsel.value) for (x, morsel) in (cookie or global_cookie).items()])
+    handle_response, handle_error = handle_response or (lambda r: r), handle_error or (lambda r: r)
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    pending = iter(range(len(items)))
+    done = [0]
+
+    @gen.coroutine
+    def fetch(index):
+        kwargs = items[index]
+        url = kwargs.pop('url')
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers.setdefault('Cookie', cookie)
+        try:
+            request, binary_res, params_for_handler = _create_request(url, headers, **kwargs)
+            semaphore = _host_semaphore(url)
+            if semaphore:
+                with (yield semaphore.acquire()):
+                    response = yield _client_for(request, client).fetch(request, raise_error=False)
+            else:
+                response = yield _client_for(request, client).fetch(request, raise_error=False)
+            return _handle_response(response, handle_response, handle_error, binary_res, params_for_handler)
+        except Exception as err:
+            return handle_error(err)
+
+    @gen.coroutine
+    def worker():
+        for index in pending:
+            results[index] = yield fetch(index)
+            done[0] += 1
+            if progress:
+                progress(done[0], len(items), index, results[index])
+
+    try:
+        yield [worker() for _ in range(min(concurrency, len(items)))]
+    finally:
+        client.close()
+    return results
+
+
 def _create_request(url, headers, **kwargs):
-    kwargs['connect_timeout'] = kwargs.get('connect_timeout', 5)
-    kwargs['request_timeout'] = kwargs.get('request_timeout', 10)
+    kwargs['connect_timeout'] = kwargs.get('connect_timeout', client_options['connect_timeout'])
+    kwargs['request_timeout'] = kwargs.get('request_timeout', client_options['request_timeout'])
     kwargs['method'] = kwargs.get('method', 'POST' if 'body' in kwargs or 'files' in kwargs else 'GET')
 
     # 设置cookie
@@ -90,8 +286,13 @@ def _create_request(url, headers, **kwargs):
     files = kwargs.pop('files', None)
     if files:
         boundary = uuid.uuid4().hex
-        headers.update({'Content-Type': 'multipart/form-data; boundary=%s' % boundary})
-        producer = partial(body_producer, boundary, files, kwargs.pop('body', {}))
+        params = kwargs.pop('body', {})
+        headers.update({'Content-Type': 'multipart/form-data; boundary=%s' % boundary,
+                        'Content-Length': str(multipart_length(boundary, files, params))})
+        producer = partial(body_producer, boundary, files, params, chunk_size=kwargs.pop('chunk_size', None))
+        # 上传到本站(本机地址)时先发送请求头，服务端接受后再发送文件，以便服务端按Content-Length提前拒绝超限的上传。
+        # 外部服务器或代理可能不回复100 Continue，Tornado的客户端会一直等到超时，默认不启用
+        kwargs['expect_100_continue'] = kwargs.get('expect_100_continue', urlsplit(url).hostname in LOOPBACK_HOSTS)
         request = HTTPRequest(url, headers=headers, body_producer=producer, validate_cert=False, **kwargs)
     else:
         request = HTTPRequest(url, headers=headers, validate_cert=False, **kwargs)
@@ -145,34 +346,46 @@ def _handle_body(body, params_for_handler, handle_response, handle_error):
             return handle_response(body, **params_for_handler)
 
 
-def body_producer(boundary, files, params, write):
-    boundary_bytes = boundary.encode()
-    cr_lf = b'\r\n'
+def _file_header(boundary, arg_name, filename):
+    m_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    return b'--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: %s\r\n\r\n' % (
+        boundary.encode(), arg_name.encode(), filename.encode(), m_type.encode())
 
-    for arg_name in files:
-        filename = files[arg_name]
-        filename_bytes = filename.encode()
-        write(b'--%s%s' % (boundary_bytes, cr_lf))
-        write(b'Content-Disposition: form-data; name="%s"; filename="%s"%s' %
-              (arg_name.encode(), filename_bytes, cr_lf))
-        m_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-        write(b'Content-Type: %s%s' % (m_type.encode(), cr_lf))
-        write(cr_lf)
-        with open(filename, 'rb') as f:
-            while True:
-                chunk = f.read(16 * 1024)
-                if not chunk:
-                    break
-                write(chunk)
-        write(cr_lf)
 
+def _params_body(boundary, params):
+    """ 字典参数各部分和结束分隔符 """
     params = json_util.loads(params) if isinstance(params, str) else params
     assert isinstance(params, dict)
-    for arg_name in params:
-        value = params[arg_name]
+    parts = []
+    for arg_name, value in params.items():
         value = json_util.dumps(value) if isinstance(value, dict) else str(value)
-        write(b'--%s%s' % (boundary_bytes, cr_lf))
-        write(b'Content-Disposition: form-data; name="%s"{}{}%s{}'.replace(b'{}', cr_lf) %
-              (arg_name.encode(), value.encode()))
+        parts.append(b'--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (
+            boundary.encode(), arg_name.encode(), value.encode()))
+    parts.append(b'--%s--\r\n' % boundary.encode())
+    return b''.join(parts)
+
+
+def multipart_length(boundary, files, params):
+    """ 预先计算multipart请求体的字节数，作为Content-Length发送，避免分块传输 """
+    length = len(_params_body(boundary, params))
+    for arg_name, filename in files.items():
+        length += len(_file_header(boundary, arg_name, filename)) + os.path.getsize(filename) + 2
+    return length
 
-    write(b'--%s--%s' % (boundary_bytes, cr_lf))
+
+async def body_producer(boundary, files, params, write, chunk_size=None):
+    """
+    发送multipart请求体。文件在线程池中逐块读取，每块等写入完成后再读下一块，不阻塞IOLoop，内存占用只与 chunk_size 有关
+    :param chunk_size: 每次读取和发送的字节数，默认为 configure_client 设置的 chunk_size
+    """
+    chunk_size = chunk_size or client_options['chunk_size']
+    for arg_name, filename in files.items():
+        await write(_file_header(boundary, arg_name, filename))
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = await thread_pool.run(f.read, chunk_size)
+                if not chunk:
+                    break
+                await write(chunk)
+        await write(b'\r\n')
+    await write(_params_body(boundary, params))
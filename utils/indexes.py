@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 索引登记表：各模块用 add_index 声明所用集合的索引、用 add_query 声明查询方式，
+启动时在后台创建缺少的索引并报告未登记、未使用的索引，检查模式下报告没有索引可用的查询方式
+@time: 2026/10/18
+"""
+
+import logging
+from collections import namedtuple
+from pymongo.errors import OperationFailure
+
+Index = namedtuple('Index', 'keys name options')
+Query = namedtuple('Query', 'fields sort')
+
+
+def _keys(keys):
+    """ 字段名、(字段名, 方向) 或其列表，统一为 [(字段名, 方向)] """
+    keys = [keys] if isinstance(keys, (str, tuple)) else keys
+    return [(k, 1) if isinstance(k, str) else tuple(k) for k in keys]
+
+
+def index_name(keys):
+    """ 与MongoDB的默认索引名一致，如 user_id_1_create_time_-1 """
+    return '_'.join('%s_%s' % (k, d) for k, d in keys)
+
+
+class IndexRegistry(object):
+    def __init__(self):
+        self.indexes = {}  # 集合名: {索引名: Index}
+        self.queries = {}  # 集合名: [Query]
+
+    def add_index(self, collection, keys, unique=False, ttl=None, partial=None, name=None):
+        """
+        声明索引，同名的索引以后声明的为准
+        :param keys: 字段名、(字段名, 方向) 或其列表
+        :param ttl: 秒数，设置时为TTL索引，文档在 keys 的时间字段之后 ttl 秒被删除
+        :param partial: 部分索引的过滤条件，只为满足条件的文档建索引
+        """
+        keys = _keys(keys)
+        options = dict(unique=unique) if unique else {}
+        if ttl is not None:
+            options['expireAfterSeconds'] = ttl
+        if partial:
+            options['partialFilterExpression'] = partial
+        name = name or index_name(keys)
+        self.indexes.setdefault(collection, {})[name] = Index(keys, name, options)
+
+    def add_query(self, collection, *fields, sort=None):
+        """ 声明查询方式：按 fields 各字段等值查询，按 sort 排序，检查模式下确认有索引可用 """
+        self.queries.setdefault(collection, []).append(Query(set(fields), _keys(sort or [])))
+
+    def reconcile(self, db, create=True):
+        """
+        比较登记的索引和文档库中的索引，create 为 True 时在后台创建缺少的索引(不删除索引)
+        :return: 各集合的 created(已创建或缺少的)、conflict(同名但字段或选项不同)、unregistered(未登记的)、
+                 unused(自服务器启动以来未被查询使用过的)索引名列表
+        """
+        report = {}
+        for collection, indexes in sorted(self.indexes.items()):
+            existing = db[collection].index_information()
+            result = report[collection] = dict(created=[], conflict=[], unregistered=[], unused=[])
+            by_keys = {tuple(_keys(info['key'])): name for name, info in existing.items()}
+            matched = set()
+            for name, index in indexes.items():
+                name = name if name in existing else by_keys.get(tuple(index.keys), name)  # 已有同样字段的索引
+                info = existing.get(name)
+                matched.add(name)
+                if info is None:
+                    if create:
+                        db[collection].create_index(index.keys, name=name, background=True, **index.options)
+                    result['created'].append(name)
+                elif _keys(info['key']) != index.keys or any(info.get(k) != v for k, v in index.options.items()):
+                    result['conflict'].append(name)
+            result['unregistered'] = sorted(set(existing) - matched - {'_id_'})
+            result['unused'] = self._unused(db[collection])
+        return report
+
+    @staticmethod
+    def _unused(collection):
+        try:
+            stats = list(collection.aggregate([{'$indexStats': {}}]))
+        except OperationFailure:  # MongoDB 3.2 以下或没有权限
+            return []
+        return sorted(s['name'] for s in stats if s['name'] != '_id_' and not s['accesses']['ops'])
+
+    def check(self, db=None):
+        """ 返回没有索引可用的查询方式 [(集合名, Query)]。db 不为空时也考虑文档库中已有的索引 """
+        missing = []
+        for collection, queries in sorted(self.queries.items()):
+            keys = [index.keys for index in self.indexes.get(collection, {}).values()] + [[('_id', 1)]]
+            if db is not None:
+                keys += [_keys(info['key']) for info in db[collection].index_information().values()]
+            missing += [(collection, q) for q in queries if not any(covers(k, q) for k in keys)]
+        return missing
+
+
+def covers(keys, query):
+    """ 索引的前几个字段为等值查询的各字段(顺序不限)、其后为排序字段(方向全相同或全相反)时，查询和排序都可用索引 """
+    n = len(query.fields)
+    if len(keys) < n + len(query.sort) or {k for k, d in keys[:n]} != query.fields:
+        return False
+    sort = keys[n:n + len(query.sort)]
+    return sort == query.sort or sort == [(k, -d) for k, d in query.sort]
+
+
+def log_report(report):
+    for collection, result in report.items():
+        for kind, names in result.items():
+            if names:
+                log = logging.warning if kind == 'conflict' else logging.info
+                log('%s indexes of %s: %s' % (kind, collection, ', '.join(names)))
+
+
+registry = IndexRegistry()
+add_index = registry.add_index
+add_query = registry.add_query
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 操作日志缓冲区，批量写入文档库，避免每个请求都等待一次插入
+@time: 2026/10/18
+"""
+
+import logging
+from collections import deque
+from tornado.ioloop import IOLoop, PeriodicCallback
+from pymongo.errors import PyMongoError, BulkWriteError
+from utils.executor import thread_pool
+
+
+class LogBuffer(object):
+    """
+    先缓存日志文档，达到 batch_size 条或每隔 flush_interval 秒用 insert_many(ordered=False) 批量写入。
+    缓冲区已有 max_size 条时按 overflow 处理：drop_new 丢弃新日志，drop_old 丢弃最早的日志。
+    stats 记录累计的缓存(buffered)、写入(flushed)、丢弃(dropped)、写入失败(failed)条数。
+    """
+    OVERFLOW = ('drop_new', 'drop_old')
+
+    def __init__(self, get_collection, batch_size=100, flush_interval=1, max_size=10000, overflow='drop_new'):
+        """
+        :param get_collection: 返回pymongo集合的函数，在首次写入时才调用，以便在fork后的子进程中连接文档库
+        """
+        self.get_collection = get_collection
+        self.queue = deque()
+        self.stats = dict(buffered=0, flushed=0, dropped=0, failed=0)
+        self._flushing = False
+        self._timer = None
+        self.configure(batch_size, flush_interval, max_size, overflow)
+
+    def configure(self, batch_size=100, flush_interval=1, max_size=10000, overflow='drop_new'):
+        """ 设置各参数(见类的说明)，重载配置时调用，flush_interval 改变时按新的间隔重新定时 """
+        if overflow not in self.OVERFLOW:
+            raise ValueError('overflow should be in %s' % str(self.OVERFLOW))
+        if not (batch_size > 0 and flush_interval > 0 and max_size > 0):
+            raise ValueError('batch_size, flush_interval and max_size should be positive')
+        if self._timer and flush_interval != self.flush_interval:
+            self._timer.stop()
+            self._timer = None  # 下次 append 时按新的间隔定时
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.overflow = overflow
+
+    def __len__(self):
+        return len(self.queue)
+
+    def append(self, doc):
+        """ 缓存一条日志，缓冲区已满且为 drop_new 时丢弃并返回False """
+        if len(self.queue) >= self.max_size:
+            self.stats['dropped'] += 1
+            if self.overflow == 'drop_new':
+                return False
+            self.queue.popleft()
+        self.queue.append(doc)
+        self.stats['buffered'] += 1
+
+        if not self._timer:
+            self._timer = PeriodicCallback(self.flush_async, self.flush_interval * 1000)
+            self._timer.start()
+        if len(self.queue) >= self.batch_size and not self._flushing:
+            IOLoop.current().add_callback(self.flush_async)
+        return True
+
+    def _take(self):
+        size = min(self.batch_size, len(self.queue))
+        return [self.queue.popleft() for _ in range(size)]
+
+    def _write(self, docs):
+        try:
+            self.get_collection().insert_many(docs, ordered=False)
+            self.stats['flushed'] += len(docs)
+        except BulkWriteError as err:
+            inserted = err.details.get('nInserted', 0)
+            self.stats['flushed'] += inserted
+            self.stats['failed'] += len(docs) - inserted
+        except PyMongoError as err:
+            self.stats['failed'] += len(docs)
+            logging.warning('fail to write %d op logs: %s' % (len(docs), str(err)))
+
+    async def flush_async(self):
+        """ 在线程池中分批写入缓冲区中的全部日志，不阻塞 IOLoop """
+        if self._flushing:
+            return
+        self._flushing = True
+        try:
+            while self.queue:
+                await thread_pool.run(self._write, self._take())
+        finally:
+            self._flushing = False
+
+    def flush(self):
+        """ 同步写入缓冲区中的全部日志，在服务停止时调用 """
+        if self._timer:
+            self._timer.stop()
+            self._timer = None
+        while self.queue:
+            self._write(self._take())
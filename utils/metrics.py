@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 进程内的运行指标(响应时间分布、计数)，多进程时各进程定时写入文件，由 /api/metrics 合并输出
+@time: 2026/10/18
+"""
+
+import os
+import json
+import logging
+from bisect import bisect_left
+from tornado.ioloop import PeriodicCallback
+
+# 响应时间分布的桶上限(毫秒)
+BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def format_labels(labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"')) for k, v in labels.items())
+
+
+def split_stats(get_stats, gauge_keys):
+    """ 将返回值中混有当前值的 get_stats 拆为 (计数函数, 当前值函数)，分别用 add_source 登记为 counter 和 gauge """
+
+    def pick(is_gauge):
+        return lambda: {k: v for k, v in (get_stats() or {}).items() if (k in gauge_keys) == is_gauge}
+
+    return pick(False), pick(True)
+
+
+class Histogram(object):
+    def __init__(self, counts=None, total=0.0):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)  # 最后一个为超过最大桶上限的次数
+        self.total = total
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+
+    def quantile(self, q):
+        """ 按桶内均匀分布估算分位数 """
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i else 0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return 0
+
+    def to_list(self):
+        return [self.counts, self.total]
+
+
+class Metrics(object):
+    """
+    histograms、counters 和 gauges 的结构为 {指标名: {标签串: 值}}。
+    add_source 登记的函数在输出时调用，返回 {类型: 数值}，作为 {指标名}{type="类型"} 计数(counter)或当前值(gauge)输出。
+    """
+    KINDS = ('counter', 'gauge')
+
+    def __init__(self, path=None, interval=5):
+        """
+        :param path: 多进程时各进程写入指标文件的目录，不指定则只输出本进程的指标
+        :param interval: 写入指标文件的间隔秒数
+        """
+        self.path = path
+        self.interval = interval
+        self.histograms = {}
+        self.counters = {}
+        self.sources = {}
+        self._timer = None
+
+    def observe(self, name, value, **labels):
+        key = format_labels(labels)
+        hist = self.histograms.setdefault(name, {}).get(key)
+        if hist is None:
+            hist = self.histograms[name][key] = Histogram()
+        hist.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        counters = self.counters.setdefault(name, {})
+        key = format_labels(labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def add_source(self, name, get_stats, kind='counter'):
+        """ kind 为 counter 时各值只增不减(累计次数)，为 gauge 时可增可减(如正在执行的任务数、空闲连接数) """
+        assert kind in self.KINDS, 'kind should be in %s' % str(self.KINDS)
+        self.sources[name] = get_stats, kind
+
+    def snapshot(self):
+        counters = {name: dict(values) for name, values in self.counters.items()}
+        gauges = {}
+        for name, (get_stats, kind) in self.sources.items():
+            stats = get_stats() or {}
+            values = {format_labels(dict(type=k)): v for k, v in stats.items()}
+            (gauges if kind == 'gauge' else counters)[name] = values
+        histograms = {name: {k: h.to_list() for k, h in values.items()} for name, values in self.histograms.items()}
+        return dict(histograms=histograms, counters=counters, gauges=gauges)
+
+    def start(self):
+        """ 在各工作进程中定时写入指标文件 """
+        if self.path and not self._timer:
+            os.makedirs(self.path, exist_ok=True)
+            self._timer = PeriodicCallback(self.dump, self.interval * 1000)
+            self._timer.start()
+
+    def stop(self):
+        if self._timer:
+            self._timer.stop()
+            self._timer = None
+        if self.path and os.path.exists(self._filename(os.getpid())):
+            os.remove(self._filename(os.getpid()))
+
+    def _filename(self, pid):
+        return os.path.join(self.path, '%d.json' % pid)
+
+    def dump(self):
+        filename = self._filename(os.getpid())
+        try:
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(filename + '.tmp', filename)
+        except OSError as err:
+            logging.warning('fail to dump metrics: %s' % str(err))
+
+    def _load_others(self):
+        snapshots = []
+        if not self.path or not os.path.isdir(self.path):
+            return snapshots
+        for fn in os.listdir(self.path):
+            pid = fn.endswith('.json') and fn[:-5].isdigit() and int(fn[:-5])
+            if not pid or pid == os.getpid():
+                continue
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:  # 进程已退出
+                os.remove(os.path.join(self.path, fn))
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(os.path.join(self.path, fn)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                pass
+        return snapshots
+
+    def collect(self):
+        """ 合并本进程和其他工作进程的指标，计数和当前值为各进程之和 """
+        histograms, counters, gauges = {}, {}, {}
+        for snap in [self.snapshot()] + self._load_others():
+            for name, values in snap['histograms'].items():
+                merged = histograms.setdefault(name, {})
+                for key, (counts, total) in values.items():
+                    if key in merged:
+                        merged[key].merge(Histogram(counts, total))
+                    else:
+                        merged[key] = Histogram(list(counts), total)
+            for kind, result in (('counters', counters), ('gauges', gauges)):
+                for name, values in snap.get(kind, {}).items():
+                    merged = result.setdefault(name, {})
+                    for key, value in values.items():
+                        merged[key] = merged.get(key, 0) + value
+        return histograms, counters, gauges
+
+    def render(self):
+        """ 输出 Prometheus 文本格式的指标 """
+        histograms, counters, gauges = self.collect()
+        lines = []
+        for name, values in sorted(histograms.items()):
+            lines.append('# TYPE %s histogram' % name)
+            for key, hist in sorted(values.items()):
+                prefix = key + ',' if key else ''
+                cumulative = 0
+                for le, n in zip(BUCKETS + ('+Inf',), hist.counts):
+                    cumulative += n
+                    lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, le, cumulative))
+                lines.append('%s_sum{%s} %.3f' % (name, key, hist.total))
+                lines.append('%s_count{%s} %d' % (name, key, cumulative))
+            lines.append('# TYPE %s_quantile gauge' % name)
+            for key, hist in sorted(values.items()):
+                prefix = key + ',' if key else ''
+                for q in (0.5, 0.9, 0.99):
+                    lines.append('%s_quantile{%squantile="%s"} %.3f' % (name, prefix, q, hist.quantile(q)))
+        for kind, values_by_name in (('counter', counters), ('gauge', gauges)):
+            for name, values in sorted(values_by_name.items()):
+                lines.append('# TYPE %s %s' % (name, kind))
+                for key, value in sorted(values.items()):
+                    lines.append('%s{%s} %s' % (name, key, value))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 文档库连接池的使用情况：正在使用和空闲的连接数、取连接的等待耗时和失败次数。
+需要 pymongo 3.9 以上的连接池事件，requirements.txt 中的 pymongo 3.7.2 没有，此时不输出这些指标
+@time: 2026/10/18
+"""
+
+import time
+import threading
+
+try:
+    from pymongo.monitoring import ConnectionPoolListener
+except ImportError:  # pymongo 3.9 以下没有连接池事件
+    ConnectionPoolListener = None
+
+
+class PoolMonitor(ConnectionPoolListener or object):
+    """
+    统计本进程连接池的连接数：checked_out(正在使用)、idle(空闲)、created(累计建立)、closed(累计关闭)、
+    check_out_failed(累计取连接超时或出错的次数)，设置了 metrics 时记录取连接的等待耗时 mongo_pool_wait_ms。
+    pymongo 3.9 以下没有连接池事件，supported 为 False，stats 为空，不输出连接池指标。
+    """
+    supported = ConnectionPoolListener is not None
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.counts = dict(created=0, closed=0, checked_out=0, check_out_failed=0)
+        self._local = threading.local()  # 取连接在调用者的线程中进行，按线程记录开始时刻
+        self._lock = threading.Lock()  # 事件在多个线程中发生
+
+    @property
+    def stats(self):
+        if not self.supported:
+            return {}
+        return dict(self.counts, idle=self.counts['created'] - self.counts['closed'] - self.counts['checked_out'])
+
+    def _inc(self, key, value=1):
+        with self._lock:
+            self.counts[key] += value
+
+    def _observe_wait(self):
+        started = getattr(self._local, 'started', None)
+        if started and self.metrics:
+            self.metrics.observe('mongo_pool_wait_ms', (time.time() - started) * 1000)
+        self._local.started = None
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.time()
+
+    def connection_checked_out(self, event):
+        self._inc('checked_out')
+        self._observe_wait()
+
+    def connection_check_out_failed(self, event):
+        self._inc('check_out_failed')
+        self._observe_wait()
+
+    def connection_checked_in(self, event):
+        self._inc('checked_out', -1)
+
+    def connection_created(self, event):
+        self._inc('created')
+
+    def connection_closed(self, event):
+        self._inc('closed')
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
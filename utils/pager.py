@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 按键值范围分页(keyset)，用上一页最后一条记录的排序值和_id查询下一页，翻到第几页耗时都一样，不像skip越往后越慢
+@time: 2026/10/18
+"""
+
+import hmac
+import base64
+import hashlib
+from bson import json_util
+from bson.json_util import JSONOptions
+from tornado.escape import utf8, to_unicode
+
+JSON_OPTIONS = JSONOptions(tz_aware=False)  # 与pymongo默认一致，时间为不带时区的UTC时间
+
+
+def page_query(condition, sort_key='_id', direction=-1, last=None):
+    """
+    返回下一页的查询条件和排序，排序值相同时按_id排序。集合应有 (sort_key, _id) 的复合索引，sort_key 为_id时不需要。
+    与文档库的排序一致，排序值为null或缺少排序字段的记录排在最小的一端
+    :param last: 上一页最后一条记录的 (排序值, _id)，为空表示第一页
+    """
+    sort = [(sort_key, direction)] if sort_key == '_id' else [(sort_key, direction), ('_id', direction)]
+    if not last:
+        return condition or {}, sort
+    op = '$gt' if direction > 0 else '$lt'
+    value, _id = last
+    if sort_key == '_id':
+        after = {'_id': {op: _id}}
+    elif value is None:  # 排序值为null或缺少排序字段的记录升序时排在最前，降序时排在最后，$gt、$lt 不匹配null
+        after = {sort_key: None, '_id': {op: _id}}
+        if direction > 0:
+            after = {'$or': [after, {sort_key: {'$ne': None}}]}
+    else:
+        after = [{sort_key: {op: value}}, {sort_key: value, '_id': {op: _id}}]
+        after = {'$or': after + [{sort_key: None}] if direction < 0 else after}
+    return {'$and': [condition, after]} if condition else after, sort
+
+
+def _sign(secret, payload):
+    return base64.urlsafe_b64encode(hmac.new(utf8(secret), payload, hashlib.sha256).digest()[:12])
+
+
+def encode_token(secret, doc, sort_key='_id', direction=-1):
+    """ 由本页最后一条记录生成下一页的令牌，令牌带签名，客户端不能修改 """
+    value = doc
+    for k in sort_key.split('.'):
+        value = value.get(k) if isinstance(value, dict) else None
+    data = json_util.dumps([sort_key, direction, value, doc['_id']], json_options=JSON_OPTIONS)
+    payload = base64.urlsafe_b64encode(utf8(data))
+    return to_unicode(payload + b'.' + _sign(secret, payload))
+
+
+def decode_token(secret, token, sort_key='_id', direction=-1):
+    """ 返回令牌中的 (排序值, _id)，令牌无效或不是按 sort_key、direction 排序生成的时抛出 ValueError """
+    payload, _, signature = utf8(token).partition(b'.')
+    if not hmac.compare_digest(signature, _sign(secret, payload)):
+        raise ValueError('invalid page token')
+    key, order, value, _id = json_util.loads(to_unicode(base64.urlsafe_b64decode(payload)), json_options=JSON_OPTIONS)
+    if key != sort_key or order != direction:
+        raise ValueError('the page token is for another order')
+    return value, _id
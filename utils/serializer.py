@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: API响应的JSON序列化。fast 使用C实现的JSON库(优先orjson)，按类型转换ObjectId等BSON类型，
+       输出格式与 bson.json_util 一致；compat 即 json_util.dumps
+@time: 2026/10/18
+"""
+
+import json
+import logging
+import calendar
+from base64 import b64encode
+from datetime import datetime
+from bson import json_util
+from bson.objectid import ObjectId
+from bson.decimal128 import Decimal128
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _datetime_to_millis(dt):
+    if dt.utcoffset() is not None:
+        dt = dt - dt.utcoffset()
+    return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+
+
+_converters = {
+    ObjectId: lambda obj: {'$oid': str(obj)},
+    datetime: lambda obj: {'$date': _datetime_to_millis(obj)},
+    bytes: lambda obj: {'$binary': b64encode(obj).decode(), '$type': '00'},
+    Decimal128: lambda obj: {'$numberDecimal': str(obj)},
+}
+
+
+def default(obj):
+    """ 转换JSON库不支持的类型，常见类型按类型直接查表，其余交给 json_util.default """
+    convert = _converters.get(type(obj))
+    return convert(obj) if convert else json_util.default(obj)
+
+
+def dumps_compat(obj):
+    return json_util.dumps(obj)
+
+
+if orjson:
+    _orjson_option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps_fast(obj):
+        """ 返回UTF-8编码的bytes，orjson不支持的数据(如超过64位的整数)改用 json_util """
+        try:
+            return orjson.dumps(obj, default=default, option=_orjson_option)
+        except TypeError:
+            return json_util.dumps(obj)
+else:
+    def dumps_fast(obj):
+        return json.dumps(obj, default=default, ensure_ascii=False, separators=(',', ':'))
+
+
+encoders = dict(fast=dumps_fast, compat=dumps_compat)
+_warned = []  # 未安装orjson的警告只记录一次
+
+
+def get_encoder(name):
+    """ 按名称(fast、compat)取序列化函数，也可传入自定义的函数 """
+    if callable(name):
+        return name
+    assert name in encoders, 'json encoder should be in %s' % str(list(encoders))
+    if name == 'fast' and not orjson and not _warned:
+        _warned.append(name)
+        logging.warning('orjson is not installed, the fast json encoder falls back to json, pip install orjson')
+    return encoders[name]
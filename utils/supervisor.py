@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 多进程服务的主进程：启动并监控工作进程，收到 SIGHUP 时滚动重启，部署时不中断服务
+@time: 2026/10/18
+"""
+
+import os
+import sys
+import time
+import select
+import signal
+import logging
+import subprocess
+
+
+class Supervisor(object):
+    """
+    主进程不处理请求，各工作进程是独立启动的子进程(重启后加载新代码)，用 SO_REUSEPORT 绑定同一端口，由内核分配连接。
+    工作进程绑定端口、开始接受连接后调用 notify_ready 通知主进程。
+    收到 SIGHUP 时逐个重启：先启动新进程并等它就绪，再让旧进程停止接受连接、处理完已有请求后退出；新进程启动失败时停止重启，保留旧进程。
+    收到 SIGTERM 或 SIGINT 时让全部工作进程处理完已有请求后退出。工作进程意外退出时自动重启。
+    """
+
+    def __init__(self, args, num_workers, ready_timeout=30, stop_timeout=30):
+        """
+        :param args: 启动工作进程的命令行参数列表，序号和就绪管道通过 --worker_id、--ready_fd 参数传入
+        :param ready_timeout: 等待工作进程就绪的秒数
+        :param stop_timeout: 等待工作进程退出的秒数，超时则强制结束
+        """
+        self.args = args
+        self.num_workers = num_workers
+        self.ready_timeout = ready_timeout
+        self.stop_timeout = stop_timeout
+        self.workers = {}  # 序号: subprocess.Popen
+        self.started = {}  # 序号: 启动时刻
+        self.reloading = self.stopping = False
+
+    def spawn(self, worker_id):
+        """ 启动工作进程并等待就绪，失败时返回 None """
+        start = self.started[worker_id] = time.time()
+        r, w = os.pipe()
+        args = self.args + ['--worker_id=%d' % worker_id, '--ready_fd=%d' % w]
+        proc = subprocess.Popen(args, pass_fds=(w,))
+        os.close(w)
+        try:
+            ready = self._wait_ready(r, proc)
+        finally:
+            os.close(r)
+        if not ready:
+            logging.error('worker #%d (pid %d) failed to start' % (worker_id, proc.pid))
+            self._stop(proc)
+            return None
+        logging.info('worker #%d (pid %d) is ready in %.2fs' % (worker_id, proc.pid, time.time() - start))
+        return proc
+
+    def _wait_ready(self, r, proc):
+        deadline = time.time() + self.ready_timeout
+        while time.time() < deadline:
+            if select.select([r], [], [], 0.2)[0]:
+                return os.read(r, 1) == b'1'  # 进程退出时读到空串
+            if proc.poll() is not None:
+                return False
+        return False
+
+    def _stop(self, proc):
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(self.stop_timeout)
+        except subprocess.TimeoutExpired:
+            logging.warning('worker (pid %d) did not stop in %ds, killed' % (proc.pid, self.stop_timeout))
+            proc.kill()
+            proc.wait()
+
+    def _on_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reloading = True
+        else:
+            self.stopping = True
+
+    def rolling_restart(self):
+        start = time.time()
+        for worker_id in sorted(self.workers):
+            if self.stopping:
+                return
+            proc = self.spawn(worker_id)
+            if not proc:
+                logging.error('rolling restart aborted, old workers are kept')
+                return
+            old, self.workers[worker_id] = self.workers[worker_id], proc
+            self._stop(old)
+        logging.info('%d workers restarted in %.2fs' % (len(self.workers), time.time() - start))
+
+    def stop_all(self):
+        for proc in self.workers.values():
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+        for proc in self.workers.values():
+            self._stop(proc)
+        self.workers = {}
+
+    def _check_workers(self):
+        for worker_id, proc in list(self.workers.items()):
+            if proc.poll() is not None:
+                logging.warning('worker #%d (pid %d) exited with %s' % (worker_id, proc.pid, proc.returncode))
+                if time.time() - self.started.get(worker_id, 0) < 5:
+                    time.sleep(1)  # 启动后很快退出或启动失败的，避免频繁重启
+                self.workers[worker_id] = self.spawn(worker_id) or proc
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_signal)
+        for worker_id in range(self.num_workers):
+            proc = self.spawn(worker_id)
+            if not proc:
+                self.stop_all()
+                return 1
+            self.workers[worker_id] = proc
+
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                self.rolling_restart()
+            else:
+                self._check_workers()
+            time.sleep(0.2)
+        self.stop_all()
+        return 0
+
+
+def notify_ready(fd):
+    """ 工作进程开始接受连接后通知主进程 """
+    if fd is not None and fd >= 0:
+        os.write(fd, b'1')
+        os.close(fd)
+
+
+def set_cpu_affinity(worker_id):
+    """ 将工作进程固定在一个CPU上，只在支持的系统(Linux)上生效 """
+    if hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[worker_id % len(cpus)]})
+
+
+def stop_server(server):
+    """
+    停止接受新连接。SO_REUSEPORT 的各监听socket有各自的连接队列，直接关闭会丢弃队列中的连接，所以先接收完队列中的连接再关闭；
+    已有连接在当前请求结束后关闭，客户端重连到其他工作进程
+    """
+    server.conn_params.no_keep_alive = True
+    for sock in list(server._sockets.values()):
+        while True:
+            try:
+                connection, address = sock.accept()
+            except OSError:  # 队列已空
+                break
+            server._handle_connection(connection, address)
+    server.stop()
+
+
+def worker_args(script):
+    """ 启动工作进程的命令行：与主进程的参数相同，去掉 --supervisor 参数 """
+    return [sys.executable, script] + [a for a in sys.argv[1:] if not a.startswith('--supervisor')]
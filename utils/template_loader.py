@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@desc: 预编译网页模板，各进程缓存编译后的模板，debug 模式下模板文件修改后重新加载
+@time: 2026/10/18
+"""
+
+import os
+import time
+import logging
+from tornado import template
+
+
+class TimedTemplate(template.Template):
+    """ 记录每次生成网页耗时的模板 """
+
+    def generate(self, **kwargs):
+        start = time.time()
+        try:
+            return super(TimedTemplate, self).generate(**kwargs)
+        finally:
+            metrics = self.loader and self.loader.metrics
+            if metrics:
+                metrics.observe('template_render_ms', 1000.0 * (time.time() - start), template=self.name)
+
+
+class TemplateLoader(template.Loader):
+    def __init__(self, root_directory, reload=False, metrics=None, **kwargs):
+        """
+        :param reload: 是否在模板文件修改后重新加载，用于debug模式
+        :param metrics: 记录网页生成耗时的 Metrics 对象
+        """
+        super(TemplateLoader, self).__init__(root_directory, **kwargs)
+        self.reload = reload
+        self.metrics = metrics
+        self.mtimes = {}
+
+    def precompile(self, ext=('.html',)):
+        """ 编译模板目录下的全部模板，返回耗时毫秒数 """
+        start = time.time()
+        names = []
+        for root, dirs, files in os.walk(self.root):
+            for fn in files:
+                if fn.endswith(ext):
+                    names.append(os.path.relpath(os.path.join(root, fn), self.root).replace(os.sep, '/'))
+                    self.load(names[-1])
+        elapsed = 1000.0 * (time.time() - start)
+        logging.info('compiled %d templates in %.2fms: %s' % (len(names), elapsed, ','.join(sorted(names))))
+        return elapsed
+
+    def _modified(self):
+        for name, mtime in list(self.mtimes.items()):
+            try:
+                if os.path.getmtime(os.path.join(self.root, name)) != mtime:
+                    return True
+            except OSError:
+                return True
+
+    def load(self, name, parent_path=None):
+        # 被包含或继承的模板修改后，引用它的模板也需重新编译，所以有修改时清空全部缓存
+        if self.reload and parent_path is None and self._modified():
+            with self.lock:
+                self.reset()
+                self.mtimes = {}
+        return super(TemplateLoader, self).load(name, parent_path)
+
+    def _create_template(self, name):
+        path = os.path.join(self.root, name)
+        self.mtimes[name] = os.path.getmtime(path)
+        with open(path, 'rb') as f:
+            return TimedTemplate(f.read(), name=name, loader=self)